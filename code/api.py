@@ -0,0 +1,254 @@
+import asyncio
+import os
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+
+from assets import read_text
+from backend import YAMLTransformer, render_svg_from_yaml
+from batch import EXCEPTION_ICON_PATH, FIRST_PASS_PATH, ICON_DESCRIPTOR_PATH, SECOND_PASS_PATH, form_input
+from diagram import Diagram
+from icons import BASE_DIR, IconIndex
+from instrumentation import Instrumentation, PrometheusExporter
+from prompts import form_prompt, icons_prompt
+from streaming import stream_resolved_diagram
+
+# Rendering service: uvicorn api:app --host 0.0.0.0 --port 8000 (from the code directory)
+#   POST /jobs/render   diagram YAML -> SVG          POST /jobs/prompt   form answers -> SVG (LLM passes first)
+#   GET  /jobs/{id}     status and progress          GET  /jobs/{id}/svg streamed result once done
+#   DELETE /jobs/{id}   cancel                        POST /render        YAML -> SVG in one blocking call
+#   GET  /metrics       Prometheus text (run with ORCHESTREE_INSTRUMENTATION=prometheus)
+
+WORKERS = 4             # Jobs processed at the same time; dot itself is bounded by GraphvizRenderer
+MAX_QUEUED = 64         # Submissions beyond this are refused with 429 instead of queueing without bound
+MAX_FINISHED = 1000     # Finished jobs kept for polling, oldest dropped first
+RESULT_CHUNK = 64 * 1024
+
+class RenderRequest(BaseModel):
+    yaml: str
+    resolved: bool = False          # Icons are already file paths (output of resolve_icon_paths), checked against the descriptor
+    use_symbols: bool = True
+    fan_out: Optional[str] = None   # 'junction' routes group-to-group relations through one point (see dot_builder)
+
+class PromptRequest(BaseModel):
+    title: str
+    cloud_providers: List[str] = []
+    resources: List[str] = []
+    cluster_description: str = ""
+    relationships_description: str = ""
+    use_symbols: bool = True
+    refresh: bool = False           # Ask the LLM for a new answer instead of the cached one (Regenerate)
+    fan_out: Optional[str] = None
+
+class Job:
+    __slots__ = ('id', 'kind', 'request', 'status', 'progress', 'error', 'svg', 'diagram', 'created', 'finished', 'task', 'done')
+
+    def __init__(self, kind:str, request):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.request = request
+        self.status = 'queued'      # queued -> running -> done | failed | cancelled
+        self.progress = ''
+        self.error = None
+        self.svg = None
+        self.diagram = None         # Resolved Diagram, written out as YAML only when /yaml asks for it
+        self.created = time.time()
+        self.finished = None
+        self.task = None
+        self.done = asyncio.Event()
+
+    def describe(self):
+        return {'id': self.id, 'kind': self.kind, 'status': self.status, 'progress': self.progress, 'error': self.error,
+                'created': self.created, 'finished': self.finished, 'bytes': len(self.svg) if self.svg else None}
+
+class JobQueue:
+    ''' Bounded asyncio queue of render jobs drained by a fixed number of worker tasks. Blocking stages (parsing,
+    dot, icon inlining) run in threads so the event loop keeps answering status polls.'''
+
+    def __init__(self, workers:int = WORKERS, max_queued:int = MAX_QUEUED):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.queue = None
+        self.jobs = OrderedDict()
+        self.prompts = None             # (first pass, second pass) system prompts, read once in start()
+        self.icon_paths = None          # Real paths of the descriptor icons and the exception icon, built in start()
+        self._tasks = []
+
+    def start(self):
+        # Created here, inside the server's event loop (asyncio primitives bind to the loop that creates them on 3.9)
+        self.queue = asyncio.Queue(maxsize=self.max_queued)
+        self.prompts = (read_text(FIRST_PASS_PATH), read_text(SECOND_PASS_PATH))
+        self.icon_paths = frozenset(map(os.path.realpath, IconIndex.load(ICON_DESCRIPTOR_PATH).paths + [EXCEPTION_ICON_PATH]))
+        self._tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def submit(self, kind:str, request):
+        job = Job(kind, request)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise HTTPException(status_code=429, detail=f"More than {self.max_queued} jobs queued, retry later")
+        self.jobs[job.id] = job
+        self.forget_finished()
+        return job
+
+    def get(self, job_id:str):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Unknown job '{job_id}'")
+        return job
+
+    def forget_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished is not None]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED)]:
+            del self.jobs[job_id]
+
+    async def work(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                if job.status == 'cancelled':
+                    continue
+                job.status = 'running'
+                job.task = asyncio.current_task()
+                await self.run(job)
+                job.status = 'done'
+            except asyncio.CancelledError:
+                if job.status != 'cancelled':
+                    # The worker itself is being stopped
+                    raise
+            except Exception as e:
+                job.status = 'failed'
+                job.error = f'{type(e).__name__}: {e}'
+            finally:
+                job.task = None
+                job.finished = job.finished or time.time()
+                job.done.set()
+                self.queue.task_done()
+
+    async def run(self, job:Job):
+        request = job.request
+        if job.kind == 'prompt':
+            first_pass, second_pass = self.prompts
+            input_data = form_input(request.model_dump())
+            def progress(message):
+                job.progress = message
+            diagram = await stream_resolved_diagram(
+                input_data=form_prompt(input_data), first_pass=first_pass, second_pass=second_pass, cloud_icons=icons_prompt(request.resources),
+                icon_descriptor_path=ICON_DESCRIPTOR_PATH, exception_icon_path=EXCEPTION_ICON_PATH, refresh=request.refresh,
+                progress=progress, allowed_icons=request.resources, providers=request.cloud_providers)
+        else:
+            diagram = await self.in_thread(Diagram.from_yaml, request.yaml)
+            if request.resolved:
+                self.check_icon_paths(diagram)
+            else:
+                diagram = await self.in_thread(YAMLTransformer.resolve_icon_paths, diagram, icon_descriptor_path=ICON_DESCRIPTOR_PATH,
+                                               exception_icon_path=EXCEPTION_ICON_PATH)
+        job.diagram = diagram
+        job.progress = "Rendering diagram"
+        job.svg = await self.in_thread(render_svg_from_yaml, diagram, use_symbols=request.use_symbols, fan_out=request.fan_out)
+        job.progress = "Done"
+
+    @staticmethod
+    async def in_thread(function, *args, **kwargs):
+        ''' asyncio.to_thread, except that a cancelled job keeps its worker until the thread is done: the thread cannot
+        be stopped, so freeing the worker early would let more than `workers` renders run at once.'''
+        future = asyncio.ensure_future(asyncio.to_thread(function, *args, **kwargs))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await asyncio.wait([future])
+            raise
+
+    def check_icon_paths(self, diagram:Diagram):
+        ''' Icon files are read and inlined into the SVG: a resolved diagram may only name the descriptor's icons.'''
+        for qualified_id, resource in diagram.iter_resources():
+            if resource.icon is not None and os.path.realpath(os.path.join(BASE_DIR, str(resource.icon))) not in self.icon_paths:
+                raise ValueError(f"Icon of '{qualified_id}' is not an icon of the descriptor")
+
+    def cancel(self, job:Job):
+        if job.finished is not None:
+            return
+        job.status = 'cancelled'
+        job.finished = time.time()
+        job.done.set()
+        if job.task is not None:
+            # Cancels the LLM stream at once; a render thread already running finishes first (see in_thread)
+            job.task.cancel()
+
+def stream_text(text:str):
+    for start in range(0, len(text), RESULT_CHUNK):
+        yield text[start:start + RESULT_CHUNK]
+
+jobs = JobQueue()
+
+@asynccontextmanager
+async def lifespan(_app):
+    jobs.start()
+    yield
+    await jobs.stop()
+
+app = FastAPI(title="Orchestree rendering service", lifespan=lifespan)
+
+@app.post("/jobs/render", status_code=202)
+async def submit_render(request:RenderRequest):
+    return jobs.submit('render', request).describe()
+
+@app.post("/jobs/prompt", status_code=202)
+async def submit_prompt(request:PromptRequest):
+    return jobs.submit('prompt', request).describe()
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id:str):
+    return jobs.get(job_id).describe()
+
+@app.get("/jobs/{job_id}/svg")
+async def job_result(job_id:str):
+    job = jobs.get(job_id)
+    if job.status != 'done':
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    return StreamingResponse(stream_text(job.svg), media_type="image/svg+xml")
+
+@app.get("/jobs/{job_id}/yaml")
+async def job_yaml(job_id:str):
+    job = jobs.get(job_id)
+    if job.diagram is None:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    text = await asyncio.to_thread(job.diagram.to_yaml)
+    return StreamingResponse(stream_text(text), media_type="application/yaml")
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id:str):
+    job = jobs.get(job_id)
+    jobs.cancel(job)
+    return job.describe()
+
+@app.post("/render")
+async def render(request:RenderRequest):
+    ''' Blocking convenience endpoint: queues the job like /jobs/render and streams the SVG once it is done.'''
+    job = jobs.submit('render', request)
+    await job.done.wait()
+    if job.status != 'done':
+        raise HTTPException(status_code=422 if job.status == 'failed' else 409, detail=job.error or f"Job was {job.status}")
+    return StreamingResponse(stream_text(job.svg), media_type="image/svg+xml")
+
+@app.get("/health")
+async def health():
+    return {'queued': jobs.queue.qsize(), 'jobs': len(jobs.jobs), 'workers': jobs.workers}
+
+@app.get("/metrics")
+async def metrics():
+    exporter = Instrumentation.exporter(PrometheusExporter)
+    if exporter is None:
+        raise HTTPException(status_code=404, detail="Prometheus exporter not enabled (set ORCHESTREE_INSTRUMENTATION=prometheus)")
+    return PlainTextResponse(exporter.render(), media_type="text/plain; version=0.0.4")
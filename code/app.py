@@ -1,4 +1,4 @@
-import json
+import asyncio
 from pathlib import Path
 import sys
 import re
@@ -8,8 +8,14 @@ import os
 import streamlit as st
 import time
 import shutil
+import base64
 from streamlit.components.v1 import html
-from backend import YAMLTransformer, SVGTransformer, generate_svg_from_yaml, remove_all_dot_files
+from assets import Assets
+from cache import RenderCache, LLMResponseCache
+from sessions import SessionRegistry
+from rendering import RenderQueueFull
+# The pipeline (backend, streaming, incremental: lxml, numpy, rapidfuzz, LLM SDKs), the icon search index and requests
+# are imported where they are first used, so reruns that only touch widgets never load them
 
 # Set directory path
 dir = Path(__file__).resolve().parent
@@ -20,43 +26,44 @@ if "authenticated" not in st.session_state:
     st.session_state["authenticated"] = True
 if "email" not in st.session_state:
     st.session_state["email"] = None
-if "session_id" not in st.session_state:
-    st.session_state["session_id"] = None
-if "submitted" not in st.session_state:
-    st.session_state["submitted"] = False
-if "output" not in st.session_state:
-    st.session_state["output"] = None
-if "last_interaction" not in st.session_state:
-    st.session_state["last_interaction"] = time.time()
-if "input_data" not in st.session_state:
-    st.session_state["input_data"] = None
+
+# Rendered SVGs, the last render state and resolved icons live in a Session owned by the process-wide registry, which
+# frees sessions idle for longer than session_idle_minutes (see sessions.py)
+if "session_idle_minutes" in st.secrets and SessionRegistry.default().idle_timeout != st.secrets["session_idle_minutes"] * 60:
+    SessionRegistry.configure(idle_timeout=st.secrets["session_idle_minutes"] * 60)
+session_expired = st.session_state.get("session") is not None and st.session_state["session"].reaped
+session = SessionRegistry.default().open(st.session_state.get("session"))
+st.session_state["session"] = session
+st.session_state["session_id"] = session.session_id
 
 # Update last interaction time
 def update_interaction():
-    st.session_state["last_interaction"] = time.time()
-
-# Inject JavaScript to handle page unload
-st.markdown("""
-<script>
-window.addEventListener('beforeunload', function (event) {
-    fetch('/clean-up', { method: 'POST' });
-});
-</script>
-""", unsafe_allow_html=True)
+    session.touch()
 
 # Title
 st.title("Orchestree")
+if session_expired:
+    st.info("Your previous diagram was cleared after a period of inactivity.")
 
 # Supported cloud providers
 cloud_providers = ["AWS", "Azure", "Google Cloud", "IBM Cloud", "Oracle Cloud"]
 
-# Load icon keys
-with open(r"icon_descriptor.json", "r") as f:
-    icon_keys = json.load(f)
+# Optional on-disk render cache, shared by every session on this host
+if "render_cache_dir" in st.secrets and RenderCache.default().disk is None:
+    RenderCache.configure(disk_dir=st.secrets["render_cache_dir"])
+# Optional persistent LLM response cache
+if "llm_cache_path" in st.secrets and LLMResponseCache.default().store is None:
+    LLMResponseCache.configure(sqlite_path=st.secrets["llm_cache_path"])
 
-# Load default prompt JSON
-with open("default_prompt.json", "r") as f:
-    default_prompt = json.load(f)
+# Static files are parsed once per process and shared by all sessions, reloaded only when they change (see assets.py)
+icon_descriptor_path = r"icon_descriptor.json"
+icon_keys = Assets.json(icon_descriptor_path)
+default_prompt = Assets.json("default_prompt.json")
+
+def icon_search():
+    # Prebuilt, memory-mapped search index over the icon catalog (see icon_search.py)
+    from icon_search import IconSearchIndex
+    return IconSearchIndex.load(icon_descriptor_path)
 
 # Button to load default values from prompt JSON
 if st.button("Default Prompt", on_click=update_interaction):
@@ -68,6 +75,16 @@ if st.button("Default Prompt", on_click=update_interaction):
     st.session_state["relationships"] = default_prompt["relationships"]
     st.experimental_rerun()
 
+# Icon search: describe a service instead of scrolling through every icon key
+with st.expander("Find icons"):
+    icon_query = st.text_input("Describe a service, e.g. 'message queue' or 'kubernetes cluster'")
+    if icon_query:
+        matches = icon_search().search([icon_query], k=10, providers=st.session_state.get("selected_providers"))[0]
+        found_icons = st.multiselect("Matching icons", [key for key, _ in matches])
+        if st.button("Add to resources", on_click=update_interaction) and found_icons:
+            st.session_state["resources"] = list(dict.fromkeys(st.session_state.get("resources", []) + found_icons))
+            st.experimental_rerun()
+
 # User inputs
 with st.form("architecture_form"):
     file_name = st.text_input("Provide a file name for the project. Warning: File name will be used as provided", st.session_state.get("file_name", ""))
@@ -80,7 +97,102 @@ with st.form("architecture_form"):
 
 # Handle form submission
 user_id = st.session_state["session_id"]
+
+# Backend inputs, needed by both Submit and Regenerate
+first_pass = Assets.text(r"base_prompt.txt")
+second_pass = Assets.text(r"yaml_transformer.txt")
+exception_icon_path = r"blank-cloud-svgrepo-com.svg"
+
+# Optional rendering service (api.py). When configured, the LLM and Graphviz work runs there and this rerun only polls it
+render_api_url = st.secrets["render_api_url"].rstrip("/") if "render_api_url" in st.secrets else None
+
+def generate_resolved_diagram(input_data:dict, refresh:bool):
+    from prompts import form_prompt, icons_prompt
+    from streaming import stream_resolved_diagram
+    # The first gemini pass streams with progress; icons are matched locally and gemini is only asked about the doubtful ones
+    with st.status("Generating diagram...") as status:
+        diagram = asyncio.run(stream_resolved_diagram(
+            input_data=form_prompt(input_data), first_pass=first_pass, second_pass=second_pass, cloud_icons=icons_prompt(input_data["resources"]),
+            icon_descriptor_path=icon_descriptor_path, exception_icon_path=exception_icon_path, refresh=refresh,
+            allowed_icons=input_data["resources"], providers=input_data["cloud_providers"],
+            known_icons=session.known_icons, progress=lambda message: status.update(label=message)))
+        status.update(label="Rendering diagram...")
+    return diagram
+
+# Longest the app polls one rendering service job before giving up on it (and cancelling it)
+API_JOB_TIMEOUT = 300
+
+class RenderServiceError(RuntimeError):
+    ''' The rendering service could not be reached or refused the job, or the job failed or took too long.'''
+
+def generate_svg_via_api(input_data:dict, refresh:bool):
+    import requests
+    from diagram import Diagram
+    with st.status("Generating diagram...") as status:
+        try:
+            response = requests.post(f"{render_api_url}/jobs/prompt", json=dict(input_data, use_symbols=True, refresh=refresh), timeout=30)
+            response.raise_for_status()
+            job = response.json()
+            deadline = time.monotonic() + API_JOB_TIMEOUT
+            while job["status"] in ("queued", "running"):
+                if time.monotonic() > deadline:
+                    try:
+                        requests.delete(f"{render_api_url}/jobs/{job['id']}", timeout=10)
+                    except requests.RequestException:
+                        pass
+                    raise RenderServiceError(f"No diagram after {API_JOB_TIMEOUT} seconds")
+                time.sleep(0.5)
+                response = requests.get(f"{render_api_url}/jobs/{job['id']}", timeout=30)
+                response.raise_for_status()
+                job = response.json()
+                status.update(label=job["progress"] or "Waiting for a rendering worker...")
+            if job["status"] != "done":
+                raise RenderServiceError(job["error"] or f"Rendering job {job['status']}")
+            response = requests.get(f"{render_api_url}/jobs/{job['id']}/yaml", timeout=60)
+            response.raise_for_status()
+            session.diagram = Diagram.from_yaml(response.text)
+            response = requests.get(f"{render_api_url}/jobs/{job['id']}/svg", timeout=60)
+            response.raise_for_status()
+        except (requests.RequestException, RenderServiceError) as e:
+            status.update(label="Diagram generation failed", state="error")
+            raise RenderServiceError(str(e)) from e
+    return response.text
+
+def generate_svg(input_data:dict, refresh:bool):
+    # Always the compact form (each icon defined once, placed with <use>); the inline form is built only for download
+    from backend import SVGTransformer
+    from incremental import render_incremental
+    if render_api_url:
+        svg = generate_svg_via_api(input_data, refresh)
+    else:
+        session.diagram = generate_resolved_diagram(input_data, refresh)
+        svg, session.render_state = render_incremental(session.diagram, previous=session.render_state, use_symbols=True)
+    session.output = svg
+    session.preview = SVGTransformer.preview_svg(svg)
+    session.inline_output = None
+
+def generate_inline_svg():
+    # Same diagram with every icon copied inline, for editors that do not support SVG <use>
+    if render_api_url:
+        import requests
+        try:
+            response = requests.post(f"{render_api_url}/render", json={"yaml": session.diagram.to_yaml(), "resolved": True, "use_symbols": False}, timeout=120)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            raise RenderServiceError(str(e)) from e
+        return response.text
+    from incremental import render_incremental
+    svg, _ = render_incremental(session.diagram, previous=session.render_state, use_symbols=False)
+    return svg
+
+# Every Graphviz worker stayed busy with other sessions' renders for the renderer's whole queue timeout
+RENDER_BUSY_MESSAGE = "All diagram renderers are busy right now. Please try again in a moment."
+
 if submitted:
+    if not resources:
+        # No icons picked: suggest them from the clustering and relationship descriptions
+        resources = icon_search().suggest(clustering + "\n" + relationships, k=15, providers=selected_providers)
+        st.session_state["resources"] = resources
     input_data = {
         "title": title,
         "cloud_providers": selected_providers,
@@ -88,84 +200,61 @@ if submitted:
         "resources": resources,
         "cluster_description": clustering
     }
-    st.session_state["input_data"] = str(input_data)
+    session.input_data = input_data
 
     # Start backend process logic
-    with open(r"base_prompt.txt", 'r') as base_prompt_file:
-        first_pass = base_prompt_file.read()
-    with open(r"yaml_transformer.txt", 'r') as base_prompt_file:
-        second_pass = base_prompt_file.read()
-    icon_descriptor_path = r"icon_descriptor.json"
-    exception_icon_path = r"blank-cloud-svgrepo-com.svg"
-
-    first_yaml = YAMLTransformer().generate_yaml_from_prompt(input_data=str(input_data), system_prompt=first_pass)
-    second_yaml = YAMLTransformer().transform_yaml_with_icons(input_yaml=first_yaml, cloud_icons=str(resources), system_prompt=second_pass)
-    third_yaml = YAMLTransformer().transform_yaml_with_icon_paths(yaml_string=second_yaml, icon_descriptor_path=icon_descriptor_path, exception_icon_path=exception_icon_path)
-    local_svg = generate_svg_from_yaml(yaml_content=third_yaml)
-    new_svg = SVGTransformer().get_svg_code(main_svg_code=local_svg)
-    remove_all_dot_files()
-
+    try:
+        generate_svg(input_data, refresh=False)
+    except RenderQueueFull:
+        st.warning(RENDER_BUSY_MESSAGE)
+    except (RenderServiceError, ValueError) as e:
+        # ValueError: the LLM answer was not a valid diagram; it is not cached, so submitting again asks anew
+        st.error(f"Diagram generation failed: {e}")
     # End backend process logic
-    st.session_state["output"] = new_svg
-    st.session_state["submitted"] = True
-
-if st.session_state["submitted"]:
-
-# Replace width and height attributes inside the <svg> tag
-    scaled_svg = st.session_state["output"]
-
-    st.write(
-        f'''
-        <div style="display: flex; justify-content: center; margin-bottom: -800px;">
-            <div style="transform: scale(0.3); transform-origin: top center;">
-                {scaled_svg}
-            </div>
-        </div>
-        ''',
-        unsafe_allow_html=True
-    )
+
+if session.output is not None:
+    # The preview goes to the browser as one image: no DOM for thousands of paths, and a simplified SVG for big diagrams
+    preview = base64.b64encode(session.preview.encode("utf-8")).decode("ascii")
+    st.markdown(f'<img src="data:image/svg+xml;base64,{preview}" style="width: 100%;" alt="Diagram preview">', unsafe_allow_html=True)
+    if session.preview is not session.output:
+        st.caption(f"Simplified preview of a {len(session.output) / 1024 / 1024:.1f} MB diagram: icons are shown as tiles and labels are hidden. The download has everything.")
+
+    file_stem = file_name or 'cloud_architecture'
     st.download_button(
             label="Download SVG",
-            data=st.session_state["output"],
-            file_name=f"{file_name or 'cloud_architecture'}.svg",
+            data=session.output,
+            file_name=f"{file_stem}.svg",
             mime="image/svg+xml"
         )
-    update_interaction()
-
-    if st.button("Regenerate", on_click=update_interaction):
-        first_yaml = YAMLTransformer().generate_yaml_from_prompt(input_data=str(input_data), system_prompt=first_pass)
-        second_yaml = YAMLTransformer().transform_yaml_with_icons(input_yaml=first_yaml, cloud_icons=str(resources), system_prompt=second_pass)
-        third_yaml = YAMLTransformer().transform_yaml_with_icon_paths(yaml_string=second_yaml, icon_descriptor_path=icon_descriptor_path, exception_icon_path=exception_icon_path)
-        local_svg = generate_svg_from_yaml(yaml_content=third_yaml)
-        new_svg = SVGTransformer().get_svg_code(main_svg_code=local_svg)
-        st.session_state["output"] = new_svg
-
-            # Resize the raw SVG before embedding it
-        raw_svg = st.session_state["output"]
-
-# Replace width and height attributes inside the <svg> tag
-        scaled_svg = st.session_state["output"]
-
-        st.write(
-            f'''
-            <div style="display: flex; justify-content: center; margin-bottom: -800px;">
-                <div style="transform: scale(0.3); transform-origin: top center;">
-                    {scaled_svg}
-                </div>
-            </div>
-            ''',
-            unsafe_allow_html=True
-        )    
+    if session.inline_output is None:
+        if st.button("Prepare SVG with every icon inline (for editors that do not support SVG <use>)", on_click=update_interaction):
+            with st.spinner("Inlining icons..."):
+                try:
+                    session.inline_output = generate_inline_svg()
+                except RenderQueueFull:
+                    st.warning(RENDER_BUSY_MESSAGE)
+                except RenderServiceError as e:
+                    st.error(f"Inlining icons failed: {e}")
+    if session.inline_output is not None:
         st.download_button(
-            label="Download SVG",
-            data=st.session_state["output"],
-            file_name=f"{file_name or 'cloud_architecture'}.svg",
+            label="Download SVG with inline icons",
+            data=session.inline_output,
+            file_name=f"{file_stem}-inline.svg",
             mime="image/svg+xml"
         )
-        st.experimental_rerun()
+    update_interaction()
+
+    if st.button("Regenerate", on_click=update_interaction):
+        # Regenerate asks for a new answer: skip the cached one for the first pass
+        try:
+            generate_svg(session.input_data, refresh=True)
+        except RenderQueueFull:
+            st.warning(RENDER_BUSY_MESSAGE)
+        except (RenderServiceError, ValueError) as e:
+            st.error(f"Diagram generation failed: {e}")
+        else:
+            st.experimental_rerun()
 
     if st.button("Restart", on_click=update_interaction):
-        st.session_state["submitted"] = False
-        st.session_state["output"] = None
-        st.session_state["input_data"] = None
+        session.clear()
         st.experimental_rerun()
@@ -0,0 +1,50 @@
+import json
+import os
+import threading
+
+# Files the Streamlit app needs on every rerun (icon descriptor, default prompt, LLM prompts), read and parsed once per
+# process and shared by every session. An entry is loaded again when its file's mtime or size changes, so edited
+# prompts or a new icon descriptor are picked up without a restart.
+#
+#   icon_keys = Assets.json("icon_descriptor.json")
+#   first_pass = Assets.text("base_prompt.txt")
+
+def read_text(path:str):
+    with open(path, 'r', encoding='utf-8') as file:
+        return file.read()
+
+def read_json(path:str):
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+class Assets:
+    _entries = {}       # (absolute path, loader) -> (mtime_ns, size, value)
+    _lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path:str, loader):
+        ''' loader(path), cached until the file changes. Values are shared between sessions: treat them as read-only.'''
+        key = (os.path.abspath(path), loader)
+        stat = os.stat(path)
+        entry = cls._entries.get(key)
+        if entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            return entry[2]
+        with cls._lock:
+            entry = cls._entries.get(key)
+            if entry is None or entry[0] != stat.st_mtime_ns or entry[1] != stat.st_size:
+                entry = (stat.st_mtime_ns, stat.st_size, loader(path))
+                cls._entries[key] = entry
+        return entry[2]
+
+    @classmethod
+    def text(cls, path:str):
+        return cls.load(path, read_text)
+
+    @classmethod
+    def json(cls, path:str):
+        return cls.load(path, read_json)
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._entries.clear()
@@ -1,49 +1,196 @@
-from singletons import GoogleGeminiClientSingleton, OpenAIClientSingleton, LlamaClientSingleton
+from singletons import GoogleGeminiClientSingleton, OpenAIClientSingleton, LlamaClientSingleton, GEMINI_MODEL_NAME
+from icons import IconIndex, IconResolver, ICON_MATCH_THRESHOLD
+from dot_builder import DotBuilder
+from diagram import Diagram, dump_yaml, load_yaml
+from rendering import GraphvizRenderer, RenderError, RenderQueueFull
+from packing import PACK_MIN_NODES, pack_svgs
+from cache import RenderCache, LLMResponseCache
+from icon_bundle import IconBundle
+from instrumentation import span, count, event
+import logging
 import re
-from xml.sax.saxutils import escape, unescape
-
-import requests
-import os,glob
-from diagrams import Diagram, Edge, Cluster
-from diagrams.custom import Custom
-import json,yaml
-from subprocess import run, PIPE
+import time
+from xml.sax.saxutils import escape
+from io import BytesIO
+
+import os
+import yaml
 from lxml import etree
+from collections import OrderedDict
+import copy
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+def remove_code_block_markers(text):   # Helper function to strip the markdown code fence the LLM wraps its YAML in
+    # Remove the starting ```python
+    text = re.sub(r'^```yaml', '', text, flags=re.MULTILINE)
+    # Remove the ending ```
+    text = re.sub(r'```$', '', text, flags=re.MULTILINE)
+    # Strip leading and trailing whitespace
+    return text.strip()
+
+# Worker threads that drain blocking SDK response streams into the asyncio pipeline, one per Gemini stream in progress.
+# They spend their time waiting on the network, so the bound is generous; ORCHESTREE_LLM_STREAMS changes it
+LLM_STREAMS = int(os.environ.get('ORCHESTREE_LLM_STREAMS') or 64)
+STREAM_EXECUTOR = ThreadPoolExecutor(max_workers=LLM_STREAMS, thread_name_prefix='llm-stream')
+
+def check_llm_yaml(text:str):   # Helper function rejecting an LLM answer that is not a diagram YAML, before it is cached
+    ''' The parsed answer. Raises ValueError if it is not YAML with a diagram.resources list.'''
+    try:
+        data = load_yaml(remove_code_block_markers(text))
+    except yaml.YAMLError as e:
+        raise ValueError(f"LLM returned invalid YAML: {e}")
+    diagram = data.get('diagram') if isinstance(data, dict) else None
+    if not isinstance(diagram, dict) or not isinstance(diagram.get('resources'), list):
+        raise ValueError("LLM returned YAML without a diagram.resources list")
+    return data
+
+def record_usage(current, usage, ttft:float = None):   # Helper function putting a gemini response's token counts (and time to first token of a stream) on its span, the counters and the log
+    if usage is None:
+        return
+    tokens = {'prompt_tokens': getattr(usage, 'prompt_token_count', 0) or 0,
+              'output_tokens': getattr(usage, 'candidates_token_count', 0) or 0}
+    current.set(**tokens)
+    for name, value in tokens.items():
+        count(f'llm.{name}', value)
+    timing = f", first token after {ttft * 1000:.0f} ms" if ttft is not None else ''
+    event(logging.INFO, f"Gemini used {tokens['prompt_tokens']} prompt tokens and "
+          f"{tokens['output_tokens']} output tokens{timing}", ttft_ms=None if ttft is None else round(ttft * 1000, 1), **tokens)
 
 class LLMInference:
     def __init__(self,api_key):
-        self.gemini_google_client = GoogleGeminiClientSingleton.initialise_gemini_client()
-        self.gemini_google_client_byok = GoogleGeminiClientSingleton.initialise_gemini_client_byok(api_key = api_key)
-        self.openai_client = OpenAIClientSingleton.get_gpt4o_openai_client()
-        self.llama_client = LlamaClientSingleton.get_llama_openai_client()
-
-    def run_inference_google(self,input_data:str, system_prompt:str):
-        ''' Use gemini 1.5 flash to run a chat completion. Working smoothly for both YAML creation and YAML icon match with 90% accuracy'''
-        prompt = system_prompt + input_data
-        response = self.gemini_google_client.generate_content(prompt)
-        def remove_code_block_markers(text):
-            # Remove the starting ```python
-            text = re.sub(r'^```yaml', '', text, flags=re.MULTILINE)
-            # Remove the ending ```
-            text = re.sub(r'```$', '', text, flags=re.MULTILINE)
-            # Strip leading and trailing whitespace
-            return text.strip()
-        cleaned_response = remove_code_block_markers(response.text)
-        return cleaned_response
+        # Clients are looked up in the provider registry on first use, so only the backend actually called is imported and initialised
+        self.api_key = api_key
+
+    @property
+    def gemini_google_client(self):
+        return GoogleGeminiClientSingleton.initialise_gemini_client()
+
+    @property
+    def gemini_google_client_byok(self):
+        return GoogleGeminiClientSingleton.initialise_gemini_client_byok(api_key = self.api_key)
+
+    @property
+    def openai_client(self):
+        return OpenAIClientSingleton.get_gpt4o_openai_client()
+
+    @property
+    def llama_client(self):
+        return LlamaClientSingleton.get_llama_openai_client()
+
+    def gemini_request(self, input_data:str, system_prompt:str, byok:bool = False):
+        ''' (model, contents) of a gemini call: the app's or the BYOK client, and the system prompt followed by the input.'''
+        return (self.gemini_google_client_byok if byok else self.gemini_google_client), system_prompt + input_data
+
+    def generate_google(self, input_data:str, system_prompt:str, byok:bool, refresh:bool = False, validate=check_llm_yaml):
+        ''' One gemini completion, answered from the LLM response cache (and coalesced while in flight) unless refresh is set.
+        An answer validate rejects is raised, not cached.'''
+        def generate():
+            model, contents = self.gemini_request(input_data, system_prompt, byok = byok)
+            with span('llm.generate', model=GEMINI_MODEL_NAME, byok=byok, prompt_chars=len(contents)) as current:
+                response = model.generate_content(contents)
+                current.set(response_chars=len(response.text))
+                record_usage(current, getattr(response, 'usage_metadata', None))
+            return remove_code_block_markers(response.text)
+        return LLMResponseCache.default().get_or_compute(GEMINI_MODEL_NAME, system_prompt, input_data, generate, refresh=refresh,
+                                                         validate=validate, api_key=self.api_key if byok else None)
+
+    def run_inference_google(self,input_data:str, system_prompt:str, refresh:bool = False):
+        ''' Use gemini 1.5 flash to run a chat completion. Working smoothly for both YAML creation and YAML icon match with 90% accuracy.
+        Identical requests are answered from the LLM response cache (and coalesced while in flight) unless refresh is set.'''
+        return self.generate_google(input_data, system_prompt, byok = False, refresh = refresh)
     
-    def run_inference_google_byok(self,input_data:str, system_prompt:str):
-        ''' Use gemini 1.5 flash to run a chat completion. Working smoothly for both YAML creation and YAML icon match with 90% accuracy'''
-        prompt = system_prompt + input_data
-        response = self.gemini_google_client_byok.generate_content(prompt)
-        def remove_code_block_markers(text):
-            # Remove the starting ```python
-            text = re.sub(r'^```yaml', '', text, flags=re.MULTILINE)
-            # Remove the ending ```
-            text = re.sub(r'```$', '', text, flags=re.MULTILINE)
-            # Strip leading and trailing whitespace
-            return text.strip()
-        cleaned_response = remove_code_block_markers(response.text)
-        return cleaned_response
+    def run_inference_google_byok(self,input_data:str, system_prompt:str, refresh:bool = False):
+        ''' Use gemini 1.5 flash to run a chat completion. Working smoothly for both YAML creation and YAML icon match with 90% accuracy.
+        Identical requests are answered from the LLM response cache (and coalesced while in flight) unless refresh is set.'''
+        return self.generate_google(input_data, system_prompt, byok = True, refresh = refresh)
+
+    async def stream_inference_google(self, input_data:str, system_prompt:str, byok:bool = False, refresh:bool = False,
+                                      validate=check_llm_yaml):
+        ''' Async generator over the raw text chunks of a streaming gemini completion (code fences included; the caller
+        cleans the joined text with remove_code_block_markers). A cached response, or the answer of an identical
+        request already streaming, is yielded as a single chunk; the cleaned full response is cached once the stream
+        ends and validate(response) has accepted it. An answer validate rejects raises its error here and in every
+        waiting request, and is not cached.
+        The SDK's async client is tied to the event loop that created it and to the process-global API key, so the
+        key-bound sync stream is drained on STREAM_EXECUTOR and handed to the event loop chunk by chunk.'''
+        cache = LLMResponseCache.default()
+        key = LLMResponseCache.key_for(GEMINI_MODEL_NAME, system_prompt, input_data, self.api_key if byok else None)
+        cached, in_flight, leader = cache.join(key, refresh)
+        if in_flight is None:
+            yield cached
+            return
+        if not leader:
+            # Same prompt already streaming for another session or rerun: wait for its answer instead of a second call
+            yield await asyncio.wrap_future(in_flight)
+            return
+
+        try:
+            parts = []
+            async for chunk in self._stream_google(input_data, system_prompt, byok):
+                parts.append(chunk)
+                yield chunk
+            text = remove_code_block_markers(''.join(parts))
+            if validate is not None:
+                validate(text)
+        except BaseException as e:
+            # Waiters get the error; a stream the caller abandoned (closed or cancelled) is reported to them as one
+            cache.finish(key, in_flight, error=e if isinstance(e, Exception) else RuntimeError("Gemini stream abandoned before it finished"))
+            raise
+        cache.finish(key, in_flight, text)
+
+    async def _stream_google(self, input_data:str, system_prompt:str, byok:bool):   # Helper function: the uncached gemini stream behind stream_inference_google
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        started = time.perf_counter()
+        # Set once the consumer stops listening (closed or cancelled), so the worker stops at the next chunk
+        abandoned = threading.Event()
+        def produce():
+            try:
+                # The first lookup of a client creates it (reading the secrets), so it runs here rather than on the event loop
+                model, contents = self.gemini_request(input_data, system_prompt, byok = byok)
+                loop.call_soon_threadsafe(queue.put_nowait, ('request', len(contents)))
+                usage = None
+                for chunk in model.generate_content(contents, stream=True):
+                    if abandoned.is_set():
+                        return
+                    # Every chunk carries the usage so far; the last one has the totals
+                    usage = getattr(chunk, 'usage_metadata', None) or usage
+                    loop.call_soon_threadsafe(queue.put_nowait, ('chunk', chunk.text))
+                loop.call_soon_threadsafe(queue.put_nowait, ('done', usage))
+            except BaseException as e:
+                if not abandoned.is_set():
+                    loop.call_soon_threadsafe(queue.put_nowait, ('error', e))
+        producer = loop.run_in_executor(STREAM_EXECUTOR, produce)
+
+        chunks = 0
+        characters = 0
+        ttft = None
+        with span('llm.stream', model=GEMINI_MODEL_NAME, byok=byok) as current:
+            try:
+                while True:
+                    kind, value = await queue.get()
+                    if kind == 'error':
+                        raise value
+                    if kind == 'request':
+                        current.set(prompt_chars=value)
+                        continue
+                    if kind == 'done':
+                        break
+                    if ttft is None:
+                        ttft = time.perf_counter() - started
+                        current.set(ttft_ms=round(ttft * 1000, 1))
+                    chunks += 1
+                    characters += len(value)
+                    yield value
+            except BaseException:
+                abandoned.set()
+                raise
+            await producer
+            current.set(chunks=chunks, response_chars=characters)
+            record_usage(current, value, ttft)
+
     def run_inference_llama(self, input_data:str, system_prompt:str):
         ''' Use Llama in huggingface for chat completion. Not working and not in development'''
         prompt = system_prompt + input_data
@@ -58,249 +205,309 @@ class LLMInference:
             messages = messages,
         )
         output = response.choices[0].message.content
-        def remove_code_block_markers(text):
-            # Remove the starting ```python
-            text = re.sub(r'^```yaml', '', text, flags=re.MULTILINE)
-            # Remove the ending ```
-            text = re.sub(r'```$', '', text, flags=re.MULTILINE)
-            # Strip leading and trailing whitespace
-            return text.strip()
         cleaned_response = remove_code_block_markers(output)
         return cleaned_response
     
 class YAMLTransformer:
 
     @staticmethod
-    def generate_yaml_from_prompt(input_data:str,system_prompt:str):
+    def generate_yaml_from_prompt(input_data:str,system_prompt:str, refresh:bool = False):
         api_key = "NULL"                                          # Generates YAML configuration from user provided input data. User answers 3 questions and provides a list of icons as multiselect
-        return LLMInference(api_key = api_key).run_inference_google(input_data = input_data, system_prompt = system_prompt)
+        return LLMInference(api_key = api_key).run_inference_google(input_data = input_data, system_prompt = system_prompt, refresh = refresh)
     @staticmethod
-    def transform_yaml_with_icons(input_yaml:str, cloud_icons:str, system_prompt:str):
+    def transform_yaml_with_icons(input_yaml:str, cloud_icons:str, system_prompt:str, refresh:bool = False):
         api_key = "NULL"   # Using user provided icon set (Through multiselect), gemini transforms yaml to replace placeholder paths with icon-references
         input_data = input_yaml + cloud_icons
-        return LLMInference(api_key = api_key).run_inference_google(input_data = input_data, system_prompt = system_prompt)
+        return LLMInference(api_key = api_key).run_inference_google(input_data = input_data, system_prompt = system_prompt, refresh = refresh)
     
     @staticmethod
-    def generate_yaml_from_prompt_byok(input_data:str,system_prompt:str, api_key:str):                                          # Generates YAML configuration from user provided input data. User answers 3 questions and provides a list of icons as multiselect
-        return LLMInference(api_key = api_key).run_inference_google_byok(input_data = input_data, system_prompt = system_prompt)
+    def generate_yaml_from_prompt_byok(input_data:str,system_prompt:str, api_key:str, refresh:bool = False):                                          # Generates YAML configuration from user provided input data. User answers 3 questions and provides a list of icons as multiselect
+        return LLMInference(api_key = api_key).run_inference_google_byok(input_data = input_data, system_prompt = system_prompt, refresh = refresh)
     @staticmethod
-    def transform_yaml_with_icons_byok(input_yaml:str, cloud_icons:str, system_prompt:str,api_key:str):   # Using user provided icon set (Through multiselect), gemini transforms yaml to replace placeholder paths with icon-references
+    def transform_yaml_with_icons_byok(input_yaml:str, cloud_icons:str, system_prompt:str,api_key:str, refresh:bool = False):   # Using user provided icon set (Through multiselect), gemini transforms yaml to replace placeholder paths with icon-references
         input_data = input_yaml + cloud_icons
-        return LLMInference(api_key = api_key).run_inference_google_byok(input_data = input_data, system_prompt = system_prompt)
+        return LLMInference(api_key = api_key).run_inference_google_byok(input_data = input_data, system_prompt = system_prompt, refresh = refresh)
+    @staticmethod
+    def transform_yaml_with_icons_local(input_yaml:str, cloud_icons:str, system_prompt:str, icon_descriptor_path,
+                                        allowed_icons=None, providers=None, threshold:float = ICON_MATCH_THRESHOLD,
+                                        api_key:str = "NULL", byok:bool = False, refresh:bool = False):   # Same output as transform_yaml_with_icons, but placeholder icons are matched locally; only resources the resolver is unsure about go to gemini
+        diagram = Diagram.from_yaml(input_yaml)
+        if not diagram.resources:
+            raise ValueError("YAML has no diagram.resources section")
+        unresolved = YAMLTransformer.resolve_icons_locally(diagram, IconResolver.load(icon_descriptor_path), allowed_icons,
+                                                           providers, threshold)
+        if unresolved:
+            inference = LLMInference(api_key = api_key)
+            run = inference.run_inference_google_byok if byok else inference.run_inference_google
+            llm_yaml = run(input_data = YAMLTransformer.unresolved_icons_yaml(unresolved) + cloud_icons,
+                           system_prompt = system_prompt, refresh = refresh)
+            YAMLTransformer.merge_llm_icons(unresolved, llm_yaml)
+        return diagram.to_yaml()
+    @staticmethod
+    def resolve_icons_locally(diagram:Diagram, icon_resolver, allowed_icons=None, providers=None, threshold:float = ICON_MATCH_THRESHOLD,
+                              known_icons:dict = None):
+        """
+        Replaces the placeholder icon of every resource the resolver matches with at least threshold confidence by
+        an icon key, scoring all resources in one batch. Returns the (dotted id path, resource) pairs left unresolved.
+        known_icons (see icon_memo_key) supplies icons resolved for the same resources before and records new matches.
+        """
+        entries = [(qualified_id, resource) for qualified_id, resource in diagram.iter_resources() if resource.icon is not None]
+        if known_icons is not None:
+            remaining = []
+            for qualified_id, resource in entries:
+                known = known_icons.get(YAMLTransformer.icon_memo_key(resource))
+                if known is None:
+                    remaining.append((qualified_id, resource))
+                else:
+                    resource.icon = known
+            count('icons.reused', len(entries) - len(remaining))
+            entries = remaining
+        with span('pipeline.resolve_icons_local', resources=len(entries)):
+            matches = icon_resolver.resolve([resource for _, resource in entries], allowed_icons, providers)
+        unresolved = []
+        for (qualified_id, resource), (icon_key, confidence) in zip(entries, matches):
+            if icon_key is not None and confidence >= threshold:
+                if known_icons is not None:
+                    known_icons[YAMLTransformer.icon_memo_key(resource)] = icon_key
+                resource.icon = icon_key
+            else:
+                unresolved.append((qualified_id, resource))
+        count('icons.resolved_locally', len(entries) - len(unresolved))
+        count('icons.sent_to_llm', len(unresolved))
+        event(logging.INFO, f"Icons resolved locally: {len(entries) - len(unresolved)}/{len(entries)}")
+        return unresolved
+    @staticmethod
+    def unresolved_icons_yaml(unresolved):   # Helper function building the reduced YAML sent to the icon LLM pass: only the unresolved resources, flattened, ids made unique
+        resources = [{'id': qualified_id, 'name': resource.name if resource.name is not None else '', 'type': resource.type or 'custom',
+                      'icon': resource.icon} for qualified_id, resource in unresolved]
+        return dump_yaml({'diagram': {'resources': resources}})
+    @staticmethod
+    def icon_memo_key(resource):   # Helper function: a resource as the icon passes see it, before its placeholder icon is replaced
+        return tuple('' if value is None else str(value) for value in (resource.name, resource.type, resource.icon))
+    @staticmethod
+    def merge_llm_icons(unresolved, llm_answer, known_icons:dict = None):   # Helper function copying the icons chosen by the LLM back onto the unresolved resources, by id. llm_answer is the YAML text or its already parsed data
+        data = load_yaml(remove_code_block_markers(llm_answer)) if isinstance(llm_answer, str) else llm_answer
+        try:
+            answer = Diagram.from_dict(data)
+        except ValueError:
+            event(logging.WARNING, "Icon LLM pass returned no diagram; keeping placeholders")
+            return
+        chosen = {qualified_id: resource.icon for qualified_id, resource in answer.iter_resources() if resource.icon is not None}
+        for qualified_id, resource in unresolved:
+            if qualified_id in chosen:
+                if known_icons is not None:
+                    known_icons[YAMLTransformer.icon_memo_key(resource)] = chosen[qualified_id]
+                resource.icon = chosen[qualified_id]
     @staticmethod
     def transform_yaml_with_icon_paths(yaml_string:str,icon_descriptor_path, exception_icon_path):   # Icon references are mapped to true icon paths (Icons are locally stored)
         """
-        Processes a YAML string by modifying its resources' icons based on direct regex matching.
-        If a resource's current icon value matches one of the regex patterns from the icon descriptor,
-        replace it with the corresponding icon path. If no regex matches, use the exception icon.
+        YAML in, YAML out form of resolve_icon_paths, for callers that hold YAML text. Stages that pass a Diagram
+        along should call resolve_icon_paths and skip the extra dump and parse.
+        """
+        try:
+            diagram = Diagram.from_yaml(yaml_string)
+        except yaml.error.YAMLError as e:
+            raise RuntimeError(f"ScannerError while processing YAML: {e}")
+        except Exception as e:
+            raise RuntimeError(f"An unexpected error occurred: {e}")
+        return YAMLTransformer.resolve_icon_paths(diagram, icon_descriptor_path, exception_icon_path).to_yaml()
+    @staticmethod
+    def resolve_icon_paths(diagram:Diagram, icon_descriptor_path, exception_icon_path):
+        """
+        Modifies the diagram's resources' icons in place and returns the diagram. An icon that is a descriptor key
+        is replaced with that key's path. Any other value is matched against the descriptor keys as regex patterns and
+        replaced with the path of the first match. If no regex matches, use the exception icon.
         """
 
         if not os.path.exists(icon_descriptor_path):
             raise FileNotFoundError(f"Icon descriptor file '{icon_descriptor_path}' not found.")
 
         try:
-            # Parse the YAML string
-            data = yaml.safe_load(yaml_string)
+            with span('pipeline.resolve_icon_paths', resources=len(diagram.resources)):
+                # Built once per process and shared by every call
+                icon_index = IconIndex.load(icon_descriptor_path)
 
-            with open(icon_descriptor_path, 'r') as file:
-                icon_descriptor = json.load(file)
-
-            # Process resources if they exist
-            if data and 'diagram' in data and 'resources' in data['diagram']:
-                YAMLTransformer.process_resources(data['diagram']['resources'], icon_descriptor, exception_icon_path)
-            else:
-                print("No 'diagram.resources' section found in YAML.")
+                if diagram.resources:
+                    YAMLTransformer.process_resources(diagram.resources, icon_index, exception_icon_path)
+                else:
+                    event(logging.WARNING, "No 'diagram.resources' section found in YAML.")
+                return diagram
 
-            return yaml.dump(data, sort_keys=False)
-
-        except yaml.error.YAMLError as e:
-            raise RuntimeError(f"ScannerError while processing YAML: {e}")
         except Exception as e:
             raise RuntimeError(f"An unexpected error occurred: {e}")
     @staticmethod    
-    def process_resources(resources, icon_descriptor, exception_icon_path):
-        base_dir = os.path.dirname(os.path.abspath(__file__))
+    def process_resources(resources, icon_index, exception_icon_path):
         """
-        Recursively process resources, updating their icons based on regex matches from the icon descriptor.
+        Recursively process resources, updating their icons to the descriptor path of their icon key, or of the
+        first regex match for a placeholder.
+        icon_index is an IconIndex; a raw descriptor dict is still accepted and indexed on the fly.
         """
+        if not isinstance(icon_index, IconIndex):
+            icon_index = IconIndex(icon_index)
         for resource in resources:
-            if 'icon' in resource:
-                current_icon = str(resource['icon'])
-                matched_icon = None
-
-                # Attempt regex matches against the icon descriptor keys
-                for pattern, icon_path in icon_descriptor.items():
-                    normalized_icon_path = re.sub(r"\\", "/", icon_path)
-                    if re.search(pattern, current_icon):
-                        matched_icon = os.path.abspath(os.path.join(base_dir, normalized_icon_path))
-                        break
+            if resource.icon is not None:
+                current_icon = str(resource.icon)
+
+                # The icon key itself when the resolver or the LLM chose one, else the first descriptor key (in file
+                # order) whose pattern matches the placeholder, same as a linear regex scan
+                matched_icon = icon_index.path_for(current_icon)
 
                 # If no match found, use exception icon
                 if not matched_icon:
                     matched_icon = exception_icon_path
+                    count('icons.exception_fallback')
 
-                resource['icon'] = matched_icon
+                resource.icon = matched_icon
 
             # If this resource has nested resources, process them too
-            if 'of' in resource and isinstance(resource['of'], list):
-                YAMLTransformer.process_resources(resource['of'], icon_descriptor, exception_icon_path)
-
-
-# Global dictionaries to store resources and relationships
-resources = {}
-relationships = []
+            if resource.of is not None:
+                YAMLTransformer.process_resources(resource.of, icon_index, exception_icon_path)
 
-def separate_relates(resources_list, relates_list):   # Helper function to generate the graphviz dot file.
-    cleaned_resources = []
-    for item in resources_list:
-        if 'relates' in item:
-            relates_list.append(item['relates'])
-        else:
-            if 'of' in item:
-                item['of'] = separate_relates(item['of'], relates_list)
-            cleaned_resources.append(item)
-    return cleaned_resources
-
-def process_resource(resource, parent_id, group=None):  # Helper function to generate graphviz dot file from YAML
-    resource_id = resource['id']
-    resource_type = resource['type']
-    label = resource['name']
-    resource_of = resource.get('of', [])
-
-    if resource_type == 'cluster':
-        # Create a Cluster context
-        with Cluster(label):
-            for sub_resource in resource_of:
-                process_resource(sub_resource, resource_id)
-    elif resource_type == 'group':
-        # Create a group (collect nodes into a list)
-        group_nodes = []
-        for sub_resource in resource_of:
-            process_resource(sub_resource, resource_id, group_nodes)
-        resources[resource_id] = group_nodes
-        if group is not None:
-            group.extend(group_nodes)
-    elif resource_type == 'custom':
-        # Create the custom node
-        icon_path = resource.get('icon')
-        if not icon_path:
-            raise ValueError(f"Custom node '{label}' must have an 'icon' path specified.")
-        node_instance = Custom(label=label, icon_path=icon_path)
-        resources[resource_id] = node_instance
-        if group is not None:
-            group.append(node_instance)
-    else:
-        raise ValueError(f"Unsupported resource type '{resource_type}' for resource '{label}'")
-
-def connect_nodes(from_node, edge, to_node, direction): # Helper function to generate graphviz dot file from YAML
-    if direction == 'outgoing':
-        from_node >> edge >> to_node
-    elif direction == 'incoming':
-        from_node << edge << to_node
-    elif direction == 'bidirectional':
-        from_node << edge >> to_node
-    else:
-        from_node - edge - to_node
-
-def generate_svg_from_yaml(yaml_content):   # Performs two tasks: Generates a dot file from the YAML, and uses graphviz internal SVG renderer to convert dot to SVG. The SVG generated from this references to icon svgs using local paths as xlink:href
-    # Parse YAML content
-    yaml_data = yaml.safe_load(yaml_content)
-
-    diagram_config = yaml_data['diagram']
-    diagram_name = diagram_config.get('name', '')
-    diagram_direction = diagram_config.get('direction', 'left-to-right')
-    diagram_style = diagram_config.get('style', {})
-    resources_list = diagram_config.get('resources', [])
-    if 'relates' not in yaml_data.get('diagram', {}):
-        relates_list = yaml_data.get('relates', [])
-    else:
-        relates_list = yaml_data['diagram']['relates']
-
-    # Separate 'relates' entries from 'resources' recursively
-    resources_list = separate_relates(resources_list, relates_list)
-
-    direction_map = {
-        'left-to-right': 'LR',
-        'right-to-left': 'RL',
-        'top-to-bottom': 'TB',
-        'bottom-to-top': 'BT'
-    }
-    diagram_direction = direction_map.get(diagram_direction, 'LR')
-
-    with Diagram(
-        name=diagram_name,
-        direction=diagram_direction,
-        outformat='dot',
-        show=False,
-        graph_attr=diagram_style.get('graph', {}),
-        node_attr=diagram_style.get('node', {}),
-        edge_attr=diagram_style.get('edge', {}),
-    ) as diagram:
-        global resources, relationships
-        resources = {}
-        relationships = []
-
-        for resource in resources_list:
-            process_resource(resource, 'diagram')
-
-        for relation in relates_list:
-            from_resource_id = relation['from']
-            to_resource_id = relation['to']
-            from_node = resources.get(from_resource_id)
-            to_node = resources.get(to_resource_id)
-            if from_node is None or to_node is None:
-                continue
 
-            edge = Edge(
-                label=relation.get('description', ''),
-                color=relation.get('color', ''),
-                style=relation.get('style', '')
-            )
-            direction = relation.get('direction', 'outgoing')
-
-            if isinstance(from_node, list) and isinstance(to_node, list):
-                for fn in from_node:
-                    for tn in to_node:
-                        connect_nodes(fn, edge, tn, direction)
-            elif isinstance(from_node, list):
-                for fn in from_node:
-                    connect_nodes(fn, edge, to_node, direction)
-            elif isinstance(to_node, list):
-                for tn in to_node:
-                    connect_nodes(from_node, edge, tn, direction)
-            else:
-                connect_nodes(from_node, edge, to_node, direction)
+def generate_svg_from_yaml(diagram, fan_out:str = None):   # Performs two tasks: Builds the graphviz dot source from the diagram (a Diagram, or YAML text parsed here) in memory, and uses graphviz internal SVG renderer to convert dot to SVG. The SVG generated from this references to icon svgs using local paths as xlink:href
+    diagram = Diagram.coerce(diagram)
 
-        dot_output = diagram.dot.source
+    with span('pipeline.build_dot') as current:
+        builder = DotBuilder(diagram, fan_out=fan_out)
+        dot_output = builder.build()
+        current.set(dot_bytes=len(dot_output))
+    return render_built(builder, dot_output)
 
+def render_dot(dot_output:str, renderer:GraphvizRenderer = None):   # Lays out DOT source on the shared, bounded pool of dot workers with per-job timeouts
     try:
-        result = run([ "dot", "-Tsvg"], input=dot_output, text=True, stdout=PIPE, stderr=PIPE, check=True)
-        print(result.stdout)
-        return result.stdout
+        return (renderer or GraphvizRenderer.default()).render(dot_output)
+    except RenderError:
+        raise
     except Exception as e:
-        raise RuntimeError(f"Error generating SVG: {e}")
-
-def remove_all_dot_files():
+        raise RenderError(f"Error generating SVG: {e}")
+
+def render_built(builder:DotBuilder, dot_output:str, renderer:GraphvizRenderer = None):   # Lays out a built diagram. Parts with no relation between them (DotBuilder.parts) go to separate dot workers at once and are packed into one SVG (packing.py); diagrams in one piece or under PACK_MIN_NODES nodes are one dot job
+    renderer = renderer or GraphvizRenderer.default()
+    parts = []
+    if renderer.max_workers > 1 and len(builder.node_ids) >= PACK_MIN_NODES:
+        parts = builder.parts(renderer.max_workers)
+    if not parts:
+        return render_dot(dot_output, renderer)
     try:
-        # Get all .dot files in the current working directory
-        dot_files = glob.glob("*.dot")
-        
-        if not dot_files:
-            print("No .dot files found in the current directory.")
-            return
-
-        # Iterate over all .dot files and delete them
-        deleted_files = []
-        for dot_file in dot_files:
-            os.remove(dot_file)
-            deleted_files.append(dot_file)
-        
-        # Print the list of deleted files
-        print(f"Deleted the following .dot files:")
-        for file in deleted_files:
-            print(f"- {file}")
+        with span('pipeline.layout_parts', parts=len(parts)):
+            # No waiting for slots: if the parts do not fit right now, one job is queued instead
+            svgs = renderer.render_many(parts, queue_timeout=0)
+        with span('pipeline.pack'):
+            return pack_svgs([STRAY_AMPERSAND.sub('&amp;', svg) for svg in svgs], builder.graph_attrs)
+    except RenderQueueFull:
+        # Not enough free workers for the parts right now: one job queues like any other render
+        count('render.pack_fallback')
+        return render_dot(dot_output, renderer)
+    except RenderError:
+        raise
     except Exception as e:
-        print(f"Error while deleting .dot files: {e}")
+        raise RenderError(f"Error generating SVG: {e}")
+
+def render_svg_from_yaml(diagram, use_symbols:bool = False, cache:RenderCache = None, fan_out:str = None):   # Full render of a resolved diagram (icon paths already mapped; a Diagram or YAML text) to the final, icon-inlined SVG, served from the render cache when the same diagram was rendered before
+    cache = cache or RenderCache.default()
+    with span('pipeline.render', use_symbols=use_symbols) as current:
+        diagram = Diagram.coerce(diagram)
+        key = RenderCache.key_for(diagram, use_symbols=use_symbols, fan_out=fan_out)
+        svg = cache.get(key)
+        current.set(cache_hit=svg is not None)
+        count('render_cache.hit' if svg is not None else 'render_cache.miss')
+        if svg is None:
+            local_svg = generate_svg_from_yaml(diagram, fan_out=fan_out)
+            svg = SVGTransformer.get_svg_code(local_svg, use_symbols=use_symbols)
+            cache.put(key, svg)
+    return svg
+
+SVG_NAMESPACE = '{http://www.w3.org/2000/svg}'
+XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+
+# Default of IconSVGCache's bundle arguments: look the process-wide bundle up on the call
+CURRENT_BUNDLE = object()
+
+class IconSVGCache:
+    ''' Process-wide LRU of prepared icon bodies. Icons come from the precompiled bundle (icon_bundle.py) when one is
+    built, keyed by path and bundle build; otherwise each icon file is read and parsed once, keyed by path and mtime.'''
+    _entries = OrderedDict()
+    _lock = threading.Lock()
+    maxsize = 512
+
+    class Entry:
+        __slots__ = ('width', 'height', 'view_box', 'markup')
+
+        def __init__(self, width, height, view_box, markup):
+            self.width = width          # viewBox (or width/height) dimensions, None if undeterminable
+            self.height = height
+            self.view_box = view_box    # The icon's viewBox attribute, None if it has none
+            self.markup = markup        # The icon children serialised once, in the host document's default namespace
+
+    @classmethod
+    def get(cls, icon_path:str, bundle = CURRENT_BUNDLE):
+        ''' Returns the cached Entry for icon_path, (re)loading it if it is new or changed. bundle is the IconBundle
+        (or None) a render looked up once for all its icons; by default it is looked up here.'''
+        if bundle is CURRENT_BUNDLE:
+            bundle = IconBundle.default()
+        if bundle is not None and icon_path in bundle:
+            key = (icon_path, bundle.build_id)
+            load = lambda: IconSVGCache._from_bundle(bundle, icon_path)
+        else:
+            key = (icon_path, os.stat(icon_path).st_mtime_ns)
+            load = lambda: IconSVGCache._load(icon_path)
+        with cls._lock:
+            entry = cls._entries.get(key)
+            if entry is not None:
+                cls._entries.move_to_end(key)
+                return entry
+        entry = load()
+        with cls._lock:
+            cls._entries[key] = entry
+            cls._entries.move_to_end(key)
+            while len(cls._entries) > cls.maxsize:
+                cls._entries.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def exists(icon_path:str, bundle = CURRENT_BUNDLE):
+        if bundle is CURRENT_BUNDLE:
+            bundle = IconBundle.default()
+        return (bundle is not None and icon_path in bundle) or os.path.exists(icon_path)
+
+    @staticmethod
+    def _from_bundle(bundle, icon_path:str):
+        icon = bundle.get(icon_path)
+        if icon is None:
+            # The bundle was closed after a rebuild while a render was still using it: read the new one, or the file
+            current = IconBundle.default()
+            icon = current.get(icon_path) if current is not None else None
+            if icon is None:
+                return IconSVGCache._load(icon_path)
+        return IconSVGCache.Entry(*icon)
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._entries.clear()
+
+    @staticmethod
+    def _load(icon_path, minify:bool = False):
+        # Minified (for the bundle): comments, whitespace-only text between elements and <metadata> are dropped
+        parser = etree.XMLParser(remove_comments=minify, remove_blank_text=minify)
+        icon_root = etree.parse(icon_path, parser).getroot()
+        try:
+            width, height = SVGTransformer.get_original_dimensions(icon_root)
+        except ValueError:
+            width, height = None, None
+
+        # Drop the svg namespace so the markup inherits it from the main document without redeclaring it
+        markup_root = etree.Element('g')
+        for child in icon_root:
+            if minify and child.tag == SVG_NAMESPACE + 'metadata':
+                continue
+            markup_root.append(copy.deepcopy(child))
+        for element in markup_root.iter(etree.Element):
+            if element.tag.startswith(SVG_NAMESPACE):
+                element.tag = element.tag[len(SVG_NAMESPACE):]
+        etree.cleanup_namespaces(markup_root)
+        markup = ''.join(etree.tostring(child, encoding='unicode') for child in markup_root)
+        return IconSVGCache.Entry(width, height, icon_root.get('viewBox'), markup)
 
 class SVGTransformer:
     @staticmethod    
@@ -343,107 +550,217 @@ class SVGTransformer:
         # If we reach here, we cannot determine original dimensions
         raise ValueError("Unable to determine original dimensions of the SVG icon.")
     @staticmethod
-    def get_svg_code(main_svg_code):  # The local svg code with xlink:href references is accessed by this function and the icon code is accessed. The icon svg code is transformed into the main svg chassis. The output svg has no references to local paths and uses pure svg code for the icons.
-        def sanitize_svg(svg_code):
-            svg_code = svg_code.replace('&', '&amp;')
-        # Parse the SVG as a string
-            parser = etree.XMLParser(remove_comments=False, recover=True)
-            root = etree.fromstring(svg_code.encode('utf-8'), parser)
-
-            # Iterate through all elements and escape attributes and text content
-            for element in root.iter():
-                # Escape all attribute values
-                for attr, value in element.attrib.items():
-                    if value:
-                        # Special handling for xlink:href to preserve & correctly
-                        if attr == '{http://www.w3.org/1999/xlink}href':
-                            # Ensure & is replaced properly in href
-                            value = value.replace('&', '&amp;')
-                        else:
-                            value = escape(value)
-                        element.set(attr, value)
-                
-                # Escape text content
-                if element.text:
-                    element.text = escape(element.text)
-
-                # Escape tail content (text after closing tag)
-                if element.tail:
-                    element.tail = escape(element.tail)
-            
-            # Serialize back to string
-            sanitized_svg = etree.tostring(root, xml_declaration=True, encoding='UTF-8').decode('utf-8')
-            return sanitized_svg
-        main_svg_code = sanitize_svg(main_svg_code)
-        parser = etree.XMLParser(remove_comments=False)
-        # Parse the SVG as bytes (to handle XML declarations)
-        root = etree.fromstring(main_svg_code.encode('utf-8'), parser)
-
-        # Define a namespace map
-        # svg namespace for the main SVG elements
-        # xlink namespace for the xlink attributes
-        nsmap = {
-            'svg': 'http://www.w3.org/2000/svg',
-            'xlink': 'http://www.w3.org/1999/xlink'
-        }
-
-        # Now we can query using these namespaces
-        # Notice the "svg:image" instead of just "image"
-        images = root.xpath('.//svg:image[@xlink:href]', namespaces=nsmap)
-
-        for img in images:
-            href = img.get('{http://www.w3.org/1999/xlink}href')
-            if not unescape(href) or not os.path.exists(unescape(href)):
-                print(href)
-                print(unescape(href))
-                print(f"Warning: Missing href in image element. Skipping...")
-                continue
-            # Extract transform parameters from the image
-            width_attr = img.get('width')
-            height_attr = img.get('height')
-            x_attr = img.get('x')
-            y_attr = img.get('y')
-
-            # Parse numeric values, default to 0 for x/y if missing
-            width = SVGTransformer.parse_dimension(width_attr) if width_attr else 0.0
-            height = SVGTransformer.parse_dimension(height_attr) if height_attr else 0.0
-            x = float(x_attr) if x_attr else 0.0
-            y = float(y_attr) if y_attr else 0.0
-
-            # Parse the referenced SVG
-            icon_tree = etree.parse(unescape(href), parser)
-            icon_root = icon_tree.getroot()
-
-            # Get original dimensions of the referenced icon
-            try:
-                original_w, original_h = SVGTransformer.get_original_dimensions(icon_root)
-            except ValueError:
-                # Handle the case where we cannot determine dimensions
-                # For safety, continue or raise
-                continue
+    def get_svg_code(main_svg_code, use_symbols:bool = False):  # The local svg code with xlink:href references is accessed by this function and the icon code is accessed. The icon svg code is transformed into the main svg chassis. The output svg has no references to local paths and uses pure svg code for the icons.
+        output = BytesIO()
+        with span('pipeline.inline_icons', svg_chars=len(main_svg_code), use_symbols=use_symbols) as current:
+            SVGTransformer.write_svg_code(main_svg_code, output, use_symbols=use_symbols)
+            current.set(output_bytes=output.tell())
+        return output.getvalue().decode('UTF-8')
 
-            # Compute scale
-            scaleX = width / original_w if original_w != 0 else 1
-            scaleY = height / original_h if original_h != 0 else 1
+    @staticmethod
+    def write_svg_code(main_svg_code, output, use_symbols:bool = False):
+        """
+        Single pass over the Graphviz SVG: stray '&' are escaped, the document is parsed once with a recovering
+        target parser, and every element is written to output as soon as it is seen, with <image> references
+        replaced by the icon content. output is a file path or a binary file-like object.
+        """
+        # Graphviz passes label text through as-is, so a bare '&' (not starting an entity) would break the parse
+        main_svg_code = STRAY_AMPERSAND.sub('&amp;', main_svg_code)
 
-            # Create a new <g> element to contain the inline SVG
-            g = etree.Element('g')
-            g.set('transform', f'translate({x},{y}) scale({scaleX},{scaleY})')
+        if isinstance(output, (str, os.PathLike)):
+            with open(output, 'wb') as file:
+                return SVGTransformer.write_svg_code(main_svg_code, file, use_symbols=use_symbols)
 
-            # Move all children of icon_root (except svg itself) into <g>
-            # We'll append the children directly; this removes them from icon_root in icon_tree
-            # If you need to preserve the original, clone them.
-            for child in list(icon_root):
-                icon_root.remove(child)
-                g.append(child)
+        target = SVGInlineTarget(output, use_symbols=use_symbols)
+        parser = etree.XMLParser(target=target, remove_comments=False, recover=True, huge_tree=True)
+        for offset in range(0, len(main_svg_code), SVGInlineTarget.CHUNK_SIZE):
+            parser.feed(main_svg_code[offset:offset + SVGInlineTarget.CHUNK_SIZE].encode('UTF-8'))
+        parser.close()
 
-            # Replace the image element with the new <g>
-            parent = img.getparent()
-            parent.replace(img, g)
-        result_bytes = etree.tostring(root, xml_declaration=True, encoding='UTF-8')
-        result_str = result_bytes.decode('UTF-8')
-        # Convert back to string
-        return result_str
+    @staticmethod
+    def preview_svg(svg_code:str, max_bytes:int = None):
+        """
+        Compact version of a rendered SVG for showing on the page. Diagrams up to max_bytes are returned as they are.
+        Larger ones are simplified: every icon symbol becomes a plain tile, and labels, tooltips and comments are
+        dropped, since they cannot be read at preview scale anyway. The layout, clusters and edges stay the same.
+        Meant for the use_symbols output, where each icon body is written only once.
+        """
+        max_bytes = PREVIEW_MAX_BYTES if max_bytes is None else max_bytes
+        if len(svg_code) <= max_bytes:
+            return svg_code
+        with span('pipeline.preview', svg_chars=len(svg_code)) as current:
+            parser = etree.XMLParser(remove_comments=True, huge_tree=True)
+            root = etree.fromstring(svg_code.encode('UTF-8'), parser)
+            for symbol in root.iter(SVG_NAMESPACE + 'symbol'):
+                view_box = (symbol.get('viewBox') or '').split()
+                x, y, width, height = view_box if len(view_box) == 4 else ('0', '0', '1', '1')
+                for child in list(symbol):
+                    symbol.remove(child)
+                etree.SubElement(symbol, SVG_NAMESPACE + 'rect', x=x, y=y, width=width, height=height,
+                                 rx=f'{float(width) * 0.15:g}', fill=PREVIEW_TILE_COLOR)
+            for element in list(root.iter(SVG_NAMESPACE + 'text', SVG_NAMESPACE + 'title')):
+                element.getparent().remove(element)
+            preview = etree.tostring(root, encoding='unicode')
+            current.set(preview_chars=len(preview))
+        return preview
+
+PREVIEW_MAX_BYTES = 512 * 1024      # Rendered SVGs above this are shown as a simplified preview (see preview_svg)
+PREVIEW_TILE_COLOR = '#D5DBE0'
+STRAY_AMPERSAND = re.compile(r'&(?!(?:[A-Za-z_][\w.-]*|#[0-9]+|#x[0-9A-Fa-f]+);)')
+
+class SVGInlineTarget:
+    ''' lxml parser target that re-serialises the Graphviz SVG while it is being parsed. Text and attributes are
+    escaped on the way out, and <image xlink:href="/local/icon.svg"> elements are swapped for the icon body, either
+    copied inline in a <g> or, with use_symbols, referenced through <use> with one <symbol> per icon in <defs>.'''
+    CHUNK_SIZE = 1 << 16
+    _ATTRIBUTE_ENTITIES = {'"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#9;'}
+
+    def __init__(self, output, use_symbols:bool = False):
+        self.output = output
+        self.use_symbols = use_symbols
+        self.depth = 0
+        self.skip_depth = 0             # > 0 while inside a replaced <image>
+        self.open_tag = False           # A start tag has been written without its closing '>'
+        self.prefixes = [{}]            # Stack of namespace uri -> prefix maps in scope
+        self.symbols = {}               # Icon path -> (symbol id, cache entry)
+        self.bundle = IconBundle.default()  # Checked once per render rather than for every <image>
+
+    def write(self, text):
+        self.output.write(text.encode('UTF-8'))
+
+    def close_open_tag(self):
+        if self.open_tag:
+            self.write('>')
+            self.open_tag = False
+
+    def qualify(self, name, prefixes, is_attribute=False):
+        if name[0] != '{':
+            return name
+        uri, local = name[1:].split('}', 1)
+        prefix = prefixes.get(uri)
+        if prefix is None or (is_attribute and prefix == ''):
+            # Not declared in this document (only happens with recovered input); keep it readable
+            return local
+        return f'{prefix}:{local}' if prefix else local
+
+    def quote(self, value):
+        return '"' + escape(value, self._ATTRIBUTE_ENTITIES) + '"'
+
+    def start(self, tag, attrib, nsmap):
+        if self.skip_depth:
+            self.skip_depth += 1
+            return
+        self.close_open_tag()
+        if self.depth == 0:
+            self.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+        self.depth += 1
+
+        prefixes = dict(self.prefixes[-1])
+        declarations = ''
+        for prefix, uri in nsmap.items():
+            prefixes[uri] = prefix or ''
+            declarations += f' xmlns:{prefix}={self.quote(uri)}' if prefix else f' xmlns={self.quote(uri)}'
+        self.prefixes.append(prefixes)
+
+        if tag == SVG_NAMESPACE + 'image' and self.replace_image(attrib, prefixes):
+            self.skip_depth = 1
+            return
 
+        attributes = ''.join(f' {self.qualify(name, prefixes, True)}={self.quote(value)}' for name, value in attrib.items())
+        self.write(f'<{self.qualify(tag, prefixes)}{declarations}{attributes}')
+        self.open_tag = True
 
+    def end(self, tag):
+        if self.skip_depth:
+            self.skip_depth -= 1
+            if self.skip_depth:
+                return
+        else:
+            if self.depth == 1 and self.symbols:
+                self.close_open_tag()
+                self.write_symbols()
+            if self.open_tag:
+                self.write('/>')
+                self.open_tag = False
+            else:
+                self.write(f'</{self.qualify(tag, self.prefixes[-1])}>')
+        self.prefixes.pop()
+        self.depth -= 1
 
+    def data(self, data):
+        if self.skip_depth or self.depth == 0:
+            return
+        self.close_open_tag()
+        self.write(escape(data))
+
+    def comment(self, text):
+        if self.skip_depth or self.depth == 0:
+            return
+        self.close_open_tag()
+        self.write(f'<!--{text}-->')
+
+    def pi(self, target, data=None):
+        if self.skip_depth or self.depth == 0:
+            return
+        self.close_open_tag()
+        self.write(f'<?{target} {data}?>' if data else f'<?{target}?>')
+
+    def close(self):
+        return None
+
+    def replace_image(self, attrib, prefixes):
+        ''' Writes the replacement for an <image> element. Returns False to keep the image as it is.'''
+        href = attrib.get(XLINK_HREF)
+        if not href or not IconSVGCache.exists(href, self.bundle):
+            count('icons.missing_href')
+            event(logging.WARNING, f"Missing href in image element, keeping the image: {href}")
+            return False
+
+        # Extract transform parameters from the image
+        width_attr = attrib.get('width')
+        height_attr = attrib.get('height')
+        x_attr = attrib.get('x')
+        y_attr = attrib.get('y')
+
+        # Parse numeric values, default to 0 for x/y if missing
+        width = SVGTransformer.parse_dimension(width_attr) if width_attr else 0.0
+        height = SVGTransformer.parse_dimension(height_attr) if height_attr else 0.0
+        x = float(x_attr) if x_attr else 0.0
+        y = float(y_attr) if y_attr else 0.0
+
+        # Icon dimensions and serialised body, from the bundle or parsed once, shared across images and calls
+        icon = IconSVGCache.get(href, self.bundle)
+
+        # Get original dimensions of the referenced icon
+        if icon.width is None:
+            # Handle the case where we cannot determine dimensions: leave the image reference in place
+            return False
+        original_w, original_h = icon.width, icon.height
+
+        # Compute scale
+        scaleX = width / original_w if original_w != 0 else 1
+        scaleY = height / original_h if original_h != 0 else 1
+        transform = self.quote(f'translate({x},{y}) scale({scaleX},{scaleY})')
+
+        if self.use_symbols:
+            if href not in self.symbols:
+                self.symbols[href] = (f'orchestree-icon-{len(self.symbols)}', icon)
+            symbol_id = self.symbols[href][0]
+            xlink = prefixes.get('http://www.w3.org/1999/xlink')
+            if xlink:
+                reference = f'{xlink}:href="#{symbol_id}"'
+            else:
+                reference = f'xmlns:xlink="http://www.w3.org/1999/xlink" xlink:href="#{symbol_id}"'
+            self.write(f'<use {reference} width="{original_w}" height="{original_h}" transform={transform}/>')
+        else:
+            self.write(f'<g transform={transform}>{icon.markup}</g>')
+        return True
+
+    def write_symbols(self):
+        # <use> may reference forward, so the definitions can go last and the stream never has to be rewound
+        self.write('<defs>')
+        for symbol_id, icon in self.symbols.values():
+            view_box = icon.view_box or f'0 0 {icon.width} {icon.height}'
+            # Inlined icons are not clipped either
+            self.write(f'<symbol id="{symbol_id}" viewBox={self.quote(view_box)} overflow="visible">{icon.markup}</symbol>')
+        self.write('</defs>')
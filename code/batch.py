@@ -0,0 +1,181 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dot_builder import FAN_OUT_MODES
+from icons import BASE_DIR
+
+# Usable as a library (render_batch) or from the command line:
+#   python batch.py "examples/source files" -o out/
+#   python batch.py diagrams.jsonl -o out/ --workers 8
+# Inputs are diagram YAMLs (icons given as icon_descriptor.json keys) or form-style JSON objects with the same fields
+# as the Streamlit form / default_prompt.json; form inputs go through the LLM passes first.
+
+ICON_DESCRIPTOR_PATH = os.path.join(BASE_DIR, 'icon_descriptor.json')
+EXCEPTION_ICON_PATH = os.path.join(BASE_DIR, 'blank-cloud-svgrepo-com.svg')
+FIRST_PASS_PATH = os.path.join(BASE_DIR, 'base_prompt.txt')
+SECOND_PASS_PATH = os.path.join(BASE_DIR, 'yaml_transformer.txt')
+
+YAML_SUFFIXES = ('.yaml', '.yml')
+
+class BatchItem:
+    __slots__ = ('name', 'kind', 'content')
+
+    def __init__(self, name:str, kind:str, content):
+        self.name = name            # Output file stem, unique within the batch
+        self.kind = kind            # 'yaml' (diagram YAML text) or 'form' (dict of form answers)
+        self.content = content
+
+def form_input(record:dict):
+    ''' Normalises a form-style record (app.py field names or default_prompt.json field names) to the input_data dict
+    app.py sends to the first LLM pass.'''
+    return {
+        "title": record.get("title", ""),
+        "cloud_providers": record.get("cloud_providers", record.get("cloudProviders", [])),
+        "relationships_description": record.get("relationships_description", record.get("relationships", "")),
+        "resources": record.get("resources", record.get("icons", [])),
+        "cluster_description": record.get("cluster_description", record.get("clusteringDetails", "")),
+    }
+
+def item_from_record(record, default_name:str):
+    ''' A JSONL line or JSON file: {"name": ..., "yaml": "..."} for a diagram, or form answers (with a "title").
+    Returns None for anything else.'''
+    if not isinstance(record, dict):
+        return None
+    name = str(record.get('name') or default_name)
+    if 'yaml' in record:
+        return BatchItem(name, 'yaml', record['yaml'])
+    if 'title' in record:
+        return BatchItem(name, 'form', form_input(record))
+    return None
+
+def collect_items(paths):
+    ''' Batch items from files, directories (*.yaml, *.yml, *.json, *.jsonl inside, not recursive) and JSONL files.'''
+    items = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, name) for name in os.listdir(path)
+                           if name.lower().endswith(YAML_SUFFIXES + ('.json', '.jsonl')))
+        else:
+            files = [path]
+        for file_path in files:
+            stem = os.path.splitext(os.path.basename(file_path))[0]
+            if file_path.lower().endswith(YAML_SUFFIXES):
+                with open(file_path, 'r', encoding='utf-8') as file:
+                    items.append(BatchItem(stem, 'yaml', file.read()))
+                continue
+            if file_path.lower().endswith('.jsonl'):
+                with open(file_path, 'r', encoding='utf-8') as file:
+                    records = [(json.loads(line), f'{stem}-{line_number}') for line_number, line in enumerate(file, 1) if line.strip()]
+            else:
+                with open(file_path, 'r', encoding='utf-8') as file:
+                    records = [(json.load(file), stem)]
+            for record, default_name in records:
+                item = item_from_record(record, default_name)
+                if item is None:
+                    print(f"Skipping {default_name}: neither a diagram nor form answers")
+                else:
+                    items.append(item)
+
+    # Output names must not collide
+    seen = {}
+    for item in items:
+        count = seen.get(item.name, 0)
+        seen[item.name] = count + 1
+        if count:
+            item.name = f'{item.name}-{count + 1}'
+    return items
+
+def init_worker(render_workers:int, render_timeout:float):
+    # Every worker process renders one diagram at a time, so one dot subprocess per process is enough
+    from rendering import GraphvizRenderer
+    GraphvizRenderer.configure(max_workers=render_workers, timeout=render_timeout)
+
+def resolve_form(form:dict):
+    ''' Form answers -> resolved diagram YAML: first LLM pass, local icon match (LLM only for doubtful icons).'''
+    from backend import YAMLTransformer
+    from prompts import form_prompt, icons_prompt
+    with open(FIRST_PASS_PATH, 'r') as file:
+        first_pass = file.read()
+    with open(SECOND_PASS_PATH, 'r') as file:
+        second_pass = file.read()
+    first_yaml = YAMLTransformer.generate_yaml_from_prompt(form_prompt(form), first_pass)
+    return YAMLTransformer.transform_yaml_with_icons_local(first_yaml, icons_prompt(form["resources"]), second_pass, ICON_DESCRIPTOR_PATH,
+                                                          allowed_icons=form["resources"], providers=form["cloud_providers"])
+
+def render_item(item:BatchItem, output_dir:str, use_symbols:bool = False, fan_out:str = None):
+    ''' Runs one item through the pipeline and writes <output_dir>/<name>.svg. Returns its status record; never raises.'''
+    from backend import YAMLTransformer, render_svg_from_yaml
+    from diagram import Diagram
+    started = time.perf_counter()
+    status = {'name': item.name, 'kind': item.kind}
+    try:
+        diagram = Diagram.from_yaml(resolve_form(item.content) if item.kind == 'form' else item.content)
+        YAMLTransformer.resolve_icon_paths(diagram, icon_descriptor_path=ICON_DESCRIPTOR_PATH, exception_icon_path=EXCEPTION_ICON_PATH)
+        svg = render_svg_from_yaml(diagram, use_symbols=use_symbols, fan_out=fan_out)
+        output_path = os.path.join(output_dir, f'{item.name}.svg')
+        with open(output_path, 'w', encoding='utf-8') as file:
+            file.write(svg)
+        resources = [resource for _, resource in diagram.iter_resources()]
+        status.update(status='ok', output=output_path, bytes=len(svg), title=diagram.name, resources=len(resources),
+                      exception_icons=sum(1 for resource in resources if resource.icon == EXCEPTION_ICON_PATH))
+    except Exception as e:
+        status.update(status='error', error=f'{type(e).__name__}: {e}')
+    status['seconds'] = round(time.perf_counter() - started, 3)
+    return status
+
+def render_batch(items, output_dir:str, workers:int = None, use_symbols:bool = False, render_timeout:float = 60.0, on_result=None,
+                 fan_out:str = None):
+    ''' Renders items across a process pool. Returns the status records in input order; on_result(status) is called
+    as each item finishes.'''
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    results = [None] * len(items)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(1, render_timeout)) as executor:
+        futures = {executor.submit(render_item, item, output_dir, use_symbols, fan_out): position for position, item in enumerate(items)}
+        for future in as_completed(futures):
+            position = futures[future]
+            try:
+                status = future.result()
+            except Exception as e:
+                # The worker process itself died
+                status = {'name': items[position].name, 'kind': items[position].kind, 'status': 'error', 'error': f'{type(e).__name__}: {e}'}
+            results[position] = status
+            if on_result is not None:
+                on_result(status)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render Orchestree diagrams without the Streamlit app.")
+    parser.add_argument('inputs', nargs='+', help="Diagram YAML files, JSON/JSONL files of diagrams or form answers, or directories of them")
+    parser.add_argument('-o', '--output', default='rendered', help="Directory for the SVGs and report.json")
+    parser.add_argument('-w', '--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--symbols', action='store_true', help="Reference repeated icons through <symbol>/<use> instead of inlining every copy")
+    parser.add_argument('--timeout', type=float, default=60.0, help="Seconds a single dot render may take")
+    parser.add_argument('--fan-out', choices=FAN_OUT_MODES, default=None,
+                        help="How group-to-group relations are drawn (default: the diagram's fan_out setting, else every edge)")
+    args = parser.parse_args(argv)
+
+    items = collect_items(args.inputs)
+    if not items:
+        print("No inputs found.")
+        return 1
+    started = time.perf_counter()
+    def report(status):
+        if status['status'] == 'ok':
+            print(f"ok     {status['name']} ({status['seconds']}s, {status['exception_icons']} fallback icons)")
+        else:
+            print(f"error  {status['name']}: {status['error']}")
+    results = render_batch(items, args.output, workers=args.workers, use_symbols=args.symbols, render_timeout=args.timeout,
+                           on_result=report, fan_out=args.fan_out)
+    failed = sum(1 for status in results if status['status'] != 'ok')
+    with open(os.path.join(args.output, 'report.json'), 'w', encoding='utf-8') as file:
+        json.dump({'items': results, 'failed': failed, 'seconds': round(time.perf_counter() - started, 3)}, file, indent=2)
+    print(f"{len(results) - failed}/{len(results)} rendered in {time.perf_counter() - started:.1f}s, report: {os.path.join(args.output, 'report.json')}")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,280 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import sys
+import time
+
+import yaml
+
+from backend import LLMInference, SVGTransformer, IconSVGCache, YAMLTransformer, STRAY_AMPERSAND, render_built
+from batch import EXCEPTION_ICON_PATH, ICON_DESCRIPTOR_PATH
+from cache import LLMResponseCache
+from diagram import Diagram
+from dot_builder import DotBuilder, FAN_OUT_MODES
+from icons import BASE_DIR
+from rendering import GraphvizRenderer
+from singletons import GEMINI_MODEL_NAME
+from streaming import stream_resolved_diagram
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+# Offline benchmark of the YAML -> SVG pipeline, stage by stage:
+#   python benchmark.py                                   examples + synthetic 10..5000 nodes
+#   python benchmark.py --sizes 100,1000 --repeat 10 --json bench.json
+#   python benchmark.py --prompt                          also replay recorded LLM answers through stream_resolved_diagram
+#   python benchmark.py --systems 4 --dot-workers 4       unrelated systems laid out in parallel and packed
+# Stages: parse (Diagram.from_yaml), resolve (resolve_icon_paths), dot_build (DotBuilder), dot (the dot
+# subprocesses, plus packing when parts are laid out in parallel), sanitize (stray '&' escaping), inline (SVGTransformer.get_svg_code on the sanitized SVG).
+
+EXAMPLES_DIR = os.path.join(BASE_DIR, 'examples', 'source files')
+DEFAULT_SIZES = (10, 100, 500, 1000, 5000)
+STAGES = ('parse', 'resolve', 'dot_build', 'dot', 'sanitize', 'inline')
+
+def synthetic_diagram(nodes:int, depth:int = 3, fanout:int = 8, icon_reuse:float = 0.8, seed:int = 0, systems:int = 1):
+    ''' Diagram YAML with `nodes` icon nodes spread over clusters nested `depth` deep, `fanout` children per cluster,
+    a group per cluster for fan-out relations (node to group, and group to group), and icon keys drawn from a pool sized so that a fraction icon_reuse of
+    the nodes repeat an icon already used. With systems > 1 the nodes are split over that many top-level clusters
+    with no relation between them.'''
+    rng = random.Random(seed)
+    with open(ICON_DESCRIPTOR_PATH, 'r') as file:
+        icon_keys = [key for key in json.load(file) if key.startswith('aws.architecture')]
+    pool = rng.sample(icon_keys, min(len(icon_keys), max(1, round(nodes * (1 - icon_reuse)))))
+
+    node_ids = []
+    group_ids = []
+    counter = [0]
+    def make_nodes(count, prefix):
+        made = []
+        for _ in range(count):
+            counter[0] += 1
+            node_id = f'{prefix}n{counter[0]}'
+            node_ids.append(node_id)
+            made.append({'id': node_id, 'name': f'Service {counter[0]}', 'type': 'custom', 'icon': rng.choice(pool)})
+        return made
+    def make_cluster(remaining, level, prefix):
+        # Spend the node budget over fanout children; the deepest level holds the nodes themselves
+        if level == depth or remaining <= fanout:
+            members = make_nodes(remaining, prefix)
+            if len(members) > 1:
+                group_id = f'{prefix}group'
+                group_ids.append(group_id)
+                return [{'id': group_id, 'name': 'Workers', 'type': 'group', 'of': members}]
+            return members
+        children = []
+        shares = [remaining // fanout + (1 if index < remaining % fanout else 0) for index in range(fanout)]
+        for index, share in enumerate(shares):
+            if share:
+                cluster_id = f'{prefix}c{index}'
+                children.append({'id': cluster_id, 'name': f'Cluster {cluster_id}', 'type': 'cluster',
+                                 'of': make_cluster(share, level + 1, cluster_id + '.')})
+        return children
+
+    def relate():
+        for position, node_id in enumerate(node_ids[1:], 1):
+            relates.append({'from': node_ids[rng.randrange(position)], 'to': node_id, 'direction': 'outgoing'})
+        for group_id in group_ids[:max(1, len(group_ids) // 4)]:
+            relates.append({'from': rng.choice(node_ids), 'to': group_id, 'direction': 'outgoing', 'description': 'fan-out'})
+        for from_group, to_group in list(zip(group_ids[::2], group_ids[1::2]))[:max(1, len(group_ids) // 8)]:
+            relates.append({'from': from_group, 'to': to_group, 'direction': 'outgoing', 'description': 'group fan-out'})
+
+    relates = []
+    if systems <= 1:
+        resources = make_cluster(nodes, 0, '')
+        relate()
+    else:
+        resources = []
+        for system in range(systems):
+            # Relations stay inside their own system
+            node_ids.clear()
+            group_ids.clear()
+            share = nodes // systems + (1 if system < nodes % systems else 0)
+            system_id = f's{system}'
+            resources.append({'id': system_id, 'name': f'System {system}', 'type': 'cluster',
+                              'of': make_cluster(share, 1, system_id + '.')})
+            relate()
+    data = {'diagram': {'name': f'Synthetic {nodes} nodes', 'direction': 'left-to-right', 'resources': resources, 'relates': relates}}
+    return yaml.dump(data, sort_keys=False)
+
+def example_diagrams():
+    ''' (name, YAML) of every example diagram that parses and builds.'''
+    examples = []
+    for name in sorted(os.listdir(EXAMPLES_DIR)):
+        if not name.endswith('.yaml'):
+            continue
+        with open(os.path.join(EXAMPLES_DIR, name), 'r', encoding='utf-8') as file:
+            content = file.read()
+        try:
+            DotBuilder(Diagram.from_yaml(content)).build()
+        except Exception as e:
+            print(f"Skipping example {name}: {type(e).__name__}: {e}")
+            continue
+        examples.append((os.path.splitext(name)[0], content))
+    return examples
+
+def run_pipeline(diagram_yaml:str, renderer, cold:bool = False, fan_out:str = None):
+    ''' One pass through every stage. Returns ({stage: seconds}, node count, edge count, output size).'''
+    if cold:
+        IconSVGCache.clear()
+    timings = {}
+    started = time.perf_counter()
+    diagram = Diagram.from_yaml(diagram_yaml)
+    timings['parse'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    YAMLTransformer.resolve_icon_paths(diagram, icon_descriptor_path=ICON_DESCRIPTOR_PATH, exception_icon_path=EXCEPTION_ICON_PATH)
+    timings['resolve'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    builder = DotBuilder(diagram, fan_out=fan_out)
+    dot_source = builder.build()
+    timings['dot_build'] = time.perf_counter() - started
+    nodes = dot_source.count(' image=')
+    edges = dot_source.count(' -> ')
+
+    if renderer is None:
+        return timings, nodes, edges, None
+
+    started = time.perf_counter()
+    local_svg = render_built(builder, dot_source, renderer)
+    timings['dot'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    sanitized = STRAY_AMPERSAND.sub('&amp;', local_svg)
+    timings['sanitize'] = time.perf_counter() - started
+
+    # get_svg_code escapes again; on already sanitized input that is a scan without replacements
+    started = time.perf_counter()
+    svg = SVGTransformer.get_svg_code(sanitized)
+    timings['inline'] = time.perf_counter() - started
+    return timings, nodes, edges, len(svg)
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))]
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is KiB on Linux, bytes on macOS; it only ever grows, so scenarios run smallest first
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(own / scale, 1), round(children / scale, 1)
+
+def benchmark(name:str, diagram_yaml:str, renderer, repeat:int, cold:bool, warmup:int = 1, fan_out:str = None):
+    # Untimed runs first, so one-off costs (loading the icon index, first imports) do not land in p99
+    for _ in range(warmup):
+        run_pipeline(diagram_yaml, renderer, cold=cold, fan_out=fan_out)
+    runs = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        runs.append(run_pipeline(diagram_yaml, renderer, cold=cold, fan_out=fan_out))
+    elapsed = time.perf_counter() - started
+    _, nodes, edges, size = runs[-1]
+    totals = [sum(timings.values()) for timings, _, _, _ in runs]
+    result = {'name': name, 'nodes': nodes, 'edges': edges, 'svg_bytes': size, 'repeat': repeat,
+              'total_p50_ms': round(percentile(totals, 0.5) * 1000, 2), 'total_p99_ms': round(percentile(totals, 0.99) * 1000, 2),
+              'diagrams_per_s': round(repeat / elapsed, 2), 'nodes_per_s': round(repeat * nodes / elapsed, 1), 'stages': {}}
+    for stage in STAGES:
+        values = [timings[stage] for timings, _, _, _ in runs if stage in timings]
+        if values:
+            result['stages'][stage] = {'p50_ms': round(percentile(values, 0.5) * 1000, 2),
+                                       'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+                                       'mean_ms': round(statistics.fmean(values) * 1000, 2)}
+    rss = peak_rss_mb()
+    if rss is not None:
+        result['peak_rss_mb'], result['peak_child_rss_mb'] = rss
+    return result
+
+def replay_llm():
+    ''' Replaces the gemini stream with recorded answers, so no network is used. Recordings are stored in the LLM
+    response cache, which answers them as it does in the app; any other request is answered by echoing its input.'''
+    async def replay(self, input_data:str, system_prompt:str, byok:bool = False):
+        yield input_data
+    LLMInference._stream_google = replay
+
+def benchmark_prompt(name:str, diagram_yaml:str, repeat:int):
+    ''' The LLM stage of the app (stream_resolved_diagram) against a recorded first-pass answer: the example diagram with
+    its icons turned back into placeholders, as the first pass writes them.'''
+    first_pass = 'benchmark first pass'
+    input_data = f'benchmark input {name}'
+    recorded = re.sub(r'(?m)^(\s*icon:\s*)(\S.*)$', lambda match: f'{match.group(1)}/path/to/{name}-icon.svg', diagram_yaml)
+    LLMResponseCache.default().store_response(LLMResponseCache.key_for(GEMINI_MODEL_NAME, first_pass, input_data), recorded)
+    values = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        asyncio.run(stream_resolved_diagram(input_data, first_pass, 'benchmark icon pass', '', ICON_DESCRIPTOR_PATH,
+                                         EXCEPTION_ICON_PATH, providers=['AWS', 'Azure']))
+        values.append(time.perf_counter() - started)
+    return {'name': f'prompt:{name}', 'repeat': repeat, 'p50_ms': round(percentile(values, 0.5) * 1000, 2),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 2)}
+
+def print_result(result):
+    stages = '  '.join(f"{stage} {timing['p50_ms']:.1f}/{timing['p99_ms']:.1f}" for stage, timing in result['stages'].items())
+    rss = f"  rss {result['peak_rss_mb']} MB (dot {result['peak_child_rss_mb']} MB)" if 'peak_rss_mb' in result else ''
+    print(f"{result['name']:<32} {result['nodes']:>5} nodes {result['edges']:>5} edges  total p50 {result['total_p50_ms']:.1f} ms "
+          f"p99 {result['total_p99_ms']:.1f} ms  {result['diagrams_per_s']} diagrams/s  {result['nodes_per_s']} nodes/s{rss}")
+    print(f"{'':<32} p50/p99 ms: {stages}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Orchestree YAML -> SVG pipeline offline.")
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES), help="Synthetic diagram sizes (icon nodes)")
+    parser.add_argument('--depth', type=int, default=3, help="Cluster nesting depth of synthetic diagrams")
+    parser.add_argument('--fanout', type=int, default=8, help="Children per cluster in synthetic diagrams")
+    parser.add_argument('--reuse', type=float, default=0.8, help="Fraction of synthetic nodes that repeat an icon")
+    parser.add_argument('--systems', type=int, default=1, help="Unrelated top-level systems per synthetic diagram")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per scenario")
+    parser.add_argument('--warmup', type=int, default=1, help="Untimed runs before each scenario")
+    parser.add_argument('--cold', action='store_true', help="Clear the icon cache before every run")
+    parser.add_argument('--no-examples', action='store_true', help="Skip the example diagrams")
+    parser.add_argument('--prompt', action='store_true', help="Also time stream_resolved_diagram with recorded LLM answers")
+    parser.add_argument('--fan-out', choices=FAN_OUT_MODES, default=None, help="How group-to-group relations are drawn")
+    parser.add_argument('--dot', default='dot', help="dot binary")
+    parser.add_argument('--dot-workers', type=int, default=1,
+                        help="Concurrent dot jobs; above 1, unrelated parts of a diagram are laid out in parallel and packed")
+    parser.add_argument('--json', help="Write the results to this file")
+    args = parser.parse_args(argv)
+
+    renderer = None
+    if shutil.which(args.dot):
+        renderer = GraphvizRenderer(max_workers=args.dot_workers, timeout=600, dot_binary=args.dot)
+    else:
+        print(f"'{args.dot}' not found: timing resolve, parse and dot_build only")
+
+    examples = example_diagrams() if not args.no_examples or args.prompt else []
+    scenarios = [] if args.no_examples else [(f'example:{name}', content) for name, content in examples]
+    for size in sorted(int(size) for size in args.sizes.split(',') if size.strip()):
+        scenarios.append((f'synthetic:{size}', synthetic_diagram(size, depth=args.depth, fanout=args.fanout, icon_reuse=args.reuse,
+                                                                     systems=args.systems)))
+
+    results = []
+    for name, content in scenarios:
+        result = benchmark(name, content, renderer, args.repeat, args.cold, args.warmup, fan_out=args.fan_out)
+        print_result(result)
+        results.append(result)
+
+    prompt_results = []
+    if args.prompt:
+        replay_llm()
+        for name, content in examples:
+            prompt_result = benchmark_prompt(name, content, args.repeat)
+            print(f"{prompt_result['name']:<32} stream_resolved_diagram p50 {prompt_result['p50_ms']} ms p99 {prompt_result['p99_ms']} ms")
+            prompt_results.append(prompt_result)
+
+    if renderer is not None:
+        renderer.shutdown()
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'settings': vars(args), 'results': results, 'prompt_results': prompt_results}, file, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,336 @@
+import hashlib
+import json
+import os
+import tempfile
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from diagram import Diagram
+from instrumentation import count
+
+class LRUCache:
+    ''' Thread-safe LRU bounded by entry count and, optionally, by the total size of its values and by age (ttl seconds).'''
+
+    def __init__(self, max_entries:int = 256, max_bytes:int = None, sizeof=len, ttl:float = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.ttl = ttl
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._expiry = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            if self.ttl is not None and self._expiry[key] < time.monotonic():
+                self.total_bytes -= self._entries.pop(key)[1]
+                del self._expiry[key]
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        size = self.sizeof(value) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            # Would evict everything else and still not fit
+            return
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            if self.ttl is not None:
+                self._expiry[key] = time.monotonic() + self.ttl
+            self.total_bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes and self.total_bytes > self.max_bytes):
+                evicted_key, (_, evicted_size) = self._entries.popitem(last=False)
+                self._expiry.pop(evicted_key, None)
+                self.total_bytes -= evicted_size
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value, size = self._entries.pop(key)
+            self._expiry.pop(key, None)
+            self.total_bytes -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._expiry.clear()
+            self.total_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+class DiskStore:
+    ''' Directory of text files named by key, evicting least recently used files once max_bytes is exceeded.'''
+
+    def __init__(self, directory:str, max_bytes:int = 512 * 1024 * 1024, suffix:str = '.svg'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key:str) -> str:
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key:str):
+        path = self.path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                value = file.read()
+        except FileNotFoundError:
+            return None
+        # mtime doubles as the recency stamp used for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key:str, value:str):
+        # Write to a temp file first so readers never see a partial entry
+        descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as file:
+            file.write(value)
+        os.replace(temp_path, self.path(key))
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(self.suffix):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            for _, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+    def clear(self):
+        with self._lock:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(self.suffix):
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+class RenderCache:
+    ''' Two-level cache of final, icon-inlined SVGs keyed by a canonical hash of the resolved diagram
+    (the output of resolve_icon_paths) plus the render options. Memory first, then the optional
+    on-disk store; disk hits are promoted to memory.'''
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_memory_bytes:int = 64 * 1024 * 1024, max_entries:int = 256, disk_dir:str = None,
+                 max_disk_bytes:int = 512 * 1024 * 1024):
+        self.memory = LRUCache(max_entries=max_entries, max_bytes=max_memory_bytes)
+        self.disk = DiskStore(disk_dir, max_bytes=max_disk_bytes) if disk_dir else None
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def default(cls):
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def configure(cls, **kwargs):
+        ''' Replaces the process-wide cache, e.g. to add a disk store.'''
+        with cls._instance_lock:
+            cls._instance = cls(**kwargs)
+        return cls._instance
+
+    @staticmethod
+    def key_for(diagram, **options) -> str:
+        ''' Canonical hash of a Diagram (or its YAML): key order, formatting and comments in the YAML do not change the key.'''
+        data = Diagram.coerce(diagram).to_dict()
+        canonical = json.dumps({'diagram': data, 'options': options}, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get(self, key:str):
+        svg = self.memory.get(key)
+        if svg is None and self.disk is not None:
+            svg = self.disk.get(key)
+            if svg is not None:
+                self.memory.put(key, svg)
+        if svg is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return svg
+
+    def put(self, key:str, svg:str):
+        self.memory.put(key, svg)
+        if self.disk is not None:
+            self.disk.put(key, svg)
+
+    def clear(self):
+        ''' Empties both levels.'''
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+class SQLiteStore:
+    ''' Persistent key/value table with per-entry age limit, shared by all threads of the process.'''
+
+    def __init__(self, path:str, ttl:float = None, max_entries:int = 10000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)")
+
+    def get(self, key:str):
+        with self._lock:
+            row = self._connection.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, created = row
+        if self.ttl is not None and created + self.ttl < time.time():
+            return None
+        return value
+
+    def put(self, key:str, value:str):
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO entries (key, value, created) VALUES (?, ?, ?)", (key, value, time.time()))
+            if self.ttl is not None:
+                self._connection.execute("DELETE FROM entries WHERE created < ?", (time.time() - self.ttl,))
+            self._connection.execute("DELETE FROM entries WHERE key NOT IN (SELECT key FROM entries ORDER BY created DESC LIMIT ?)", (self.max_entries,))
+
+class LLMResponseCache:
+    ''' Cache of cleaned LLM responses keyed on model name, system prompt hash, input hash and BYOK key hash. Memory LRU with TTL,
+    optional SQLite store, and single-flight: concurrent identical requests wait for the one call already in flight.'''
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_entries:int = 512, ttl:float = 24 * 60 * 60, sqlite_path:str = None):
+        self.memory = LRUCache(max_entries=max_entries, ttl=ttl)
+        self.store = SQLiteStore(sqlite_path, ttl=ttl) if sqlite_path else None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def default(cls):
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def configure(cls, **kwargs):
+        with cls._instance_lock:
+            cls._instance = cls(**kwargs)
+        return cls._instance
+
+    @staticmethod
+    def key_for(model_name:str, system_prompt:str, input_data:str, api_key:str = None) -> str:
+        ''' api_key is the BYOK key the call is made with (None for the app's own key), so answers are never shared
+        between the app's key and a user's own, nor between users' keys.'''
+        system_hash = hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()
+        input_hash = hashlib.sha256(input_data.encode('utf-8')).hexdigest()
+        key_hash = hashlib.sha256(api_key.encode('utf-8')).hexdigest() if api_key else ''
+        return hashlib.sha256(f'{model_name}\0{system_hash}\0{input_hash}\0{key_hash}'.encode('utf-8')).hexdigest()
+
+    def lookup(self, key:str):
+        value = self.memory.get(key)
+        if value is None and self.store is not None:
+            value = self.store.get(key)
+            if value is not None:
+                self.memory.put(key, value)
+        return value
+
+    def store_response(self, key:str, value:str):
+        self.memory.put(key, value)
+        if self.store is not None:
+            self.store.put(key, value)
+
+    def join(self, key:str, refresh:bool = False):
+        ''' Registers a caller about to ask the LLM for key. Returns (value, None, False) on a cache hit, (None, future,
+        False) while the same request is already in flight (its result is the answer), or (None, future, True) when
+        this caller is the one to make the call and must pass the outcome to finish(). With refresh the cache is
+        not read, but a call already in flight is still shared.'''
+        if not refresh:
+            value = self.lookup(key)
+            if value is not None:
+                with self._lock:
+                    self.hits += 1
+                count('llm_cache.hit')
+                return value, None, False
+
+        with self._lock:
+            in_flight = self._in_flight.get(key)
+            leader = in_flight is None
+            if leader:
+                in_flight = Future()
+                self._in_flight[key] = in_flight
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        count('llm_cache.miss' if leader else 'llm_cache.coalesced')
+        return None, in_flight, leader
+
+    def finish(self, key:str, in_flight:Future, value:str = None, error:BaseException = None):
+        ''' Completes the call join() made this caller the leader of: caches value, or hands error to the waiters.'''
+        # Stored before the call stops being in flight, so no caller in between misses both and calls again
+        if error is None:
+            self.store_response(key, value)
+        with self._lock:
+            self._in_flight.pop(key, None)
+        if error is not None:
+            in_flight.set_exception(error)
+        else:
+            in_flight.set_result(value)
+
+    def get_or_compute(self, model_name:str, system_prompt:str, input_data:str, compute, refresh:bool = False, validate=None,
+                       api_key:str = None):
+        ''' Returns the cached response, or calls compute() once and caches its result. With refresh the cache is
+        not read (a fresh answer is wanted, e.g. Regenerate) but the new answer still replaces the cached one.
+        validate(value), if given, raises for an answer that must not be cached; the error then goes to every caller.
+        api_key: see key_for.'''
+        key = LLMResponseCache.key_for(model_name, system_prompt, input_data, api_key)
+        value, in_flight, leader = self.join(key, refresh)
+        if in_flight is None:
+            return value
+        if not leader:
+            return in_flight.result()
+        try:
+            value = compute()
+            if validate is not None:
+                validate(value)
+        except BaseException as e:
+            self.finish(key, in_flight, error=e)
+            raise
+        self.finish(key, in_flight, value)
+        return value
@@ -0,0 +1,163 @@
+import yaml
+
+from instrumentation import span
+
+# In-memory form of a diagram, passed between the pipeline stages instead of YAML text. YAML is parsed once where it
+# enters (an LLM answer, a request body, a file), with libyaml's C loader when PyYAML was built with it, and written
+# out again only when text is asked for (the /yaml endpoint, the second LLM pass, a download).
+#
+#   diagram = Diagram.from_yaml(llm_answer)
+#   YAMLTransformer.resolve_icon_paths(diagram, icon_descriptor_path, exception_icon_path)
+#   svg = render_svg_from_yaml(diagram)
+#   text = diagram.to_yaml()
+#
+# Keys the model does not know are kept in `extra` and written back out, so a round trip loses nothing but comments.
+
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+SafeDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+def load_yaml(text:str):
+    return yaml.load(text, Loader=SafeLoader)
+
+def dump_yaml(data) -> str:
+    return yaml.dump(data, Dumper=SafeDumper, sort_keys=False)
+
+class Resource:
+    ''' One entry of diagram.resources: a 'custom' node drawn with its icon, a 'cluster' drawn as a box around its
+    members, or a 'group' that only names its members for fan-out relations. Absent keys are None.'''
+    __slots__ = ('id', 'name', 'type', 'icon', 'of', 'extra')
+    KEYS = ('id', 'name', 'type', 'icon', 'of')
+
+    def __init__(self, id=None, name=None, type=None, icon=None, of=None, extra=None):
+        self.id = id
+        self.name = name
+        self.type = type
+        self.icon = icon
+        self.of = of                # Member resources of a cluster or group, None for a node
+        self.extra = extra or {}
+
+    @classmethod
+    def list_from(cls, items, relates:list):
+        ''' Resources of a YAML list. Relations written among the resources ({'relates': ...} items, at any depth)
+        are appended to relates instead, as DotBuilder always drew them.'''
+        resources = []
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            if 'relates' in item:
+                nested = item['relates']
+                relates.extend(Relation.from_dict(relation) for relation in (nested if isinstance(nested, list) else [nested])
+                               if isinstance(relation, dict))
+                continue
+            of = item.get('of')
+            resources.append(cls(item.get('id'), item.get('name'), item.get('type'), item.get('icon'),
+                                 cls.list_from(of, relates) if isinstance(of, list) else None,
+                                 {key: value for key, value in item.items() if key not in cls.KEYS}))
+        return resources
+
+    def to_dict(self) -> dict:
+        data = {key: getattr(self, key) for key in ('id', 'name', 'type', 'icon') if getattr(self, key) is not None}
+        data.update(self.extra)
+        if self.of is not None:
+            data['of'] = [resource.to_dict() for resource in self.of]
+        return data
+
+class Relation:
+    ''' One entry of diagram.relates. source and target are resource ids (the YAML 'from' and 'to').'''
+    __slots__ = ('source', 'target', 'direction', 'description', 'color', 'style', 'extra')
+    KEYS = ('from', 'to', 'direction', 'description', 'color', 'style')
+
+    def __init__(self, source=None, target=None, direction=None, description=None, color=None, style=None, extra=None):
+        self.source = source
+        self.target = target
+        self.direction = direction  # outgoing (default), incoming, bidirectional or anything else for no arrows
+        self.description = description
+        self.color = color
+        self.style = style
+        self.extra = extra or {}
+
+    @classmethod
+    def from_dict(cls, data:dict):
+        return cls(data.get('from'), data.get('to'), data.get('direction'), data.get('description'), data.get('color'),
+                   data.get('style'), {key: value for key, value in data.items() if key not in cls.KEYS})
+
+    def to_dict(self) -> dict:
+        data = {'from': self.source, 'to': self.target}
+        for key in ('direction', 'description', 'color', 'style'):
+            if getattr(self, key) is not None:
+                data[key] = getattr(self, key)
+        data.update(self.extra)
+        return data
+
+class Diagram:
+    ''' A whole diagram. Relations nested among the resources are moved to relates when it is read, so every stage
+    finds them in one place.'''
+    __slots__ = ('name', 'direction', 'style', 'fan_out', 'resources', 'relates', 'extra')
+    KEYS = ('name', 'direction', 'style', 'fan_out', 'resources', 'relates')
+
+    def __init__(self, name=None, direction=None, style=None, fan_out=None, resources=None, relates=None, extra=None):
+        self.name = name
+        self.direction = direction
+        self.style = style
+        self.fan_out = fan_out
+        self.resources = resources if resources is not None else []
+        self.relates = relates if relates is not None else []
+        self.extra = extra or {}
+
+    @classmethod
+    def from_dict(cls, data:dict):
+        ''' From parsed YAML ({'diagram': {...}}). Raises ValueError if there is no diagram mapping or relates is neither a
+        list nor a single relation.'''
+        if not isinstance(data, dict) or not isinstance(data.get('diagram'), dict):
+            raise ValueError("YAML has no diagram section")
+        config = data['diagram']
+        # Relations may also sit next to the diagram instead of inside it
+        relates = config['relates'] if 'relates' in config else data.get('relates')
+        # A single relation written as a mapping, as among the resources (see Resource.list_from)
+        if isinstance(relates, dict):
+            relates = [relates]
+        elif relates is not None and not isinstance(relates, list):
+            raise ValueError(f"relates must be a list of relations, not {type(relates).__name__}")
+        relates = [Relation.from_dict(relation) for relation in relates or [] if isinstance(relation, dict)]
+        resources = config.get('resources')
+        resources = Resource.list_from(resources, relates) if isinstance(resources, list) else []
+        return cls(config.get('name'), config.get('direction'), config.get('style'), config.get('fan_out'), resources, relates,
+                   {key: value for key, value in config.items() if key not in cls.KEYS})
+
+    @classmethod
+    def from_yaml(cls, text:str):
+        with span('pipeline.parse_yaml', yaml_chars=len(text)):
+            return cls.from_dict(load_yaml(text))
+
+    @classmethod
+    def coerce(cls, value):
+        ''' A Diagram from a Diagram (returned as is), parsed YAML or YAML text.'''
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, str):
+            return cls.from_yaml(value)
+        return cls.from_dict(value)
+
+    def to_dict(self) -> dict:
+        config = {key: getattr(self, key) for key in ('name', 'direction', 'style', 'fan_out') if getattr(self, key) is not None}
+        config.update(self.extra)
+        config['resources'] = [resource.to_dict() for resource in self.resources]
+        if self.relates:
+            config['relates'] = [relation.to_dict() for relation in self.relates]
+        return {'diagram': config}
+
+    def to_yaml(self) -> str:
+        with span('pipeline.dump_yaml', resources=len(self.resources)):
+            return dump_yaml(self.to_dict())
+
+    def iter_resources(self):
+        return iter_resources(self.resources)
+
+def iter_resources(resources, parent:str = ''):   # Helper function yielding (dotted id path, resource) for every resource, nested ones included
+    for resource in resources:
+        qualified_id = str(resource.id)
+        if parent and not qualified_id.startswith(parent + '.'):
+            qualified_id = f"{parent}.{qualified_id}"
+        yield qualified_id, resource
+        if resource.of is not None:
+            yield from iter_resources(resource.of, qualified_id)
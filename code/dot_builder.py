@@ -0,0 +1,296 @@
+import re
+
+from diagram import Diagram
+
+# Same defaults the diagrams library applied, so the rendered output keeps its look
+DEFAULT_GRAPH_ATTRS = {
+    "pad": "2.0",
+    "splines": "ortho",
+    "nodesep": "0.60",
+    "ranksep": "0.75",
+    "fontname": "Sans-Serif",
+    "fontsize": "15",
+    "fontcolor": "#2D3436",
+}
+DEFAULT_NODE_ATTRS = {
+    "shape": "box",
+    "style": "rounded",
+    "fixedsize": "true",
+    "width": "1.4",
+    "height": "1.4",
+    "labelloc": "b",
+    "imagescale": "true",
+    "fontname": "Sans-Serif",
+    "fontsize": "13",
+    "fontcolor": "#2D3436",
+}
+DEFAULT_EDGE_ATTRS = {
+    "color": "#7B8894",
+}
+CLUSTER_GRAPH_ATTRS = {
+    "shape": "box",
+    "style": "rounded",
+    "labeljust": "l",
+    "pencolor": "#AEB6BE",
+    "fontname": "Sans-Serif",
+    "fontsize": "12",
+}
+CLUSTER_BGCOLORS = ("#E5F5FD", "#EBF3E7", "#ECE8F6", "#FDF7E3")
+EDGE_ATTRS = {
+    "fontcolor": "#2D3436",
+    "fontname": "Sans-Serif",
+    "fontsize": "13",
+}
+ICON_NODE_HEIGHT = 1.9
+
+DIRECTION_MAP = {
+    'left-to-right': 'LR',
+    'right-to-left': 'RL',
+    'top-to-bottom': 'TB',
+    'bottom-to-top': 'BT'
+}
+# connect_nodes semantics: >> is forward, << is back, << edge >> is both, - is none
+EDGE_DIRECTIONS = {
+    'outgoing': 'forward',
+    'incoming': 'back',
+    'bidirectional': 'both',
+}
+
+# How a relation between two groups is drawn: 'edges' draws every member-to-member edge (m x n), 'junction' routes
+# them through one small point node (m + n edges), which keeps large group-to-group fan-outs fast to lay out
+FAN_OUT_MODES = ('edges', 'junction')
+DEFAULT_FAN_OUT = 'edges'
+JUNCTION_NODE_ATTRS = {
+    "shape": "point",
+    "width": "0.08",
+    "height": "0.08",
+    "label": "",
+    "color": "#7B8894",
+}
+
+_UNESCAPED_QUOTE = re.compile(r'(?<!\\)"')
+_HTML_STRING = re.compile(r'<.*>$', re.DOTALL)
+
+def quote(value) -> str:   # Helper function to write a DOT identifier or attribute value
+    value = str(value)
+    if _HTML_STRING.match(value):
+        return value
+    return '"' + _UNESCAPED_QUOTE.sub(r'\"', value) + '"'
+
+def attr_list(attrs:dict) -> str:
+    return ' '.join(f'{key}={quote(value)}' for key, value in attrs.items())
+
+class DotBuilder:
+    ''' Builds Graphviz DOT source for a Diagram (parsed YAML and YAML text are converted) in memory. Produces the
+    same clusters, node and edge attributes as the diagrams library did, without its global context, temp files or
+    import cost. One builder per diagram; nothing is shared between instances and the diagram is not modified.
+    fan_out overrides the diagram's own 'fan_out' setting.'''
+
+    def __init__(self, diagram, fan_out:str = None):
+        self.diagram = Diagram.coerce(diagram)
+        self.fan_out = fan_out
+        self.nodes = {}             # resource id -> node id, or list of node ids for groups
+        self.node_ids = set()
+        self.cluster_names = set()
+        self.lines = []
+        self.elements = []          # (line position, 'node' or 'edge', node id or (tail, head), attrs) in output order
+        self.junctions = 0
+        self.graph_attrs = {}
+        self.top_level = None       # Index of the top-level resource being added
+        self.owners = {}            # node id -> index of the top-level resource it was drawn in
+        self.blocks = []            # (first line, end line, top-level index) of every top-level resource and relation
+        self.links = []             # Top-level indices joined by each relation
+
+    def unique_id(self, wanted:str, used:set) -> str:
+        candidate = wanted
+        counter = 1
+        while candidate in used:
+            counter += 1
+            candidate = f'{wanted}~{counter}'
+        used.add(candidate)
+        return candidate
+
+    def build(self) -> str:
+        diagram = self.diagram
+        diagram_name = diagram.name if diagram.name is not None else ''
+        diagram_direction = DIRECTION_MAP.get(diagram.direction or 'left-to-right', 'LR')
+        diagram_style = diagram.style or {}
+        fan_out = self.fan_out or diagram.fan_out or DEFAULT_FAN_OUT
+        if fan_out not in FAN_OUT_MODES:
+            raise ValueError(f"Unsupported fan_out '{fan_out}', expected one of {', '.join(FAN_OUT_MODES)}")
+        self.fan_out = fan_out
+
+        graph_attrs = dict(DEFAULT_GRAPH_ATTRS, label=diagram_name, rankdir=diagram_direction)
+        graph_attrs.update(diagram_style.get('graph', {}) or {})
+        node_attrs = dict(DEFAULT_NODE_ATTRS)
+        node_attrs.update(diagram_style.get('node', {}) or {})
+        edge_attrs = dict(DEFAULT_EDGE_ATTRS)
+        edge_attrs.update(diagram_style.get('edge', {}) or {})
+        self.graph_attrs = graph_attrs
+
+        self.lines = [
+            f'digraph {quote(diagram_name)} {{',
+            f'\tgraph [{attr_list(graph_attrs)}]',
+            f'\tnode [{attr_list(node_attrs)}]',
+            f'\tedge [{attr_list(edge_attrs)}]',
+        ]
+        for index, resource in enumerate(diagram.resources):
+            start = len(self.lines)
+            self.top_level = index
+            self.add_resource(resource, depth=0, indent='\t')
+            self.blocks.append((start, len(self.lines), index))
+        self.top_level = None
+        for relation in diagram.relates:
+            start, first_element = len(self.lines), len(self.elements)
+            self.add_relation(relation)
+            joined = {self.owners[node] for _, kind, name, _ in self.elements[first_element:] if kind == 'edge'
+                      for node in name if node in self.owners}
+            if joined:
+                self.links.append(joined)
+                self.blocks.append((start, len(self.lines), min(joined)))
+        self.lines.append('}')
+        return '\n'.join(self.lines) + '\n'
+
+    def parts(self, max_parts:int):
+        ''' Splits the built diagram into at most max_parts DOT sources that share no edge, for laying out at the same
+        time (see packing.py). Top-level resources joined by a relation, directly or through others, stay in one
+        part; when there are more such components than max_parts, the smallest are added to the lightest parts.
+        Parts follow the diagram's resource order, so a diagram always splits and packs the same way. Each part
+        keeps the node and edge defaults but has no graph label or padding. Returns [] for a diagram in one piece.'''
+        parent = list(range(len(self.diagram.resources)))
+        def find(index):
+            while parent[index] != index:
+                parent[index] = parent[parent[index]]
+                index = parent[index]
+            return index
+        for joined in self.links:
+            first, *others = joined
+            for other in others:
+                parent[find(other)] = find(first)
+
+        weights = {}
+        for start, end, index in self.blocks:
+            root = find(index)
+            weights[root] = weights.get(root, 0) + end - start
+        # Components in order of their first resource; ones that draw nothing (empty groups) are left out
+        components = [root for root in dict.fromkeys(find(index) for index in range(len(parent))) if weights.get(root)]
+        if len(components) < 2 or max_parts < 2:
+            return []
+
+        loads = [0] * min(max_parts, len(components))
+        bins = [[] for _ in loads]
+        for root in sorted(components, key=lambda root: -weights[root]):
+            lightest = loads.index(min(loads))
+            loads[lightest] += weights[root]
+            bins[lightest].append(root)
+        part_of = {}
+        for part, roots in enumerate(sorted(bins, key=lambda roots: min(components.index(root) for root in roots))):
+            for root in roots:
+                part_of[root] = part
+
+        graph_attrs = dict(self.graph_attrs, label='', pad='0')
+        header = [self.lines[0], f'\tgraph [{attr_list(graph_attrs)}]', self.lines[2], self.lines[3]]
+        sources = [list(header) for _ in bins]
+        for start, end, index in self.blocks:
+            sources[part_of[find(index)]].extend(self.lines[start:end])
+        return ['\n'.join(lines + ['}']) + '\n' for lines in sources]
+
+    def add_resource(self, resource, depth, indent, group=None):
+        resource_id = resource.id
+        resource_type = resource.type
+        label = resource.name if resource.name is not None else ''
+        resource_of = resource.of or []
+
+        if resource_type == 'cluster':
+            cluster_name = self.unique_id(f'cluster_{resource_id}', self.cluster_names)
+            cluster_attrs = dict(CLUSTER_GRAPH_ATTRS, label=label, rankdir='LR', bgcolor=CLUSTER_BGCOLORS[depth % len(CLUSTER_BGCOLORS)])
+            self.lines.append(f'{indent}subgraph {quote(cluster_name)} {{')
+            self.lines.append(f'{indent}\tgraph [{attr_list(cluster_attrs)}]')
+            for sub_resource in resource_of:
+                self.add_resource(sub_resource, depth + 1, indent + '\t')
+            self.lines.append(f'{indent}}}')
+        elif resource_type == 'group':
+            # A group is not drawn; it only names a set of nodes for fan-out relations
+            group_nodes = []
+            for sub_resource in resource_of:
+                self.add_resource(sub_resource, depth, indent, group_nodes)
+            self.nodes[resource_id] = group_nodes
+            if group is not None:
+                group.extend(group_nodes)
+        elif resource_type == 'custom':
+            icon_path = resource.icon
+            if not icon_path:
+                raise ValueError(f"Custom node '{label}' must have an 'icon' path specified.")
+            node_id = self.unique_id(str(resource_id), self.node_ids)
+            # Taller icon nodes so multi-line labels do not run into the image
+            node_attrs = {
+                'label': label,
+                'height': str(ICON_NODE_HEIGHT + 0.4 * str(label).count('\n')),
+                'image': icon_path,
+                'shape': 'none',
+            }
+            self.add_node(node_id, node_attrs, indent)
+            self.nodes[resource_id] = node_id
+            if group is not None:
+                group.append(node_id)
+        else:
+            raise ValueError(f"Unsupported resource type '{resource_type}' for resource '{label}'")
+
+    def add_relation(self, relation):
+        from_node = self.nodes.get(relation.source)
+        to_node = self.nodes.get(relation.target)
+        if from_node is None or to_node is None:
+            return
+
+        edge_attrs = dict(EDGE_ATTRS)
+        if relation.description:
+            edge_attrs['label'] = relation.description
+        if relation.color:
+            edge_attrs['color'] = relation.color
+        if relation.style:
+            edge_attrs['style'] = relation.style
+        edge_attrs['dir'] = EDGE_DIRECTIONS.get(relation.direction or 'outgoing', 'none')
+
+        # Groups fan out to every member node
+        from_nodes = from_node if isinstance(from_node, list) else [from_node]
+        to_nodes = to_node if isinstance(to_node, list) else [to_node]
+        if self.fan_out == 'junction' and len(from_nodes) * len(to_nodes) > len(from_nodes) + len(to_nodes):
+            self.add_junction(from_nodes, to_nodes, edge_attrs)
+            return
+        attrs = attr_list(edge_attrs)
+        for fn in from_nodes:
+            for tn in to_nodes:
+                self.add_edge(fn, tn, edge_attrs, attrs)
+
+    def add_junction(self, from_nodes, to_nodes, edge_attrs):
+        # from_nodes -> junction -> to_nodes; arrowheads stay on the member nodes and the label moves to the junction
+        self.junctions += 1
+        junction = self.unique_id(f'fan_out~{self.junctions}', self.node_ids)
+        junction_attrs = dict(JUNCTION_NODE_ATTRS)
+        if 'color' in edge_attrs:
+            junction_attrs['color'] = edge_attrs['color']
+        if 'label' in edge_attrs:
+            junction_attrs['xlabel'] = edge_attrs['label']
+        self.add_node(junction, junction_attrs, '\t')
+
+        direction = edge_attrs['dir']
+        shared_attrs = {key: value for key, value in edge_attrs.items() if key not in ('label', 'dir')}
+        incoming_attrs = dict(shared_attrs, dir='back' if direction in ('back', 'both') else 'none')
+        outgoing_attrs = dict(shared_attrs, dir='forward' if direction in ('forward', 'both') else 'none')
+        incoming_text = attr_list(incoming_attrs)
+        outgoing_text = attr_list(outgoing_attrs)
+        for fn in from_nodes:
+            self.add_edge(fn, junction, incoming_attrs, incoming_text)
+        for tn in to_nodes:
+            self.add_edge(junction, tn, outgoing_attrs, outgoing_text)
+
+    def add_node(self, node_id, attrs, indent):
+        if self.top_level is not None:
+            self.owners[node_id] = self.top_level
+        self.elements.append((len(self.lines), 'node', node_id, attrs))
+        self.lines.append(f'{indent}{quote(node_id)} [{attr_list(attrs)}]')
+
+    def add_edge(self, tail, head, attrs, attr_text):
+        # attr_text is attr_list(attrs), rendered once by the caller for all edges of a fan-out
+        self.elements.append((len(self.lines), 'edge', (tail, head), attrs))
+        self.lines.append(f'\t{quote(tail)} -> {quote(head)} [{attr_text}]')
@@ -0,0 +1,148 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+
+from icons import BASE_DIR
+from instrumentation import event
+
+# Built by `python icon_bundle.py`; used by the renderer whenever it exists and is newer than the icon descriptor
+DEFAULT_BUNDLE_PATH = os.path.join(BASE_DIR, 'icons.bundle')
+DEFAULT_ICON_DESCRIPTOR_PATH = os.path.join(BASE_DIR, 'icon_descriptor.json')
+
+# File layout: MAGIC, header length (little-endian uint64), JSON header, then the icon bodies back to back.
+# The header maps each icon path (relative to BASE_DIR, '/'-separated, as icon_descriptor.json paths are once
+# normalised) to [offset, length, width, height, viewBox]; offsets are relative to the end of the header.
+MAGIC = b'ORCHICO1'
+_LENGTH = struct.Struct('<Q')
+
+def bundle_key(icon_path:str, base_dir:str = BASE_DIR):
+    ''' Bundle lookup key of an icon path, whether absolute (as written into the dot output) or descriptor-relative.'''
+    return os.path.relpath(os.path.abspath(os.path.join(base_dir, icon_path.replace('\\', '/'))), base_dir).replace(os.sep, '/')
+
+def icon_paths(icons_dir:str, icon_descriptor_path:str):
+    ''' Every SVG of the icons tree plus every path named in the descriptor (normally the same files).'''
+    paths = set()
+    for directory, _, files in os.walk(icons_dir):
+        paths.update(os.path.join(directory, name) for name in files if name.lower().endswith('.svg'))
+    with open(icon_descriptor_path, 'r') as file:
+        for path in json.load(file).values():
+            path = os.path.join(BASE_DIR, path.replace('\\', '/'))
+            if path.lower().endswith('.svg') and os.path.exists(path):
+                paths.add(path)
+    return sorted(os.path.abspath(path) for path in paths)
+
+def build_bundle(output_path:str = DEFAULT_BUNDLE_PATH, icons_dir:str = None, icon_descriptor_path:str = DEFAULT_ICON_DESCRIPTOR_PATH):
+    ''' Parses and minifies every icon once and packs them into one indexed file. Returns (icons packed, skipped).'''
+    # Imported here so reading a bundle never pulls in the renderer
+    from backend import IconSVGCache
+    icons_dir = icons_dir or os.path.join(os.path.dirname(BASE_DIR), 'icons')
+    entries = {}
+    bodies = []
+    offset = 0
+    skipped = []
+    for path in icon_paths(icons_dir, icon_descriptor_path):
+        try:
+            icon = IconSVGCache._load(path, minify=True)
+        except Exception as e:
+            skipped.append((path, e))
+            continue
+        body = icon.markup.encode('utf-8')
+        entries[bundle_key(path)] = [offset, len(body), icon.width, icon.height, icon.view_box]
+        bodies.append(body)
+        offset += len(body)
+
+    header = json.dumps({'entries': entries}, separators=(',', ':')).encode('utf-8')
+    temp_path = output_path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(MAGIC)
+        file.write(_LENGTH.pack(len(header)))
+        file.write(header)
+        for body in bodies:
+            file.write(body)
+    os.replace(temp_path, output_path)
+    return len(entries), skipped
+
+def _file_stamp(path:str):   # Helper function: (mtime_ns, size) of a file, None if it does not exist
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+class IconBundle:
+    ''' Read side of the bundle: the header is parsed once, icon bodies are slices of a read-only mmap of the file.'''
+    _instance = None
+    _instance_stamp = None     # (path, bundle stamp, descriptor stamp) _instance was opened for
+    _lock = threading.Lock()
+
+    def __init__(self, path:str):
+        self.path = path
+        self.build_id = os.stat(path).st_mtime_ns
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"'{path}' is not an icon bundle")
+        header_length = _LENGTH.unpack_from(self._map, len(MAGIC))[0]
+        header_start = len(MAGIC) + _LENGTH.size
+        self.entries = json.loads(self._map[header_start:header_start + header_length])['entries']
+        self.body_start = header_start + header_length
+        self._read_lock = threading.Lock()
+
+    @classmethod
+    def default(cls, path:str = DEFAULT_BUNDLE_PATH, icon_descriptor_path:str = DEFAULT_ICON_DESCRIPTOR_PATH):
+        ''' The process-wide bundle, or None when it is missing or older than the descriptor (icons then load per file).
+        Like Assets, the files are checked on every call, so a rebuilt bundle is picked up without a restart.'''
+        stamp = (path, _file_stamp(path), _file_stamp(icon_descriptor_path))
+        if cls._instance_stamp == stamp:
+            return cls._instance
+        with cls._lock:
+            if cls._instance_stamp != stamp:
+                bundle = None
+                if stamp[1] is not None:
+                    if stamp[2] is not None and stamp[2][0] > stamp[1][0]:
+                        event(logging.WARNING, f"Icon bundle '{path}' is older than the icon descriptor; "
+                                               f"rebuild it with python icon_bundle.py", path=path)
+                    else:
+                        bundle = cls(path)
+                if cls._instance is not None:
+                    cls._instance.close()
+                cls._instance = bundle
+                cls._instance_stamp = stamp
+        return cls._instance
+
+    def __contains__(self, icon_path:str):
+        return bundle_key(icon_path) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, icon_path:str):
+        ''' (width, height, viewBox, markup) of an icon, or None if the bundle does not have it or has been closed.'''
+        entry = self.entries.get(bundle_key(icon_path))
+        if entry is None:
+            return None
+        offset, length, width, height, view_box = entry
+        start = self.body_start + offset
+        with self._read_lock:
+            if self._map.closed:
+                return None
+            body = self._map[start:start + length]
+        return width, height, view_box, body.decode('utf-8')
+
+    def close(self):
+        ''' Unmaps the file. Called by default() when a rebuilt bundle replaces this one.'''
+        with self._read_lock:
+            self._map.close()
+
+if __name__ == '__main__':
+    # Offline build: python icon_bundle.py [output path] [icons directory]
+    output_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_BUNDLE_PATH
+    icons_dir = sys.argv[2] if len(sys.argv) > 2 else None
+    packed, skipped = build_bundle(output_path, icons_dir)
+    for path, error in skipped:
+        print(f"Skipped {path}: {error}")
+    print(f"Packed {packed} icons into {output_path} ({os.path.getsize(output_path) / 1024 / 1024:.1f} MB)")
@@ -0,0 +1,233 @@
+import json
+import math
+import os
+import re
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import numpy
+
+from icons import PROVIDER_PREFIXES, service_part
+
+# Built next to the descriptor by `python icon_search.py` (or on first load if missing or older than the descriptor)
+DEFAULT_INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'icon_search_index')
+
+_WORD = re.compile(r'[a-z]+[0-9]*|[0-9]+')
+_STOP_WORDS = {'a', 'and', 'arch', 'architecture', 'for', 'icon', 'icons', 'in', 'of', 'on', 'res', 'resource', 'the',
+               'to', 'with', 'is', 'are', 'be', 'by', 'from', 'into', 'this', 'that', 'it', 'as', 'or', 'each', 'all'}
+_GRAM = 3
+# Relative weight of each feature kind: words naming the service count most, category words less, character
+# n-grams let partial or slightly misspelt words ("dynamo", "kubernets") still find their icon
+SERVICE_WEIGHT = 2.0
+CATEGORY_WEIGHT = 1.0
+GRAM_WEIGHT = 0.5
+
+def words(text:str):
+    return [word for word in _WORD.findall(str(text).lower()) if not word.isdigit() and word not in _STOP_WORDS]
+
+def grams(word:str):
+    padded = f'#{word}#'
+    return ['~' + padded[i:i + _GRAM] for i in range(len(padded) - _GRAM + 1)]
+
+def features(service_words, category_words=()):
+    ''' Weighted term counts of an icon key (service and category words) or of a search query (service words only).'''
+    counts = {}
+    for weight, source in ((SERVICE_WEIGHT, service_words), (CATEGORY_WEIGHT, category_words)):
+        for word in dict.fromkeys(source):
+            counts[word] = counts.get(word, 0.0) + weight
+            for gram in grams(word):
+                counts[gram] = counts.get(gram, 0.0) + GRAM_WEIGHT
+    return counts
+
+@contextmanager
+def _replacing(path:str, mode:str):   # Helper function: a file written next to path and renamed over it once complete
+    descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, mode) as file:
+            yield file
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+class IconSearchIndex:
+    ''' TF-IDF index over the icon catalog: each key is described by the words of its service name and of its
+    provider/category path. The matrix is stored column-wise (one posting list of (key, weight) per term) as .npy
+    files and memory-mapped on load, so opening it costs a few milliseconds and no pass over the catalog.
+    Queries are scored in batches with NumPy scatter-adds; scores are cosine similarities in [0, 1].'''
+    _instances = {}
+    _lock = threading.Lock()
+
+    def __init__(self, keys, vocabulary, idf, indptr, indices, data):
+        self.keys = keys
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.providers = numpy.asarray([key.split('.', 1)[0] for key in keys])
+        # Size and theme variants of one icon (ec2_16, ec2_48, ...) share a group; results show each group once,
+        # represented by its 48px or unsized variant when scores tie
+        self.groups = [key.split('.', 1)[0] + ' ' + ' '.join(words(service_part(key))) for key in keys]
+        self.variant_penalty = numpy.asarray([0.0 if re.search(r'_48(?:_|$)', key) or not re.search(r'_(16|32|64)(?:_|$)', key)
+                                              else 1e-4 for key in keys], dtype=numpy.float32)
+
+    @classmethod
+    def build(cls, icon_keys, index_dir:str = None):
+        ''' Builds the index from the descriptor keys, and writes it to index_dir if given. Pure local computation.'''
+        keys = list(icon_keys)
+        documents = []
+        for key in keys:
+            service = service_part(key)
+            category = key[:len(key) - len(service)]
+            documents.append(features(words(service), words(category)))
+
+        vocabulary = {}
+        document_frequency = []
+        for document in documents:
+            for term in document:
+                if term not in vocabulary:
+                    vocabulary[term] = len(vocabulary)
+                    document_frequency.append(0)
+                document_frequency[vocabulary[term]] += 1
+        idf = numpy.log((1 + len(keys)) / (1 + numpy.asarray(document_frequency, dtype=numpy.float32))) + 1
+
+        # Row-normalised tf-idf, then transposed into per-term posting lists
+        postings = [[] for _ in vocabulary]
+        for row, document in enumerate(documents):
+            weights = {vocabulary[term]: (1 + math.log(count)) * idf[vocabulary[term]] for term, count in document.items()}
+            norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1.0
+            for column, weight in weights.items():
+                postings[column].append((row, weight / norm))
+        indptr = numpy.zeros(len(postings) + 1, dtype=numpy.int64)
+        indptr[1:] = numpy.cumsum([len(posting) for posting in postings])
+        indices = numpy.fromiter((row for posting in postings for row, _ in posting), dtype=numpy.int32, count=indptr[-1])
+        data = numpy.fromiter((weight for posting in postings for _, weight in posting), dtype=numpy.float32, count=indptr[-1])
+        index = cls(keys, vocabulary, idf.astype(numpy.float32), indptr, indices, data)
+        if index_dir is not None:
+            index.save(index_dir)
+        return index
+
+    def save(self, index_dir:str):
+        ''' Writes every file under a temporary name and renames it into place, terms.json (the marker load() checks)
+        last: a process opening the index meanwhile never maps a partly written file, and two processes building it
+        at the same time just replace each other's identical files.'''
+        os.makedirs(index_dir, exist_ok=True)
+        for name in ('idf', 'indptr', 'indices', 'data'):
+            with _replacing(os.path.join(index_dir, f'{name}.npy'), 'wb') as file:
+                numpy.save(file, getattr(self, name))
+        with _replacing(os.path.join(index_dir, 'terms.json'), 'w') as file:
+            json.dump({'keys': self.keys, 'vocabulary': list(self.vocabulary)}, file)
+
+    @classmethod
+    def open(cls, index_dir:str):
+        arrays = {name: numpy.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r') for name in ('idf', 'indptr', 'indices', 'data')}
+        with open(os.path.join(index_dir, 'terms.json'), 'r') as file:
+            terms = json.load(file)
+        vocabulary = {term: column for column, term in enumerate(terms['vocabulary'])}
+        return cls(terms['keys'], vocabulary, **arrays)
+
+    @classmethod
+    def load(cls, icon_descriptor_path:str, index_dir:str = DEFAULT_INDEX_DIR):
+        ''' Returns the process-wide index, opening the prebuilt files or rebuilding them when the descriptor is newer.'''
+        # The descriptor's mtime is part of the key, so a changed descriptor is picked up by a running process
+        key = (os.path.abspath(icon_descriptor_path), os.path.abspath(index_dir), os.stat(icon_descriptor_path).st_mtime_ns)
+        instance = cls._instances.get(key)
+        if instance is None:
+            with cls._lock:
+                instance = cls._instances.get(key)
+                if instance is None:
+                    marker = os.path.join(index_dir, 'terms.json')
+                    if os.path.exists(marker) and os.path.getmtime(marker) >= os.path.getmtime(icon_descriptor_path):
+                        instance = cls.open(index_dir)
+                    else:
+                        with open(icon_descriptor_path, 'r') as file:
+                            icon_keys = json.load(file).keys()
+                        instance = cls.build(icon_keys, index_dir)
+                    # Drop the index of an older version of the same descriptor
+                    for stale in [other for other in cls._instances if other[:2] == key[:2]]:
+                        del cls._instances[stale]
+                    cls._instances[key] = instance
+        return instance
+
+    def query_matrix(self, queries):
+        ''' (query row, term column, weight) arrays of the normalised tf-idf vectors of the queries.'''
+        rows, columns, weights = [], [], []
+        for row, query in enumerate(queries):
+            vector = {self.vocabulary[term]: (1 + math.log(count)) for term, count in features(words(query)).items()
+                      if term in self.vocabulary}
+            for column in vector:
+                vector[column] *= float(self.idf[column])
+            norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+            for column, weight in vector.items():
+                rows.append(row)
+                columns.append(column)
+                weights.append(weight / norm)
+        return rows, columns, weights
+
+    def scores(self, queries):
+        ''' Dense (len(queries), len(keys)) matrix of cosine similarities.'''
+        scores = numpy.zeros((len(queries), len(self.keys)), dtype=numpy.float32)
+        rows, columns, weights = self.query_matrix(queries)
+        if not rows:
+            return scores
+        starts = self.indptr[columns]
+        lengths = self.indptr[numpy.asarray(columns) + 1] - starts
+        # Expand every (query, term) pair into its posting list and scatter-add all of them at once
+        posting_rows = numpy.repeat(numpy.asarray(rows), lengths)
+        offsets = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        positions = numpy.repeat(starts, lengths) + offsets
+        numpy.add.at(scores, (posting_rows, self.indices[positions]),
+                     numpy.repeat(numpy.asarray(weights, dtype=numpy.float32), lengths) * self.data[positions])
+        return scores
+
+    def provider_mask(self, providers):
+        prefixes = [PROVIDER_PREFIXES.get(provider, str(provider).lower()) for provider in providers]
+        return numpy.isin(self.providers, prefixes)
+
+    def search(self, queries, k:int = 10, providers=None, min_score:float = 0.05):
+        ''' Top-k icon keys for every query, as lists of (key, score), best first. providers (UI names such as "AWS")
+        restricts the results to those providers' icons.'''
+        scores = self.scores(queries) - self.variant_penalty
+        if providers:
+            scores[:, ~self.provider_mask(providers)] = 0
+        # Variants are collapsed afterwards, so look at a few more than k candidates
+        width = min(4 * k, len(self.keys))
+        top = numpy.argpartition(-scores, width - 1, axis=1)[:, :width]
+        results = []
+        for row in range(len(queries)):
+            ranked = top[row][numpy.argsort(-scores[row, top[row]], kind='stable')]
+            results.append(self.distinct(ranked, scores[row], k, min_score))
+        return results
+
+    def distinct(self, ranked, scores, k, min_score):   # Helper function keeping the best-scoring variant of each icon group
+        results, seen = [], set()
+        for column in ranked:
+            if len(results) == k or scores[column] < min_score:
+                break
+            if self.groups[column] not in seen:
+                seen.add(self.groups[column])
+                results.append((self.keys[column], round(float(scores[column]), 4)))
+        return results
+
+    def suggest(self, text:str, k:int = 10, providers=None, per_phrase:int = 1, min_score:float = 0.35):
+        ''' Icons for the services mentioned in a free-text description (clustering or relationship answers).
+        Every sentence or clause is one query of a batch; the best matches of each clause are merged, best first.'''
+        phrases = [phrase for phrase in re.split(r'[.;,:\n()]|\band\b|\bthen\b', text) if words(phrase)]
+        if not phrases:
+            return []
+        best = {}
+        for matches in self.search(phrases, k=per_phrase, providers=providers, min_score=min_score):
+            for key, score in matches:
+                best[key] = max(score, best.get(key, 0.0))
+        return sorted(best, key=best.get, reverse=True)[:k]
+
+if __name__ == '__main__':
+    # Offline build: python icon_search.py [icon_descriptor.json] [output directory]
+    descriptor_path = sys.argv[1] if len(sys.argv) > 1 else 'icon_descriptor.json'
+    output_dir = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_INDEX_DIR
+    with open(descriptor_path, 'r') as file:
+        index = IconSearchIndex.build(json.load(file).keys(), output_dir)
+    print(f"Indexed {len(index.keys)} icons, {len(index.vocabulary)} terms, {len(index.data)} postings -> {output_dir}")
@@ -0,0 +1,285 @@
+import json
+import os
+import re
+import threading
+
+import numpy
+from rapidfuzz import fuzz, process
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class IconIndex:
+    ''' Load-once index over icon_descriptor.json. Keys are dotted icon names (e.g. aws.compute.ec2) which are also
+    used as regex patterns against the icon reference written by the LLM. The first pattern (in descriptor order) that
+    matches wins, exactly like the linear scan it replaces; the index only narrows down which patterns have to be tried.'''
+    _instances = {}
+    _lock = threading.Lock()
+
+    # Characters that give a key a regex meaning beyond the '.' wildcard. Keys without them are "simple" and can be
+    # prefiltered by the literal text between their dots.
+    _REGEX_SPECIALS = set('\\^$*+?{}[]|()')
+    _GRAM = 3
+    _MEMO_SIZE = 4096
+
+    def __init__(self, icon_descriptor:dict, base_dir:str = BASE_DIR):
+        self.keys = list(icon_descriptor.keys())
+        self.patterns = [re.compile(key) for key in self.keys]
+        # Normalised absolute icon paths, computed once instead of on every resource
+        self.paths = [os.path.abspath(os.path.join(base_dir, re.sub(r"\\", "/", path))) for path in icon_descriptor.values()]
+
+        # Descriptor key -> its own position, for icon keys chosen by IconResolver or the icon LLM pass (see path_for)
+        self.key_positions = {key: position for position, key in enumerate(self.keys)}
+        # Exact lookup on the dotted name. A key that matches itself bounds the scan: nothing after it can win.
+        self.exact = {}
+        for position, key in enumerate(self.keys):
+            if key not in self.exact and self.patterns[position].search(key):
+                self.exact[key] = position
+
+        # n-gram prefilter: every simple pattern is filed under one n-gram of its literal (between-dot) text. A pattern
+        # can only match a string that contains that n-gram. Everything else is always a candidate.
+        key_grams = [self._literal_grams(key) for key in self.keys]
+        frequency = {}
+        for grams in key_grams:
+            for gram in grams or ():
+                frequency[gram] = frequency.get(gram, 0) + 1
+        self.gram_index = {}
+        self.always = []
+        for position, grams in enumerate(key_grams):
+            # File each pattern under its rarest n-gram so candidate lists stay short
+            gram = min(grams, key=frequency.get) if grams else None
+            if gram is None:
+                self.always.append(position)
+            else:
+                self.gram_index.setdefault(gram, []).append(position)
+
+        self._memo = {}
+
+    @classmethod
+    def load(cls, icon_descriptor_path:str, base_dir:str = BASE_DIR):
+        ''' Returns the process-wide index for the given descriptor file, building it on first use.'''
+        key = (os.path.abspath(icon_descriptor_path), base_dir)
+        instance = cls._instances.get(key)
+        if instance is None:
+            with cls._lock:
+                instance = cls._instances.get(key)
+                if instance is None:
+                    with open(icon_descriptor_path, 'r') as file:
+                        instance = cls(json.load(file), base_dir=base_dir)
+                    cls._instances[key] = instance
+        return instance
+
+    def _literal_grams(self, key):
+        if any(char in self._REGEX_SPECIALS for char in key):
+            return None
+        return {segment[i:i + self._GRAM] for segment in key.split('.') for i in range(len(segment) - self._GRAM + 1)}
+
+    def _candidates(self, icon_name):
+        limit = self.exact.get(icon_name, len(self.keys))
+        grams = {icon_name[i:i + self._GRAM] for i in range(len(icon_name) - self._GRAM + 1)}
+        candidates = [position for position in self.always if position <= limit]
+        for gram in grams:
+            for position in self.gram_index.get(gram, ()):
+                if position > limit:
+                    break
+                candidates.append(position)
+        candidates.sort()
+        return candidates
+
+    def match_position(self, icon_name:str):
+        ''' Index of the first descriptor key whose pattern matches icon_name, or None.'''
+        if icon_name in self._memo:
+            return self._memo[icon_name]
+        position = None
+        for candidate in self._candidates(icon_name):
+            if self.patterns[candidate].search(icon_name):
+                position = candidate
+                break
+        if len(self._memo) >= self._MEMO_SIZE:
+            self._memo.clear()
+        self._memo[icon_name] = position
+        return position
+
+    def scan_position(self, icon_name:str):
+        ''' Plain linear regex scan over every pattern. Kept as the reference behaviour and fallback.'''
+        for position, pattern in enumerate(self.patterns):
+            if pattern.search(icon_name):
+                return position
+        return None
+
+    def match(self, icon_name:str):
+        ''' Absolute icon path for icon_name, or None if no pattern matches.'''
+        position = self.match_position(icon_name)
+        return None if position is None else self.paths[position]
+
+    def path_for(self, icon_name:str):
+        ''' Absolute icon path of a resource's icon: the key's own path when icon_name is a descriptor key, else the
+        path of the first pattern that matches it (see match), or None. As patterns, some keys match an earlier,
+        shorter key first (alibaba.add matches alibaba.ad) or do not match themselves at all (keys with parentheses).'''
+        position = self.key_positions.get(icon_name)
+        return self.paths[position] if position is not None else self.match(icon_name)
+
+# Confidence below which a resource's icon is left to the LLM
+ICON_MATCH_THRESHOLD = 0.6
+
+# Provider names as shown in the UI, mapped to the first segment of their icon keys
+PROVIDER_PREFIXES = {
+    "AWS": "aws",
+    "Azure": "azure",
+    "Google Cloud": "gcp",
+    "IBM Cloud": "ibm",
+    "Oracle Cloud": "oci",
+    "Alibaba": "alibaba",
+}
+
+_TOKEN = re.compile(r'[a-z]+[0-9]*|[0-9]+')
+# Words that appear in almost every key (or only name the provider/icon set) and say nothing about the service
+_NOISE_TOKENS = {
+    'a', 'and', 'arch', 'architecture', 'for', 'icon', 'icons', 'in', 'light', 'dark', 'of', 'on', 'path', 'res',
+    'resource', 'service', 'services', 'svg', 'the', 'to', 'with', 'amazon', 'aws', 'azure', 'gcp', 'google', 'ibm',
+    'oci', 'oracle', 'alibaba', 'cloud', 'custom', 'cluster', 'png', 'icons06072024',
+}
+
+# Short names a placeholder file is often called by, where the icon keys only spell the service out
+_ABBREVIATIONS = {
+    's3': 'simple storage', 'sqs': 'simple queue', 'sns': 'simple notification', 'ses': 'simple email',
+    'elb': 'elastic load balancing', 'ecr': 'elastic container registry',
+}
+
+# Share of a resource's score that comes from its placeholder icon's file name when it has one. The name and id
+# only describe what the resource does ("Events Queue"), the file name is the service the LLM had in mind (sqs.svg)
+PLACEHOLDER_WEIGHT = 0.6
+
+def icon_tokens(text:str):
+    ''' Lower-case word tokens of an icon key or a resource description, without noise words and bare numbers.'''
+    tokens = []
+    for token in _TOKEN.findall(str(text).lower()):
+        if token.isdigit() or token in _NOISE_TOKENS or token in tokens:
+            continue
+        tokens.append(token)
+    return tokens
+
+def service_part(key:str):
+    ''' The part of an icon key that names the service, e.g. "amazon.ec2_48" for
+    aws.architecture.service.icons_06072024.arch_compute.48.arch_amazon.ec2_48. Category segments are dropped.'''
+    for marker in ('.arch_', '.res_', '.icon.service.'):
+        position = key.rfind(marker)
+        if position != -1:
+            return key[position + len(marker):]
+    segments = key.split('.')
+    return '.'.join(segments[2:]) if len(segments) > 2 else segments[-1]
+
+class IconResolver:
+    ''' Local replacement for the LLM pass that maps placeholder icons to icon keys. Every key is reduced once to the
+    tokens of its service name; resources are scored against the candidate keys in one RapidFuzz batch. A score is a
+    confidence in [0, 1]; callers send resources below their threshold to the LLM instead.'''
+    _instances = {}
+    _lock = threading.Lock()
+
+    def __init__(self, icon_keys):
+        self.keys = list(icon_keys)
+        self.positions = {key: position for position, key in enumerate(self.keys)}
+        self.documents = [' '.join(icon_tokens(service_part(key))) or ' '.join(icon_tokens(key)) for key in self.keys]
+        # Tie-break between keys that score the same: 48px architecture icons over other sizes and variants, then
+        # the key with the fewest extra words
+        self.preference = [self._preference(key, document) for key, document in zip(self.keys, self.documents)]
+        # token -> key positions, used to shortlist candidates that share at least one word with a resource
+        self.token_index = {}
+        for position, document in enumerate(self.documents):
+            for token in document.split():
+                self.token_index.setdefault(token, []).append(position)
+        self.provider_positions = {}
+        for position, key in enumerate(self.keys):
+            self.provider_positions.setdefault(key.split('.', 1)[0], []).append(position)
+
+    @classmethod
+    def load(cls, icon_descriptor_path:str):
+        ''' Returns the process-wide resolver for the given descriptor file, building it on first use.'''
+        key = os.path.abspath(icon_descriptor_path)
+        instance = cls._instances.get(key)
+        if instance is None:
+            with cls._lock:
+                instance = cls._instances.get(key)
+                if instance is None:
+                    with open(icon_descriptor_path, 'r') as file:
+                        instance = cls(json.load(file).keys())
+                    cls._instances[key] = instance
+        return instance
+
+    @staticmethod
+    def _preference(key, document):
+        size = re.search(r'_(16|32|48|64)(?:_|$)', key)
+        score = 0.0
+        if size is None or size.group(1) == '48':
+            score += 0.2
+        if '.arch_' in key or '.res_' not in key:
+            score += 0.1
+        if 'light' in key or 'dark' in key:
+            score -= 0.1
+        return score - 0.01 * len(document.split())
+
+    @staticmethod
+    def describe(resource):
+        ''' Texts a diagram.Resource is matched on: (its name, the last part of its id and its type; the placeholder
+        icon's file name, with known abbreviations spelled out).'''
+        parts = [resource.name or '', str(resource.id or '').split('.')[-1]]
+        if resource.type not in (None, 'custom', 'cluster'):
+            parts.append(resource.type)
+        label = icon_tokens(' '.join(str(part) for part in parts))
+        file_name = os.path.splitext(re.split(r'[\\/]', str(resource.icon or ''))[-1])[0]
+        placeholder = icon_tokens(' '.join(_ABBREVIATIONS.get(token, token) for token in icon_tokens(file_name)))
+        return ' '.join(label), ' '.join(placeholder)
+
+    def candidate_positions(self, allowed_icons=None, providers=None):
+        ''' Key positions a resource may resolve to: the allowed icons if any are given (as the LLM pass is told),
+        otherwise every key of the selected providers, otherwise every key.'''
+        if allowed_icons:
+            return sorted({self.positions[icon] for icon in allowed_icons if icon in self.positions})
+        if providers:
+            positions = []
+            for provider in providers:
+                positions.extend(self.provider_positions.get(PROVIDER_PREFIXES.get(provider, str(provider).lower()), ()))
+            if positions:
+                return sorted(positions)
+        return list(range(len(self.keys)))
+
+    def resolve(self, resources, allowed_icons=None, providers=None):
+        ''' Scores every resource against the candidate keys at once. Returns one (icon key, confidence) per
+        resource; the key is None when nothing shares a word with the resource.'''
+        candidates = self.candidate_positions(allowed_icons, providers)
+        labels, placeholders = zip(*[self.describe(resource) for resource in resources]) if resources else ((), ())
+        queries = [' '.join(filter(None, texts)) for texts in zip(labels, placeholders)]
+        if not queries or not candidates:
+            return [(None, 0.0) for _ in queries]
+
+        # Shortlist: candidates sharing a word with any resource. With an explicit allowed list keep all of them,
+        # the LLM pass would also have picked the closest one.
+        if not allowed_icons:
+            candidate_set = set(candidates)
+            shortlist = set()
+            for query in queries:
+                for token in query.split():
+                    shortlist.update(position for position in self.token_index.get(token, ()) if position in candidate_set)
+            candidates = sorted(shortlist)
+            if not candidates:
+                return [(None, 0.0) for _ in queries]
+
+        documents = [self.documents[position] for position in candidates]
+        # token_set_ratio rewards a service name fully contained in the description ("Lambda (Inventory Alerts)");
+        # token_sort_ratio penalises the extra words so "Web" does not match every web-something key equally
+        scores = 0.7 * process.cdist(labels, documents, scorer=fuzz.token_set_ratio, workers=-1)
+        scores += 0.3 * process.cdist(labels, documents, scorer=fuzz.token_sort_ratio, workers=-1)
+        # The file name has to name the service, not merely be part of it: sqs.svg says nothing for "iot events"
+        # and s3.svg little for "s3 storage lens"
+        placeholder_rows = numpy.asarray([bool(placeholder) for placeholder in placeholders])
+        if placeholder_rows.any():
+            placeholder_scores = process.cdist(placeholders, documents, scorer=fuzz.token_sort_ratio, workers=-1)
+            scores[placeholder_rows] = (PLACEHOLDER_WEIGHT * placeholder_scores[placeholder_rows]
+                                        + (1 - PLACEHOLDER_WEIGHT) * scores[placeholder_rows])
+        best = (scores + numpy.asarray([self.preference[position] for position in candidates])).argmax(axis=1)
+        results = []
+        for row, query in enumerate(queries):
+            if not query:
+                results.append((None, 0.0))
+            else:
+                results.append((self.keys[candidates[best[row]]], round(float(scores[row, best[row]]) / 100, 3)))
+        return results
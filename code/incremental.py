@@ -0,0 +1,181 @@
+import hashlib
+
+from lxml import etree
+
+from backend import SVGTransformer, IconSVGCache, STRAY_AMPERSAND, SVG_NAMESPACE, XLINK_HREF, render_built
+from cache import RenderCache
+from diagram import Diagram
+from dot_builder import DotBuilder, attr_list
+from instrumentation import span, count
+
+# Incremental re-render for sessions that render one diagram many times (Submit, Regenerate, small edits):
+#
+#   svg, state = render_incremental(diagram, previous=session.render_state)
+#
+# The DOT built for the new diagram is compared with the previous one. If it is the same, the previous SVG is returned.
+# If only layout-neutral attributes changed (node labels with the same number of lines, icons with the same aspect
+# ratio, edge colours), the previous dot output is patched in place and dot is not run. Anything else is laid out
+# again. Icon bodies come from IconSVGCache either way, so unchanged icons are never parsed twice.
+
+ASPECT_TOLERANCE = 0.01
+
+class RenderState:
+    ''' What a session keeps of its last render. local_svg (the dot output, icons still referenced by path) is None
+    when the SVG came from the render cache; the next change is then laid out again.'''
+    __slots__ = ('dot_source', 'layout_key', 'elements', 'local_svg', 'svg', 'use_symbols', 'fan_out')
+
+    def __init__(self, dot_source, layout_key, elements, local_svg, svg, use_symbols, fan_out):
+        self.dot_source = dot_source
+        self.layout_key = layout_key
+        self.elements = elements
+        self.local_svg = local_svg
+        self.svg = svg
+        self.use_symbols = use_symbols
+        self.fan_out = fan_out
+
+def patchable_label(label):
+    # Labels with escapes (\l, \N, ...) are left to dot
+    return '\\' not in str(label)
+
+def patchable_color(color):
+    # A colour list (a:b) draws parallel edges, which is layout work
+    return ':' not in str(color)
+
+def layout_attrs(kind:str, attrs:dict):
+    ''' The attributes of a node or edge that can move anything: labels count only by their number of lines, icons
+    and edge colours not at all.'''
+    attrs = dict(attrs)
+    if kind == 'node':
+        attrs.pop('image', None)
+        if 'label' in attrs and patchable_label(attrs['label']):
+            attrs['label'] = str(attrs['label']).count('\n') + 1
+    elif 'color' in attrs and patchable_color(attrs['color']):
+        del attrs['color']
+    return attrs
+
+def layout_key(builder:DotBuilder):
+    lines = list(builder.lines)
+    for position, kind, name, attrs in builder.elements:
+        lines[position] = f'{kind} {name} {attr_list(layout_attrs(kind, attrs))}'
+    return hashlib.sha256('\n'.join(lines).encode('utf-8')).hexdigest()
+
+def svg_elements(root):
+    ''' {(kind, title, occurrence): <g>} of the nodes and edges in a Graphviz SVG. Repeated edges between the same
+    two nodes are told apart by their order, which follows the DOT source.'''
+    found = {}
+    seen = {}
+    for group in root.iter(SVG_NAMESPACE + 'g'):
+        kind = group.get('class')
+        if kind not in ('node', 'edge'):
+            continue
+        title = group.findtext(SVG_NAMESPACE + 'title')
+        occurrence = seen.get((kind, title), 0)
+        seen[(kind, title)] = occurrence + 1
+        found[(kind, title, occurrence)] = group
+    return found
+
+def same_aspect(old_path, new_path):
+    if not (IconSVGCache.exists(old_path) and IconSVGCache.exists(new_path)):
+        return False
+    old_icon = IconSVGCache.get(old_path)
+    new_icon = IconSVGCache.get(new_path)
+    if not (old_icon.width and old_icon.height and new_icon.width and new_icon.height):
+        return False
+    return abs(old_icon.width / old_icon.height - new_icon.width / new_icon.height) <= ASPECT_TOLERANCE * old_icon.width / old_icon.height
+
+def patch_node(group, old_attrs, new_attrs):
+    if old_attrs.get('label') != new_attrs.get('label'):
+        lines = str(new_attrs.get('label', '')).split('\n')
+        texts = group.findall(SVG_NAMESPACE + 'text')
+        if len(texts) != len(lines):
+            return False
+        for text, line in zip(texts, lines):
+            text.text = line
+    if old_attrs.get('image') != new_attrs.get('image'):
+        image = group.find(SVG_NAMESPACE + 'image')
+        if image is None or not same_aspect(old_attrs.get('image'), new_attrs.get('image')):
+            return False
+        image.set(XLINK_HREF, new_attrs['image'])
+    return True
+
+def patch_edge(group, new_attrs):
+    color = new_attrs.get('color')
+    if color is None:
+        # Back to the diagram's default edge colour, which is not known here
+        return False
+    for element in group:
+        if element.tag == SVG_NAMESPACE + 'path':
+            element.set('stroke', color)
+        elif element.tag == SVG_NAMESPACE + 'polygon':
+            # Arrowheads
+            element.set('stroke', color)
+            if element.get('fill') not in (None, 'none'):
+                element.set('fill', color)
+    return True
+
+def patch_svg(previous:RenderState, builder:DotBuilder):
+    ''' The previous dot output with the changed labels, icons and edge colours of builder applied, or None if a change
+    cannot be patched (dot lays the diagram out again then).'''
+    changes = []
+    occurrences = {}
+    for (_, kind, name, old_attrs), (_, _, _, new_attrs) in zip(previous.elements, builder.elements):
+        title = name if kind == 'node' else f'{name[0]}->{name[1]}'
+        occurrence = occurrences.get((kind, title), 0)
+        occurrences[(kind, title)] = occurrence + 1
+        if old_attrs != new_attrs:
+            changes.append(((kind, title, occurrence), old_attrs, new_attrs))
+    if not changes:
+        return previous.local_svg
+
+    parser = etree.XMLParser(recover=True, huge_tree=True)
+    root = etree.fromstring(STRAY_AMPERSAND.sub('&amp;', previous.local_svg).encode('UTF-8'), parser)
+    groups = svg_elements(root)
+    for key, old_attrs, new_attrs in changes:
+        group = groups.get(key)
+        if group is None:
+            return None
+        patched = patch_node(group, old_attrs, new_attrs) if key[0] == 'node' else patch_edge(group, new_attrs)
+        if not patched:
+            return None
+    count('render.patched_elements', len(changes))
+    return etree.tostring(root, encoding='unicode')
+
+def render_incremental(diagram, previous:RenderState = None, use_symbols:bool = False, fan_out:str = None,
+                       cache:RenderCache = None):
+    ''' Renders a resolved diagram (a Diagram or YAML text) like render_svg_from_yaml, reusing what it can of the previous render of the same
+    session. Returns (svg, state to pass as previous next time).'''
+    cache = cache or RenderCache.default()
+    with span('pipeline.render_incremental', use_symbols=use_symbols) as current:
+        diagram = Diagram.coerce(diagram)
+        # Same key as render_svg_from_yaml, so both share the render cache
+        cache_key = RenderCache.key_for(diagram, use_symbols=use_symbols, fan_out=fan_out)
+        with span('pipeline.build_dot') as build_span:
+            builder = DotBuilder(diagram, fan_out=fan_out)
+            dot_source = builder.build()
+            build_span.set(dot_bytes=len(dot_source))
+        key = layout_key(builder)
+
+        mode = 'layout'
+        local_svg = None
+        svg = None
+        if previous is not None and previous.fan_out == fan_out:
+            if previous.dot_source == dot_source and previous.use_symbols == use_symbols:
+                mode, local_svg, svg = 'unchanged', previous.local_svg, previous.svg
+            elif previous.layout_key == key and previous.local_svg is not None:
+                local_svg = patch_svg(previous, builder)
+                if local_svg is not None:
+                    mode = 'patched'
+        if mode == 'layout':
+            svg = cache.get(cache_key)
+            if svg is not None:
+                mode = 'cached'
+            else:
+                local_svg = render_built(builder, dot_source)
+                svg = SVGTransformer.get_svg_code(local_svg, use_symbols=use_symbols)
+                cache.put(cache_key, svg)
+        elif mode == 'patched':
+            svg = SVGTransformer.get_svg_code(local_svg, use_symbols=use_symbols)
+            cache.put(cache_key, svg)
+        current.set(mode=mode)
+        count('render.incremental', mode=mode)
+    return svg, RenderState(dot_source, key, builder.elements, local_svg, svg, use_symbols, fan_out)
@@ -0,0 +1,251 @@
+import contextvars
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+# Spans time pipeline stages and LLM calls, counters count cache hits, icon fallbacks, dot exit statuses and the like.
+# Both are no-ops until instrumentation is enabled: span() then returns a shared do-nothing context manager and
+# count() returns after one attribute check.
+#
+#   with span('graphviz.dot', format='svg') as current:
+#       ...
+#       current.set(exit_status=0)
+#   count('render_cache.hit')
+#
+# Enable from code with Instrumentation.configure([RingBufferExporter(), PrometheusExporter()]) or by setting
+# ORCHESTREE_INSTRUMENTATION to a comma-separated list of exporters: log, ring, prometheus. Diagnostic messages (event())
+# and token usage go to the 'orchestree' logger, which prints from ORCHESTREE_LOG_LEVEL up (INFO when the log exporter
+# is on; otherwise it is left to the application's logging setup).
+
+logger = logging.getLogger('orchestree')
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+def attach_handler(target:logging.Logger, level, log_format:str = LOG_FORMAT):   # Helper function making a logger print at level on stderr
+    ''' Sets the logger's level and, unless it already has a handler, gives it one writing to stderr. Such a logger no
+    longer propagates, so nothing is printed twice.'''
+    target.setLevel(level)
+    if not target.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(log_format))
+        target.addHandler(handler)
+        target.propagate = False
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+NO_SPAN = _NoSpan()
+
+_current_span = contextvars.ContextVar('orchestree_span', default=None)
+_span_ids = itertools.count(1)
+
+class Span:
+    __slots__ = ('name', 'attributes', 'span_id', 'parent_id', 'started', 'start_time', 'duration', 'status', '_token')
+
+    def __init__(self, name:str, attributes:dict):
+        self.name = name
+        self.attributes = attributes
+        self.span_id = next(_span_ids)
+        self.parent_id = None
+        self.status = 'ok'
+        self.duration = None
+
+    def __enter__(self):
+        parent = _current_span.get()
+        self.parent_id = parent.span_id if parent is not None else None
+        self._token = _current_span.set(self)
+        self.start_time = time.time()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.duration = time.perf_counter() - self.started
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.status = 'error'
+            self.attributes['error'] = f'{exc_type.__name__}: {exc}'
+        Instrumentation.export(self.record())
+        return False
+
+    def set(self, **attributes):
+        ''' Adds attributes discovered while the span runs (sizes, statuses, counts).'''
+        self.attributes.update(attributes)
+
+    def record(self):
+        return {'type': 'span', 'name': self.name, 'span_id': self.span_id, 'parent_id': self.parent_id,
+                'start': self.start_time, 'duration_ms': round(self.duration * 1000, 3), 'status': self.status,
+                'attributes': self.attributes}
+
+class Instrumentation:
+    ''' Process-wide switch, counters and exporters.'''
+    enabled = False
+    exporters = []
+    counters = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, exporters):
+        ''' Enables instrumentation with the given exporters (replacing any previous ones).'''
+        cls.exporters = list(exporters)
+        cls.enabled = True
+
+    @classmethod
+    def disable(cls):
+        cls.enabled = False
+        cls.exporters = []
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls.counters = {}
+
+    @classmethod
+    def export(cls, record:dict):
+        for exporter in cls.exporters:
+            try:
+                exporter.export(record)
+            except Exception as e:
+                # A broken exporter must never break a render
+                logger.warning(f"Instrumentation exporter {type(exporter).__name__} failed: {e}")
+
+    @classmethod
+    def increment(cls, name:str, value, labels:dict):
+        key = (name, tuple(sorted(labels.items())))
+        with cls._lock:
+            cls.counters[key] = cls.counters.get(key, 0) + value
+
+    @classmethod
+    def counter_values(cls):
+        ''' Snapshot {(name, ((label, value), ...)): total}.'''
+        with cls._lock:
+            return dict(cls.counters)
+
+    @classmethod
+    def from_environment(cls, value:str = None):
+        value = os.environ.get('ORCHESTREE_INSTRUMENTATION', '') if value is None else value
+        factories = {'log': LogExporter, 'ring': RingBufferExporter, 'prometheus': PrometheusExporter}
+        names = [name.strip() for name in value.split(',')]
+        log_level = os.environ.get('ORCHESTREE_LOG_LEVEL', 'INFO' if 'log' in names else '')
+        if log_level:
+            attach_handler(logger, log_level.upper())
+        exporters = [factories[name]() for name in names if name in factories]
+        if exporters:
+            cls.configure(exporters)
+
+    @classmethod
+    def exporter(cls, exporter_type):
+        ''' The first configured exporter of the given type, or None.'''
+        return next((exporter for exporter in cls.exporters if isinstance(exporter, exporter_type)), None)
+
+def span(name:str, **attributes):
+    ''' Context manager timing the enclosed block. Nested spans (also across await) record their parent.'''
+    if not Instrumentation.enabled:
+        return NO_SPAN
+    return Span(name, attributes)
+
+def count(name:str, value = 1, **labels):
+    if Instrumentation.enabled:
+        Instrumentation.increment(name, value, labels)
+
+def event(level:int, message:str, **attributes):
+    ''' Diagnostic message. Goes to the 'orchestree' logger, and to the exporters as a record when enabled.'''
+    logger.log(level, message)
+    if Instrumentation.enabled:
+        Instrumentation.export({'type': 'event', 'level': logging.getLevelName(level), 'message': message,
+                                'time': time.time(), 'attributes': attributes})
+
+class LogExporter:
+    ''' Writes every record as one JSON line to a logger.'''
+
+    def __init__(self, logger_name:str = 'orchestree.trace', level:int = logging.INFO):
+        self.logger = logging.getLogger(logger_name)
+        self.level = level
+        # Bare JSON lines, printed even though the root logger is left at WARNING
+        attach_handler(self.logger, level, '%(message)s')
+
+    def export(self, record:dict):
+        self.logger.log(self.level, json.dumps(record, default=str))
+
+class RingBufferExporter:
+    ''' Keeps the last maxlen records in memory, e.g. for a debug page or a test.'''
+
+    def __init__(self, maxlen:int = 2000):
+        self.buffer = deque(maxlen=maxlen)
+
+    def export(self, record:dict):
+        self.buffer.append(record)
+
+    def records(self, name:str = None):
+        return [record for record in list(self.buffer) if name is None or record.get('name') == name]
+
+class PrometheusExporter:
+    ''' Aggregates span durations into histograms and renders them, with all counters, in the Prometheus text format.'''
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, prefix:str = 'orchestree'):
+        self.prefix = prefix
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def export(self, record:dict):
+        if record['type'] != 'span':
+            return
+        seconds = record['duration_ms'] / 1000
+        key = (record['name'], record['status'])
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.BUCKETS), 0, 0.0]
+            for position, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[0][position] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+
+    @staticmethod
+    def metric_name(name:str):
+        return ''.join(character if character.isalnum() else '_' for character in name)
+
+    @staticmethod
+    def label_text(labels):
+        if not labels:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+    def render(self):
+        lines = []
+        counters = {}
+        for (name, labels), value in Instrumentation.counter_values().items():
+            counters.setdefault(name, []).append((labels, value))
+        for name in sorted(counters):
+            metric = f'{self.prefix}_{self.metric_name(name)}_total'
+            lines.append(f'# TYPE {metric} counter')
+            for labels, value in counters[name]:
+                lines.append(f'{metric}{self.label_text(labels)} {value}')
+        metric = f'{self.prefix}_span_duration_seconds'
+        lines.append(f'# TYPE {metric} histogram')
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+        for (name, status), (buckets, total_count, total_sum) in histograms:
+            labels = f'span="{name}",status="{status}"'
+            for bound, bucket_count in zip(self.BUCKETS, buckets):
+                lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {bucket_count}')
+            lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {total_count}')
+            lines.append(f'{metric}_count{{{labels}}} {total_count}')
+            lines.append(f'{metric}_sum{{{labels}}} {round(total_sum, 6)}')
+        return '\n'.join(lines) + '\n'
+
+Instrumentation.from_environment()
@@ -0,0 +1,93 @@
+from lxml import etree
+
+# Diagrams made of several systems with no relation between them are laid out one part per dot worker at the same
+# time (DotBuilder.parts) and the parts' SVGs are packed into one document here, the way gvpack packs components:
+#
+#   svg = pack_svgs([renderer.render(part) for part in builder.parts(4)], builder.graph_attrs)
+#
+# Parts are stacked across the rank direction (top to bottom for left-to-right diagrams, left to right for
+# top-to-bottom ones), centred, in the order DotBuilder returns them, so re-rendering a diagram puts every part
+# in the same place. The diagram's padding, background and label go around the packed parts.
+
+PACK_MIN_NODES = 100    # Smaller diagrams are laid out in one dot job: below this the split does not pay for itself
+PART_GAP = 36.0         # Points between packed parts
+
+SVG_NS = 'http://www.w3.org/2000/svg'
+XLINK_NS = 'http://www.w3.org/1999/xlink'
+
+def points(value, default:float = 0.0) -> float:   # Helper function reading an SVG length such as '812pt'
+    try:
+        return float(str(value).strip().rstrip('ptx'))
+    except (TypeError, ValueError):
+        return default
+
+def pad_points(pad) -> float:   # Helper function: Graphviz pad is in inches, optionally 'x,y'; dot's own default is 4 points
+    if pad is None:
+        return 4.0
+    return points(str(pad).split(',')[0], 4.0 / 72) * 72
+
+def part_box(root):
+    ''' (min x, min y, width, height) of a part's drawing, from its viewBox or else its width and height.'''
+    view_box = (root.get('viewBox') or '').replace(',', ' ').split()
+    if len(view_box) == 4:
+        return tuple(points(value) for value in view_box)
+    return 0.0, 0.0, points(root.get('width')), points(root.get('height'))
+
+def pack_svgs(svgs, graph_attrs:dict) -> str:
+    ''' One SVG holding the Graphviz SVGs of a diagram's parts (well-formed: stray '&' already escaped). Each part's
+    graph group is moved in whole under a translate, so node and edge groups keep their titles and ids get a
+    per-part prefix to stay unique.'''
+    parser = etree.XMLParser(recover=True, huge_tree=True, remove_comments=True)
+    roots = [etree.fromstring(svg.encode('UTF-8'), parser) for svg in svgs]
+    boxes = [part_box(root) for root in roots]
+    across = graph_attrs.get('rankdir', 'TB') in ('LR', 'RL')
+    pad = pad_points(graph_attrs.get('pad'))
+    label = str(graph_attrs.get('label') or '')
+    font_size = points(graph_attrs.get('fontsize'), 14.0)
+    label_height = font_size * 1.5 if label else 0.0
+
+    if across:
+        inner_width = max(box[2] for box in boxes)
+        inner_height = sum(box[3] for box in boxes) + PART_GAP * (len(boxes) - 1)
+    else:
+        inner_width = sum(box[2] for box in boxes) + PART_GAP * (len(boxes) - 1)
+        inner_height = max(box[3] for box in boxes)
+    width = inner_width + 2 * pad
+    height = inner_height + label_height + 2 * pad
+
+    packed = etree.Element(f'{{{SVG_NS}}}svg', nsmap={None: SVG_NS, 'xlink': XLINK_NS},
+                           width=f'{width:.0f}pt', height=f'{height:.0f}pt', viewBox=f'0.00 0.00 {width:.2f} {height:.2f}')
+    graph = etree.SubElement(packed, f'{{{SVG_NS}}}g', id='graph0', attrib={'class': 'graph'})
+    etree.SubElement(graph, f'{{{SVG_NS}}}title').text = label
+    etree.SubElement(graph, f'{{{SVG_NS}}}polygon', fill=str(graph_attrs.get('bgcolor', 'white')), stroke='none',
+                     points=f'0,0 {width:.2f},0 {width:.2f},{height:.2f} 0,{height:.2f} 0,0')
+
+    offset = pad
+    for number, (root, (min_x, min_y, part_width, part_height)) in enumerate(zip(roots, boxes), 1):
+        if across:
+            x, y = pad + (inner_width - part_width) / 2, offset
+            offset += part_height + PART_GAP
+        else:
+            x, y = offset, pad + (inner_height - part_height) / 2
+            offset += part_width + PART_GAP
+        for element in root.iter():
+            if element.get('id') is not None:
+                element.set('id', f'part{number}_{element.get("id")}')
+        for child in root:
+            if child.tag == f'{{{SVG_NS}}}g':
+                # Outer translate, then the part's own transform (dot's translate into its viewBox)
+                transform = f'translate({x - min_x:.2f} {y - min_y:.2f})'
+                child.set('transform', f'{transform} {child.get("transform")}' if child.get('transform') else transform)
+                title = child.find(f'{{{SVG_NS}}}title')
+                if title is not None:
+                    child.remove(title)
+            graph.append(child)
+
+    if label:
+        text = etree.SubElement(graph, f'{{{SVG_NS}}}text', attrib={'text-anchor': 'middle'}, x=f'{width / 2:.2f}',
+                                y=f'{height - pad - font_size * 0.4:.2f}', fill=str(graph_attrs.get('fontcolor', 'black')))
+        text.set('font-family', str(graph_attrs.get('fontname', 'Times,serif')))
+        text.set('font-size', f'{font_size:.2f}')
+        text.text = label
+    etree.cleanup_namespaces(packed)
+    return '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n' + etree.tostring(packed, encoding='unicode')
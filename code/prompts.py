@@ -0,0 +1,36 @@
+# What the LLM passes are sent after their system prompt. The form answers and the allowed icon list used to go out
+# as Python reprs (str(dict), str(list)): quotes, brackets, escaped newlines and repeated icons are all input tokens,
+# paid again on every request. Here they are written as labelled plain text, each icon once, one per line.
+#
+#   input_data = form_prompt(form)                      # first pass, after base_prompt.txt
+#   cloud_icons = icons_prompt(form["resources"])       # second pass, after the YAML whose icons are replaced
+
+FORM_FIELDS = (
+    ("title", "Title"),
+    ("cloud_providers", "Cloud providers"),
+    ("resources", "Resources"),
+    ("cluster_description", "Clustering"),
+    ("relationships_description", "Relationships"),
+)
+
+def unique(items):   # Helper function: non-blank items as text, in first-seen order, each once
+    return list(dict.fromkeys(text for text in (str(item).strip() for item in items or ()) if text))
+
+def form_prompt(form:dict) -> str:
+    ''' The form answers (batch.form_input field names) as the first pass reads them.'''
+    lines = []
+    for key, label in FORM_FIELDS:
+        value = form.get(key)
+        if key == "resources":
+            lines.append(f"{label}:")
+            lines.extend(f"- {icon}" for icon in unique(value))
+        elif key == "cloud_providers":
+            lines.append(f"{label}: {', '.join(unique(value))}")
+        else:
+            text = str(value or '').strip()
+            lines.append(f"{label}:\n{text}" if '\n' in text else f"{label}: {text}")
+    return '\n'.join(lines)
+
+def icons_prompt(icons) -> str:
+    ''' The allowed icon list of the second pass, appended to the YAML it edits.'''
+    return "\nAllowed icons:\n" + '\n'.join(unique(icons))
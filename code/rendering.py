@@ -0,0 +1,208 @@
+import asyncio
+import contextvars
+import os
+import signal
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import span, count
+
+class RenderError(RuntimeError):
+    """Graphviz failed to render a graph."""
+
+class RenderTimeout(RenderError):
+    """A render job ran longer than its timeout and was killed."""
+
+class RenderQueueFull(RenderError):
+    """Too many render jobs are already queued or running."""
+
+class RenderCancelled(RenderError):
+    """A render job was cancelled before it finished."""
+
+# Seconds a render waits for a free slot before RenderQueueFull: long enough to ride out a burst of renders from other
+# sessions, short enough that a stuck pool is reported instead of hanging the page
+QUEUE_TIMEOUT = 10.0
+
+class RenderJob:
+    ''' One Graphviz invocation. Holds the running dot process so the job can be cancelled from another thread.'''
+
+    def __init__(self, dot_source:str, output_format:str, timeout):
+        self.dot_source = dot_source
+        self.output_format = output_format
+        self.timeout = timeout
+        self.process = None
+        self.cancelled = False
+        self.returncode = None
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if self.process is not None and self.process.poll() is None:
+                self.kill()
+
+    def kill(self):
+        # dot runs in its own process group so anything it spawned goes down with it
+        if hasattr(os, 'killpg'):
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+                return
+            except ProcessLookupError:
+                return
+        self.process.kill()
+
+    def run_subprocess(self, command):
+        with self._lock:
+            if self.cancelled:
+                raise RenderCancelled("Render job cancelled before it started")
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                            start_new_session=hasattr(os, 'killpg'))
+        try:
+            stdout, stderr = self.process.communicate(self.dot_source.encode('utf-8'), timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            self.kill()
+            self.process.communicate()
+            self.returncode = self.process.returncode
+            raise RenderTimeout(f"dot did not finish within {self.timeout} seconds")
+        self.returncode = self.process.returncode
+        if self.cancelled:
+            raise RenderCancelled("Render job cancelled while running")
+        if self.process.returncode != 0:
+            raise RenderError(f"dot exited with status {self.process.returncode}: {stderr.decode('utf-8', 'replace').strip()}")
+        return stdout.decode('utf-8')
+
+    def run_library(self):
+        # In-process layout through the Graphviz C library. Cannot be interrupted, so timeouts do not apply.
+        import pygraphviz
+        graph = pygraphviz.AGraph(string=self.dot_source)
+        self.returncode = 0
+        return graph.draw(format=self.output_format, prog='dot').decode('utf-8')
+
+class GraphvizRenderer:
+    ''' Runs dot jobs on a bounded pool of worker threads, each driving one dot subprocess at a time. Limits how many
+    jobs may be queued (backpressure), kills jobs that exceed their timeout, and supports cancellation. Optionally
+    renders in-process through pygraphviz when it is installed and use_library is set.'''
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_workers:int = None, max_pending:int = None, timeout:float = 60.0, queue_timeout:float = QUEUE_TIMEOUT,
+                 dot_binary:str = 'dot', use_library:bool = False):
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.max_pending = max_pending or self.max_workers * 4
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.dot_binary = dot_binary
+        self.use_library = use_library and GraphvizRenderer.library_available()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='graphviz')
+
+    @classmethod
+    def default(cls):
+        ''' Process-wide renderer shared by every session.'''
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def configure(cls, **kwargs):
+        ''' Replaces the process-wide renderer, e.g. to size it for a batch worker process.'''
+        with cls._instance_lock:
+            previous, cls._instance = cls._instance, cls(**kwargs)
+        if previous is not None:
+            previous.shutdown(wait=False)
+        return cls._instance
+
+    @staticmethod
+    def library_available() -> bool:
+        try:
+            import pygraphviz  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def submit(self, dot_source:str, output_format:str = 'svg', timeout:float = None, queue_timeout:float = None):
+        ''' Queues a render and returns a Future whose .job can be cancelled. Raises RenderQueueFull when
+        max_pending jobs are already waiting or running and no slot frees up within queue_timeout (the renderer's
+        own unless given; 0 fails at once).'''
+        queue_timeout = self.queue_timeout if queue_timeout is None else queue_timeout
+        if queue_timeout:
+            acquired = self._slots.acquire(timeout=queue_timeout)
+        else:
+            acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            count('graphviz.queue_full')
+            raise RenderQueueFull(f"More than {self.max_pending} render jobs pending")
+        job = RenderJob(dot_source, output_format, self.timeout if timeout is None else timeout)
+        try:
+            # The caller's context goes along so the dot span nests under the caller's span
+            future = self._executor.submit(contextvars.copy_context().run, self._run, job)
+        except Exception:
+            self._slots.release()
+            raise
+        future.job = job
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _run(self, job:RenderJob):
+        with span('graphviz.dot', format=job.output_format, library=self.use_library, dot_bytes=len(job.dot_source)) as current:
+            status = None
+            try:
+                if self.use_library:
+                    return job.run_library()
+                return job.run_subprocess([self.dot_binary, f'-T{job.output_format}'])
+            except RenderTimeout:
+                status = 'timeout'
+                raise
+            except RenderCancelled:
+                status = 'cancelled'
+                raise
+            finally:
+                # dot's exit status, or why there is none
+                if status is None:
+                    status = job.returncode if job.returncode is not None else ('library' if self.use_library else 'failed')
+                current.set(exit_status=status)
+                count('graphviz.dot_exit', status=status)
+
+    def render(self, dot_source:str, output_format:str = 'svg', timeout:float = None) -> str:
+        ''' Blocking render. Returns the output document as text.'''
+        future = self.submit(dot_source, output_format=output_format, timeout=timeout)
+        try:
+            return future.result()
+        except BaseException:
+            # The caller gave up (e.g. KeyboardInterrupt or a Streamlit rerun): do not leave dot running
+            if not future.done():
+                future.cancel()
+                future.job.cancel()
+            raise
+
+    def render_many(self, dot_sources, output_format:str = 'svg', timeout:float = None, queue_timeout:float = None) -> list:
+        ''' Blocking render of several graphs at once, each on its own worker. Returns the outputs in order. If one
+        fails or the caller gives up, the others are cancelled.'''
+        futures = []
+        try:
+            for dot_source in dot_sources:
+                futures.append(self.submit(dot_source, output_format=output_format, timeout=timeout, queue_timeout=queue_timeout))
+            return [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                if not future.done():
+                    future.cancel()
+                    future.job.cancel()
+            raise
+
+    async def render_async(self, dot_source:str, output_format:str = 'svg', timeout:float = None) -> str:
+        ''' Awaitable render. Cancelling the awaiting task kills the dot process.'''
+        # Waiting for a free slot blocks, so it happens off the event loop
+        future = await asyncio.to_thread(self.submit, dot_source, output_format, timeout)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            future.cancel()
+            future.job.cancel()
+            raise
+
+    def shutdown(self, wait:bool = True):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
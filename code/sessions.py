@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+import uuid
+
+from instrumentation import count, event
+
+# Per-session render state of the Streamlit app, owned by one process-wide registry instead of st.session_state so it
+# can be freed from outside the session. Streamlit gives no signal when a browser tab goes away (the old beforeunload
+# POST to /clean-up had nothing answering it), so a reaper thread frees every session idle for longer than
+# idle_timeout; a session that comes back afterwards starts from the form again.
+#
+#   session = SessionRegistry.default().open(st.session_state.get("session"))
+#   session.output = svg
+
+IDLE_TIMEOUT = 30 * 60      # Seconds without interaction before a session's SVGs and render state are freed
+REAP_INTERVAL = 60
+
+class Session:
+    __slots__ = ('session_id', 'last_interaction', 'input_data', 'diagram', 'output', 'preview', 'inline_output',
+                 'render_state', 'known_icons', 'reaped')
+
+    def __init__(self):
+        self.session_id = uuid.uuid4().hex
+        self.last_interaction = time.time()
+        self.reaped = False
+        self.clear()
+
+    def clear(self):
+        ''' Drops everything the session rendered; it shows the empty form again.'''
+        self.input_data = None
+        self.diagram = None         # diagram.Diagram with icon paths, input of the render
+        self.output = None          # Full SVG of the last render, icons referenced through <use>
+        self.preview = None         # What the page shows, see SVGTransformer.preview_svg
+        self.inline_output = None   # Same diagram with every icon copied inline, built on request
+        self.render_state = None    # incremental.RenderState of the last render
+        self.known_icons = {}       # Resolved icons, see stream_resolved_diagram
+
+    def touch(self):
+        self.last_interaction = time.time()
+
+    @property
+    def size(self):
+        ''' Approximate bytes held, counting the SVG strings only.'''
+        state = self.render_state
+        held = len(self.output or '') + len(self.inline_output or '')
+        if self.preview is not self.output:
+            held += len(self.preview or '')
+        if state is not None:
+            held += len(state.local_svg or '') + (len(state.svg) if state.svg is not self.output else 0)
+        return held
+
+class SessionRegistry:
+    ''' Process-wide registry of the live sessions, with a daemon thread reaping the idle ones.'''
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, idle_timeout:float = IDLE_TIMEOUT, reap_interval:float = REAP_INTERVAL):
+        self.idle_timeout = idle_timeout
+        self.reap_interval = reap_interval
+        self.sessions = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._reaper = None
+
+    @classmethod
+    def default(cls):
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+                    cls._instance.start()
+        return cls._instance
+
+    @classmethod
+    def configure(cls, **kwargs):
+        ''' Replaces the default registry (e.g. with another idle_timeout); sessions of the old one are kept.'''
+        with cls._instance_lock:
+            registry = cls(**kwargs)
+            if cls._instance is not None:
+                cls._instance.stop()
+                registry.sessions = dict(cls._instance.sessions)
+            registry.start()
+            cls._instance = registry
+        return registry
+
+    def open(self, session:Session = None):
+        ''' The given session, registered again if it was reaped, or a new one. Counts as an interaction.'''
+        if session is None:
+            session = Session()
+        with self._lock:
+            if self.sessions.get(session.session_id) is not session:
+                self.sessions[session.session_id] = session
+        session.reaped = False
+        session.touch()
+        return session
+
+    def close(self, session:Session):
+        ''' Frees a session right away (Restart).'''
+        session.clear()
+        with self._lock:
+            self.sessions.pop(session.session_id, None)
+
+    def reap(self, now:float = None):
+        ''' Frees and forgets every session idle for longer than idle_timeout. Returns how many were reaped.'''
+        now = time.time() if now is None else now
+        with self._lock:
+            idle = [session for session in self.sessions.values() if now - session.last_interaction > self.idle_timeout]
+            for session in idle:
+                del self.sessions[session.session_id]
+        freed = 0
+        for session in idle:
+            freed += session.size
+            session.clear()
+            session.reaped = True
+        if idle:
+            count('sessions.reaped', len(idle))
+            event(logging.INFO, f"Reaped {len(idle)} idle sessions, about {freed / 1024 / 1024:.1f} MB of SVG freed",
+                  sessions=len(idle), freed_bytes=freed)
+        return len(idle)
+
+    def start(self):
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._run, name='session-reaper', daemon=True)
+            self._reaper.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.reap_interval):
+            try:
+                self.reap()
+            except Exception as e:
+                event(logging.WARNING, f"Session reaper failed: {e}")
@@ -1,48 +1,158 @@
-from openai import OpenAI
-import streamlit as st
+import hashlib
+import threading
+from contextlib import contextmanager
 
-import google.generativeai as genai
+# Provider SDKs (openai, google.generativeai) and streamlit secrets are only imported when a client of that provider
+# is first requested, so importing this module costs nothing and unused backends are never initialised.
 
 class TokenException(Exception):
         """Exception for handling invalid or expired tokens."""
 pass
 
+GEMINI_MODEL_NAME = 'gemini-2.0-flash-exp'
+
+def read_secret(name:str):
+    import streamlit as st
+    return st.secrets[name]
+
+class ProviderRegistry:
+    ''' Registry of LLM provider client factories. A factory is called the first time its provider is requested and
+    the client is kept for the life of the process. Keyed providers (BYOK) keep one client per API key.'''
+    _factories = {}
+    _clients = {}
+    _lock = threading.RLock()
+    max_keyed_clients = 64
+
+    @classmethod
+    def register(cls, name:str, factory, keyed:bool = False):
+        with cls._lock:
+            cls._factories[name] = (factory, keyed)
+
+    @classmethod
+    def providers(cls):
+        return list(cls._factories)
+
+    @classmethod
+    def get(cls, name:str, api_key:str = None):
+        if name not in cls._factories:
+            raise KeyError(f"Unknown LLM provider '{name}'. Registered: {', '.join(cls._factories)}")
+        factory, keyed = cls._factories[name]
+        if keyed:
+            if not api_key:
+                raise TokenException(f"Provider '{name}' needs an API key")
+            # Hash the key so raw keys are not used as dictionary keys
+            client_key = (name, hashlib.sha256(api_key.encode('utf-8')).hexdigest())
+        else:
+            client_key = (name, None)
+        client = cls._clients.get(client_key)
+        if client is None:
+            with cls._lock:
+                client = cls._clients.get(client_key)
+                if client is None:
+                    client = factory(api_key) if keyed else factory()
+                    if keyed and sum(1 for provider, key in cls._clients if provider == name) >= cls.max_keyed_clients:
+                        # Drop the oldest keyed client of this provider
+                        oldest = next(existing for existing in cls._clients if existing[0] == name)
+                        del cls._clients[oldest]
+                    cls._clients[client_key] = client
+        return client
+
+    @classmethod
+    def reset(cls, name:str = None):
+        with cls._lock:
+            for client_key in [client_key for client_key in cls._clients if name is None or client_key[0] == name]:
+                del cls._clients[client_key]
+
 class OpenAIClientSingleton:
-    _instance = None
 
     @classmethod
     def get_gpt4o_openai_client(cls):
-        if cls._instance is None:
-            api_key = st.secrets['gpt4o_openai_api_key']
-            api_organization_id = st.secrets['org_id']
-            cls._instance = OpenAI(api_key = api_key, organization= api_organization_id)
-        return cls._instance
+        return ProviderRegistry.get('openai')
+
+    @staticmethod
+    def create():
+        from openai import OpenAI
+        api_key = read_secret('gpt4o_openai_api_key')
+        api_organization_id = read_secret('org_id')
+        return OpenAI(api_key = api_key, organization= api_organization_id)
+
+class GeminiModel:
+     ''' A GenerativeModel used with one API key. genai.configure() is process-global and a model takes its client from
+     it on its first call, so that call is made while the key is configured (see GoogleGeminiClientSingleton.using_key);
+     later calls go straight to the SDK.'''
+     __slots__ = ('model', 'api_key', 'bound')
+
+     def __init__(self, model, api_key:str):
+          self.model = model
+          self.api_key = api_key
+          self.bound = False
+
+     def generate_content(self, *args, **kwargs):
+          if self.bound:
+               return self.model.generate_content(*args, **kwargs)
+          with GoogleGeminiClientSingleton.using_key(self.api_key):
+               response = self.model.generate_content(*args, **kwargs)
+               self.bound = True
+          return response
 
 class GoogleGeminiClientSingleton:
-     _instance = None
+     # Key genai is configured with and number of callers using it; callers with another key wait until it is unused
+     _key_condition = threading.Condition()
+     _configured_key = None
+     _key_users = 0
 
      @classmethod
      def initialise_gemini_client(cls):
-          if cls._instance is None:
-            api_key = st.secrets['google_api_key']
-            genai.configure(api_key=api_key)
-            cls._instance = genai.GenerativeModel('gemini-2.0-flash-exp')
-          return cls._instance
+          return ProviderRegistry.get('gemini')
+
      @classmethod
      def initialise_gemini_client_byok(cls,api_key):
-          if cls._instance is None:
-            genai.configure(api_key=api_key)
-            cls._instance = genai.GenerativeModel('gemini-2.0-flash-exp')
-          return cls._instance
+          return ProviderRegistry.get('gemini_byok', api_key = api_key)
+
+     @classmethod
+     @contextmanager
+     def using_key(cls, api_key:str):
+          ''' Context in which genai's default clients use api_key. Callers with the same key run side by side; a
+          caller with another key waits for them to finish, so only models being set up for different keys wait on
+          each other.'''
+          import google.generativeai as genai
+          with cls._key_condition:
+               while cls._key_users and cls._configured_key != api_key:
+                    cls._key_condition.wait()
+               if cls._configured_key != api_key:
+                    genai.configure(api_key=api_key)
+                    cls._configured_key = api_key
+               cls._key_users += 1
+          try:
+               yield
+          finally:
+               with cls._key_condition:
+                    cls._key_users -= 1
+                    if not cls._key_users:
+                         cls._key_condition.notify_all()
+
+     @classmethod
+     def create(cls, api_key:str = None):
+          import google.generativeai as genai
+          if api_key is None:
+               api_key = read_secret('google_api_key')
+          return GeminiModel(genai.GenerativeModel(GEMINI_MODEL_NAME), api_key)
 
 class LlamaClientSingleton:
-     _instance = None
 
      @classmethod
      def get_llama_openai_client(cls):
+        return ProviderRegistry.get('llama')
+
+     @staticmethod
+     def create():
         # meta-llama/Llama-3.2-11B-Vision-Instruct
-        if cls._instance is None:
-            api_key = st.secrets['hf_api_key']
-            api_base_url = "https://api-inference.huggingface.co/v1/"
-            cls._instance = OpenAI(api_key = api_key, base_url= api_base_url)
-        return cls._instance
\ No newline at end of file
+        from openai import OpenAI
+        api_key = read_secret('hf_api_key')
+        api_base_url = "https://api-inference.huggingface.co/v1/"
+        return OpenAI(api_key = api_key, base_url= api_base_url)
+
+ProviderRegistry.register('gemini', GoogleGeminiClientSingleton.create)
+ProviderRegistry.register('gemini_byok', GoogleGeminiClientSingleton.create, keyed=True)
+ProviderRegistry.register('openai', OpenAIClientSingleton.create)
+ProviderRegistry.register('llama', LlamaClientSingleton.create)
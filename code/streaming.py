@@ -0,0 +1,199 @@
+import asyncio
+import re
+
+import yaml
+
+from backend import LLMInference, YAMLTransformer, remove_code_block_markers
+from diagram import Diagram, Resource, load_yaml
+from icons import IconResolver, ICON_MATCH_THRESHOLD
+
+_LIST_ITEM = re.compile(r'^\s*- ', re.MULTILINE)
+
+class IncrementalYAML:
+    ''' Accumulates a streamed LLM response and re-parses it whenever a new list item starts, i.e. whenever the
+    previous resource entry can no longer grow. Reports resource entries as they become complete and validates the
+    final document, whose parsed data is kept in data.'''
+
+    def __init__(self):
+        self.buffer = ''
+        self.parsed_lines = 0
+        self.data = None
+        self.error = None
+        self.completed = []
+        self._seen = set()
+        self._closed = None
+
+    def feed(self, chunk:str):
+        ''' Adds a chunk and returns the resource entries that became complete because of it.'''
+        self.buffer += chunk
+        complete_text = self.buffer[:self.buffer.rfind('\n') + 1]
+        line_count = complete_text.count('\n')
+        if line_count == self.parsed_lines:
+            return []
+        new_lines = complete_text.split('\n')[self.parsed_lines:line_count]
+        self.parsed_lines = line_count
+        if not any(_LIST_ITEM.match(line) for line in new_lines):
+            return []
+        return self._update(complete_text, finished=False)
+
+    def close(self):
+        ''' Parses and validates the full response. Returns (cleaned text, newly completed entries); later calls
+        return the same.'''
+        if self._closed is None:
+            text = remove_code_block_markers(self.buffer)
+            completed = self._update(self.buffer, finished=True)
+            if self.error is not None:
+                raise ValueError(f"LLM returned invalid YAML: {self.error}")
+            diagram = self.data.get('diagram') if isinstance(self.data, dict) else None
+            if not isinstance(diagram, dict) or not isinstance(diagram.get('resources'), list):
+                raise ValueError("LLM returned YAML without a diagram.resources list")
+            self._closed = (text, completed)
+        return self._closed
+
+    @property
+    def resource_count(self):
+        return len(self.completed)
+
+    def _update(self, text, finished):
+        try:
+            data = load_yaml(remove_code_block_markers(text))
+        except yaml.YAMLError as e:
+            # A cut at a line boundary normally parses; keep the error and retry on the next item
+            self.error = e
+            return []
+        self.error = None
+        self.data = data
+        if not isinstance(data, dict) or not isinstance(data.get('diagram'), dict):
+            return []
+        diagram = data['diagram']
+        resources = diagram.get('resources')
+        if not isinstance(resources, list):
+            return []
+        # Anything written after the resources list means the list itself is finished
+        keys = list(diagram)
+        still_open = not finished and keys[-1] == 'resources' and list(data)[-1] == 'diagram'
+        newly_completed = []
+        self._collect(resources, still_open, (), newly_completed)
+        return newly_completed
+
+    def _collect(self, items, still_open, path, newly_completed):
+        for position, item in enumerate(items):
+            if not isinstance(item, dict):
+                continue
+            item_open = still_open and position == len(items) - 1
+            item_path = path + (position,)
+            if isinstance(item.get('of'), list):
+                self._collect(item['of'], item_open, item_path, newly_completed)
+            if not item_open and item_path not in self._seen:
+                self._seen.add(item_path)
+                self.completed.append(item)
+                newly_completed.append(item)
+
+async def stream_llm_document(inference:LLMInference, input_data:str, system_prompt:str, on_complete=None, progress=None,
+                              stage:str = '', byok:bool = False, refresh:bool = False):
+    ''' Streams one LLM pass, validating the YAML as it arrives. on_complete(entry) is called for each resource entry
+    as soon as it is complete; progress(message) receives a short status line. Returns the closed IncrementalYAML:
+    its data is the parsed answer, so the text is never parsed again.'''
+    document = IncrementalYAML()
+    characters = 0
+    # The document is validated before the answer is cached, so an invalid answer is asked for again next time
+    async for chunk in inference.stream_inference_google(input_data, system_prompt, byok=byok, refresh=refresh,
+                                                         validate=lambda text: document.close()):
+        characters += len(chunk)
+        for entry in document.feed(chunk):
+            if on_complete is not None:
+                on_complete(entry)
+        if progress is not None:
+            progress(f"{stage}: {characters:,} characters, {document.resource_count} resources")
+    _, completed = document.close()
+    for entry in completed:
+        if on_complete is not None:
+            on_complete(entry)
+    return document
+
+class IconPrefetch:
+    ''' Matches the icons of resource entries locally while the first pass is still streaming. add() is the
+    on_complete callback of stream_llm_document: completed entries are queued and scored in batches on a thread, and
+    the matches go into memo, which resolve_icons_locally reads once the stream is done. Only the entries completed
+    last are then still scored after the stream.'''
+    __slots__ = ('icon_descriptor_path', 'allowed_icons', 'providers', 'threshold', 'memo', 'pending', 'task')
+
+    def __init__(self, icon_descriptor_path, allowed_icons, providers, threshold:float, memo:dict):
+        self.icon_descriptor_path = icon_descriptor_path
+        self.allowed_icons = allowed_icons
+        self.providers = providers
+        self.threshold = threshold
+        self.memo = memo
+        self.pending = []
+        self.task = None
+
+    def add(self, entry:dict):
+        if entry.get('icon') is None or 'relates' in entry:
+            return
+        # Members of a cluster or group are reported as entries of their own
+        self.pending.append({key: value for key, value in entry.items() if key != 'of'})
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._drain())
+
+    async def finish(self):
+        if self.task is not None:
+            await self.task
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _drain(self):
+        while self.pending:
+            batch, self.pending = self.pending, []
+            await asyncio.to_thread(self._resolve, batch)
+
+    def _resolve(self, entries):
+        diagram = Diagram(resources=Resource.list_from(entries, []))
+        YAMLTransformer.resolve_icons_locally(diagram, IconResolver.load(self.icon_descriptor_path), self.allowed_icons,
+                                              self.providers, self.threshold, known_icons=self.memo)
+
+async def stream_resolved_diagram(input_data:str, first_pass:str, second_pass:str, cloud_icons:str, icon_descriptor_path,
+                                  exception_icon_path, api_key:str = "NULL", byok:bool = False, refresh:bool = False, progress=None,
+                                  allowed_icons=None, providers=None, threshold:float = ICON_MATCH_THRESHOLD, known_icons:dict = None):
+    ''' Async version of the first gemini pass, the icon match and resolve_icon_paths. The first pass
+    streams, and the placeholder icons of the resources it completes are matched locally as they arrive (see
+    IconPrefetch and IconResolver); only resources below threshold go through the second, streamed gemini pass.
+    known_icons is a dict the caller keeps between calls (e.g. in session state): resources already resolved by an
+    earlier call with the same icon choices skip both icon passes. refresh asks both gemini passes for new answers
+    and resolves every icon again. Returns the resolved Diagram.'''
+    # Memoised per icon selection, since allowed_icons and providers decide what a placeholder resolves to
+    memo = {}
+    if known_icons is not None:
+        selection = (tuple(allowed_icons or ()), tuple(providers or ()))
+        # Regenerate starts the selection's memo over, so earlier icon answers are not reused either
+        memo = known_icons[selection] = {} if refresh else known_icons.get(selection, {})
+    prefetch = IconPrefetch(icon_descriptor_path, allowed_icons, providers, threshold, memo)
+    inference = LLMInference(api_key = api_key)
+    try:
+        first_answer = await stream_llm_document(inference, input_data, first_pass, on_complete=prefetch.add, progress=progress,
+                                                 stage="Drafting diagram", byok=byok, refresh=refresh)
+        await prefetch.finish()
+    except BaseException:
+        prefetch.cancel()
+        raise
+
+    diagram = Diagram.from_dict(first_answer.data)
+    # Scoring resources against the icon keys (and loading the resolver the first time) is CPU work: run it, and
+    # the path resolution below, in a thread so the event loop keeps serving other requests meanwhile
+    unresolved = await asyncio.to_thread(
+        lambda: YAMLTransformer.resolve_icons_locally(diagram, IconResolver.load(icon_descriptor_path), allowed_icons,
+                                                      providers, threshold, known_icons=memo))
+    if unresolved:
+        icon_answer = await stream_llm_document(inference, YAMLTransformer.unresolved_icons_yaml(unresolved) + cloud_icons,
+                                                second_pass, progress=progress, stage=f"Matching {len(unresolved)} icons",
+                                                byok=byok, refresh=refresh)
+        YAMLTransformer.merge_llm_icons(unresolved, icon_answer.data, known_icons=memo)
+    if progress is not None:
+        progress("Resolved icons")
+    return await asyncio.to_thread(YAMLTransformer.resolve_icon_paths, diagram, icon_descriptor_path=icon_descriptor_path,
+                                   exception_icon_path=exception_icon_path)
+
+async def stream_resolved_yaml(*args, **kwargs):
+    ''' stream_resolved_diagram, returning the resolved diagram as YAML text.'''
+    return (await stream_resolved_diagram(*args, **kwargs)).to_yaml()
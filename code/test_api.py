@@ -0,0 +1,133 @@
+import asyncio
+import os
+import threading
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import api
+from batch import EXCEPTION_ICON_PATH, ICON_DESCRIPTOR_PATH
+from diagram import Diagram
+from icons import IconIndex
+
+def resolved_yaml(icon):
+    return f'''diagram:
+  name: Shop
+  resources:
+    - id: web
+      name: Web
+      type: custom
+      icon: {icon}
+'''
+
+@pytest.fixture
+def client(monkeypatch):
+    ''' The service with a fresh job queue, started and stopped by the app's lifespan.'''
+    monkeypatch.setattr(api, 'jobs', api.JobQueue(workers=1))
+    with TestClient(api.app) as client:
+        yield client
+
+def test_resolved_render_refuses_files_outside_the_descriptor(client, tmp_path):
+    secret = tmp_path / 'secret.svg'
+    secret.write_text('<svg xmlns="http://www.w3.org/2000/svg"><text>secret</text></svg>')
+    # A path that starts in the icons directory and climbs out of it
+    icons_dir = os.path.dirname(IconIndex.load(ICON_DESCRIPTOR_PATH).paths[0])
+    climbing = icons_dir + '/' + os.path.relpath(secret, icons_dir)
+    for icon in (str(secret), climbing, 'icon_descriptor.json'):
+        response = client.post('/render', json={'yaml': resolved_yaml(icon), 'resolved': True})
+        assert response.status_code == 422
+        assert 'not an icon of the descriptor' in response.json()['detail']
+        assert 'secret' not in response.text
+
+def test_descriptor_and_exception_icons_pass_the_check(client):
+    for icon in (IconIndex.load(ICON_DESCRIPTOR_PATH).paths[0], EXCEPTION_ICON_PATH, os.path.basename(EXCEPTION_ICON_PATH)):
+        api.jobs.check_icon_paths(Diagram.from_yaml(resolved_yaml(icon)))
+
+@pytest.fixture
+def renders(monkeypatch):
+    ''' Replaces dot: each render blocks until gate is set and returns an SVG naming the diagram; the first
+    diagram named 'Broken' fails instead. running counts the renders in progress, peak the most at once.'''
+    state = {'gate': threading.Event(), 'running': 0, 'peak': 0}
+    lock = threading.Lock()
+    def fake_render(diagram, use_symbols=True, fan_out=None):
+        with lock:
+            state['running'] += 1
+            state['peak'] = max(state['peak'], state['running'])
+        try:
+            state['gate'].wait(5)
+            if diagram.name == 'Broken':
+                raise RuntimeError('dot exploded')
+            return f'<svg>{diagram.name}</svg>'
+        finally:
+            with lock:
+                state['running'] -= 1
+    monkeypatch.setattr(api, 'render_svg_from_yaml', fake_render)
+    return state
+
+def named_yaml(name):
+    return f'diagram:\n  name: {name}\n  resources: []\n'
+
+async def until(condition):
+    for _ in range(500):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError('condition never became true')
+
+def run_queue(queue, scenario):
+    async def main():
+        queue.start()
+        try:
+            await scenario()
+        finally:
+            await queue.stop()
+    asyncio.run(main())
+
+def test_jobs_render_in_order_and_a_full_queue_is_refused(renders):
+    queue = api.JobQueue(workers=1, max_queued=1)
+    async def scenario():
+        first = queue.submit('render', api.RenderRequest(yaml=named_yaml('First')))
+        await until(lambda: first.status == 'running')
+        second = queue.submit('render', api.RenderRequest(yaml=named_yaml('Second')))
+        with pytest.raises(HTTPException) as refused:
+            queue.submit('render', api.RenderRequest(yaml=named_yaml('Third')))
+        assert refused.value.status_code == 429
+        assert second.status == 'queued' and list(queue.jobs) == [first.id, second.id]
+        renders['gate'].set()
+        await second.done.wait()
+        assert (first.status, first.svg, second.status, second.svg) == ('done', '<svg>First</svg>', 'done', '<svg>Second</svg>')
+        assert second.diagram.name == 'Second' and second.finished is not None
+    run_queue(queue, scenario)
+
+def test_a_failing_job_does_not_stop_its_worker(renders):
+    queue = api.JobQueue(workers=1)
+    renders['gate'].set()
+    async def scenario():
+        broken = queue.submit('render', api.RenderRequest(yaml=named_yaml('Broken')))
+        after = queue.submit('render', api.RenderRequest(yaml=named_yaml('After')))
+        await after.done.wait()
+        assert (broken.status, broken.error, broken.svg) == ('failed', 'RuntimeError: dot exploded', None)
+        assert after.status == 'done'
+    run_queue(queue, scenario)
+
+def test_cancelled_render_keeps_its_worker_until_dot_is_done(renders):
+    queue = api.JobQueue(workers=1)
+    async def scenario():
+        running = queue.submit('render', api.RenderRequest(yaml=named_yaml('Running')))
+        await until(lambda: renders['running'] == 1)
+        queue.cancel(running)
+        assert running.status == 'cancelled' and running.done.is_set()
+        queued = queue.submit('render', api.RenderRequest(yaml=named_yaml('Queued')))
+        skipped = queue.submit('render', api.RenderRequest(yaml=named_yaml('Skipped')))
+        queue.cancel(skipped)
+        # dot cannot be stopped: the next job waits for it instead of rendering next to it
+        await asyncio.sleep(0.1)
+        assert queued.status == 'queued'
+        renders['gate'].set()
+        await queued.done.wait()
+        await until(lambda: queue.queue.empty())
+        assert (queued.status, queued.svg) == ('done', '<svg>Queued</svg>')
+        assert (running.status, running.svg, skipped.status, skipped.svg) == ('cancelled', None, 'cancelled', None)
+        assert renders['peak'] == 1
+    run_queue(queue, scenario)
@@ -0,0 +1,102 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from cache import LLMResponseCache, LRUCache, RenderCache
+
+def test_concurrent_identical_requests_make_one_call():
+    cache = LLMResponseCache()
+    calls = []
+    release = threading.Event()
+    def compute():
+        calls.append(1)
+        release.wait(5)
+        return 'answer'
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(cache.get_or_compute, 'model', 'system', 'input', compute) for _ in range(8)]
+        # Let every request reach the cache before the one call finishes
+        deadline = time.monotonic() + 5
+        while cache.coalesced < 7 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        results = [future.result(5) for future in futures]
+    assert results == ['answer'] * 8
+    assert len(calls) == 1
+    assert (cache.misses, cache.coalesced, cache.hits) == (1, 7, 0)
+    assert cache.get_or_compute('model', 'system', 'input', lambda: 'other') == 'answer'
+    assert cache.hits == 1
+
+def test_waiters_see_the_error_and_nothing_is_cached():
+    cache = LLMResponseCache()
+    release = threading.Event()
+    def compute():
+        release.wait(5)
+        raise RuntimeError('quota')
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [executor.submit(cache.get_or_compute, 'model', 'system', 'input', compute) for _ in range(3)]
+        deadline = time.monotonic() + 5
+        while cache.coalesced < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for future in futures:
+            with pytest.raises(RuntimeError, match='quota'):
+                future.result(5)
+    assert cache.get_or_compute('model', 'system', 'input', lambda: 'recovered') == 'recovered'
+
+def test_refresh_bypasses_and_replaces_the_cached_answer():
+    cache = LLMResponseCache()
+    assert cache.get_or_compute('model', 'system', 'input', lambda: 'first') == 'first'
+    assert cache.get_or_compute('model', 'system', 'input', lambda: 'second', refresh=True) == 'second'
+    assert cache.get_or_compute('model', 'system', 'input', lambda: 'third') == 'second'
+
+def test_key_depends_on_model_prompt_input_and_byok_key():
+    keys = {LLMResponseCache.key_for(*parts) for parts in [('m', 's', 'i'), ('m2', 's', 'i'), ('m', 's2', 'i'), ('m', 's', 'i2'),
+                                                           ('m', 's', 'i', 'user key'), ('m', 's', 'i', 'other key')]}
+    assert len(keys) == 6
+    assert LLMResponseCache.key_for('m', 's', 'i', None) == LLMResponseCache.key_for('m', 's', 'i')
+
+def test_byok_answers_are_not_shared_with_the_app_key():
+    cache = LLMResponseCache()
+    assert cache.get_or_compute('model', 'system', 'input', lambda: 'app') == 'app'
+    assert cache.get_or_compute('model', 'system', 'input', lambda: 'user', api_key='user key') == 'user'
+    assert cache.get_or_compute('model', 'system', 'input', lambda: 'again') == 'app'
+
+def test_sqlite_store_survives_a_new_cache(tmp_path):
+    path = str(tmp_path / 'llm.sqlite')
+    LLMResponseCache(sqlite_path=path).get_or_compute('model', 'system', 'input', lambda: 'stored')
+    assert LLMResponseCache(sqlite_path=path).get_or_compute('model', 'system', 'input', lambda: 'recomputed') == 'stored'
+
+def test_lru_evicts_by_count_and_size():
+    cache = LRUCache(max_entries=2, max_bytes=10)
+    cache.put('a', '1234')
+    cache.put('b', '1234')
+    cache.get('a')
+    cache.put('c', '1')
+    assert 'b' not in cache and 'a' in cache and 'c' in cache
+    cache.put('d', '12345678')
+    assert cache.total_bytes <= 10
+
+def test_render_cache_clear_empties_memory_and_disk(tmp_path):
+    cache = RenderCache(disk_dir=str(tmp_path))
+    cache.put('key', '<svg/>')
+    cache.clear()
+    assert cache.get('key') is None
+    assert os.listdir(str(tmp_path)) == []
+
+def test_render_cache_key_ignores_yaml_formatting():
+    first = 'diagram:\n  name: A\n  resources:\n    - {id: a, name: A, type: custom, icon: i.svg}\n'
+    second = '# comment\ndiagram:\n  resources:\n  - icon: i.svg\n    type: custom\n    name: A\n    id: a\n  name: A\n'
+    assert RenderCache.key_for(first) == RenderCache.key_for(second)
+    assert RenderCache.key_for(first) != RenderCache.key_for(first, use_symbols=True)
+
+def test_rejected_answers_are_raised_and_not_cached():
+    cache = LLMResponseCache()
+    def validate(value):
+        if value == 'bad':
+            raise ValueError('not a diagram')
+    with pytest.raises(ValueError):
+        cache.get_or_compute('model', 'system', 'input', lambda: 'bad', validate=validate)
+    assert cache.get_or_compute('model', 'system', 'input', lambda: 'good', validate=validate) == 'good'
@@ -0,0 +1,38 @@
+import pytest
+
+from diagram import Diagram
+
+SINGLE_RELATION = '''
+diagram:
+  name: Shop
+  resources:
+    - id: web
+      name: Web
+      type: custom
+      icon: /path/to/web.svg
+    - id: db
+      name: DB
+      type: custom
+      icon: /path/to/db.svg
+  relates:
+    from: web
+    to: db
+    description: reads
+'''
+
+def test_single_relation_mapping_is_kept():
+    diagram = Diagram.from_yaml(SINGLE_RELATION)
+    assert [(relation.source, relation.target, relation.description) for relation in diagram.relates] == [('web', 'db', 'reads')]
+    assert Diagram.from_yaml(diagram.to_yaml()).to_dict() == diagram.to_dict()
+
+def test_relations_next_to_the_diagram_and_among_resources():
+    diagram = Diagram.from_dict({'diagram': {'resources': [{'id': 'a'}, {'id': 'b'}, {'relates': {'from': 'b', 'to': 'a'}}]},
+                                 'relates': [{'from': 'a', 'to': 'b'}]})
+    assert [(relation.source, relation.target) for relation in diagram.relates] == [('a', 'b'), ('b', 'a')]
+    assert [resource.id for resource in diagram.resources] == ['a', 'b']
+
+def test_relates_of_the_wrong_type_is_an_error():
+    with pytest.raises(ValueError, match='relates'):
+        Diagram.from_dict({'diagram': {'resources': [], 'relates': 'web -> db'}})
+    with pytest.raises(ValueError):
+        Diagram.from_dict({'resources': []})
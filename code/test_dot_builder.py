@@ -0,0 +1,180 @@
+import os
+import re
+
+import pytest
+
+from diagram import Diagram
+from dot_builder import DotBuilder
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'examples', 'source files')
+
+NESTED_YAML = '''
+diagram:
+  name: Nested & grouped
+  direction: top-to-bottom
+  style:
+    graph:
+      splines: polyline
+  resources:
+    - id: edge
+      name: Edge
+      type: cluster
+      of:
+        - id: lb
+          name: Load Balancer
+          type: custom
+          icon: /icons/lb.svg
+        - id: inner
+          name: Inner
+          type: cluster
+          of:
+            - id: web
+              name: Web
+              type: group
+              of:
+                - id: web1
+                  name: "Web 1"
+                  type: custom
+                  icon: /icons/web.svg
+                - id: web2
+                  name: "Web 2"
+                  type: custom
+                  icon: /icons/web.svg
+    - id: db
+      name: Database
+      type: custom
+      icon: /icons/db.svg
+  relates:
+    - from: lb
+      to: web
+      direction: outgoing
+      description: routes
+    - from: web
+      to: db
+      direction: bidirectional
+      color: red
+    - from: db
+      to: lb
+      direction: incoming
+      style: dashed
+    - from: db
+      to: missing
+'''
+
+_STATEMENT = re.compile(r'^\s*(?:"((?:[^"\\]|\\.)*)"|(\S+))(?: -> (?:"((?:[^"\\]|\\.)*)"|(\S+)))? \[(.*)\]$')
+_ATTRIBUTE = re.compile(r'(\w+)=("(?:[^"\\]|\\.)*"|<.*?>|[^\s\]]+)')
+
+def attributes(text):
+    return tuple(sorted((key, value[1:-1] if value.startswith('"') else value) for key, value in _ATTRIBUTE.findall(text)))
+
+def summary(source):
+    ''' Graph attributes, nodes (attributes of the clusters around them, attributes) and edges (tail label, head label, attributes) of DOT
+    source, independent of node ids and statement order.'''
+    graph, nodes, edges, labels, clusters = None, [], [], {}, []
+    for line in source.splitlines():
+        stripped = line.strip()
+        if stripped.startswith('subgraph'):
+            clusters.append(None)
+        elif stripped == '}' and clusters:
+            clusters.pop()
+        elif stripped.startswith('graph ['):
+            if clusters:
+                clusters[-1] = attributes(stripped[7:-1])
+            else:
+                graph = attributes(stripped[7:-1])
+        elif stripped.startswith(('node [', 'edge [')) or stripped.startswith('digraph'):
+            continue
+        elif _STATEMENT.match(stripped):
+            match = _STATEMENT.match(stripped)
+            tail, head = match.group(1) or match.group(2), match.group(3) or match.group(4)
+            if head is None:
+                labels[tail] = dict(attributes(match.group(5))).get('label')
+                nodes.append((tuple(clusters), attributes(match.group(5))))
+            else:
+                edges.append((tail, head, attributes(match.group(5))))
+    edges = [(labels.get(tail), labels.get(head), attrs) for tail, head, attrs in edges]
+    return graph, sorted(nodes), sorted(edges)
+
+def diagrams_library_dot(text):
+    ''' DOT source the diagrams library produces for a diagram, built the way the backend did before DotBuilder.'''
+    diagrams = pytest.importorskip('diagrams')
+    from diagrams import Cluster, Edge
+    from diagrams.custom import Custom
+
+    diagram = Diagram.from_yaml(text)
+    nodes = {}
+    def add(resource, group=None):
+        if resource.type == 'cluster':
+            with Cluster(resource.name):
+                for member in resource.of or []:
+                    add(member)
+        elif resource.type == 'group':
+            members = []
+            for member in resource.of or []:
+                add(member, members)
+            nodes[resource.id] = members
+            if group is not None:
+                group.extend(members)
+        else:
+            nodes[resource.id] = Custom(label=resource.name, icon_path=resource.icon)
+            if group is not None:
+                group.append(nodes[resource.id])
+
+    style = diagram.style or {}
+    directions = {'left-to-right': 'LR', 'right-to-left': 'RL', 'top-to-bottom': 'TB', 'bottom-to-top': 'BT'}
+    library_diagram = diagrams.Diagram(name=diagram.name or '', direction=directions.get(diagram.direction or 'left-to-right', 'LR'),
+                                       outformat='dot', show=False, graph_attr=style.get('graph', {}),
+                                       node_attr=style.get('node', {}), edge_attr=style.get('edge', {}))
+    # Entered but never exited: __exit__ would run dot
+    library_diagram.__enter__()
+    try:
+        for resource in diagram.resources:
+            add(resource)
+        for relation in diagram.relates:
+            if relation.source not in nodes or relation.target not in nodes:
+                continue
+            sources = nodes[relation.source] if isinstance(nodes[relation.source], list) else [nodes[relation.source]]
+            targets = nodes[relation.target] if isinstance(nodes[relation.target], list) else [nodes[relation.target]]
+            for source in sources:
+                for target in targets:
+                    edge = Edge(label=relation.description or '', color=relation.color or '', style=relation.style or '')
+                    direction = relation.direction or 'outgoing'
+                    if direction == 'outgoing':
+                        source >> edge >> target
+                    elif direction == 'incoming':
+                        source << edge << target
+                    elif direction == 'bidirectional':
+                        source << edge >> target
+                    else:
+                        source - edge - target
+        return library_diagram.dot.source
+    finally:
+        diagrams.setdiagram(None)
+
+@pytest.mark.parametrize('text', [NESTED_YAML, open(os.path.join(EXAMPLES_DIR, 'events_processing_aws.yaml')).read()],
+                         ids=['nested', 'events_processing_aws'])
+def test_dot_matches_diagrams_library(text):
+    expected = summary(diagrams_library_dot(text))
+    assert summary(DotBuilder(text).build()) == expected
+
+def test_build_does_not_modify_the_diagram():
+    diagram = Diagram.from_yaml(NESTED_YAML)
+    before = diagram.to_dict()
+    DotBuilder(diagram).build()
+    assert diagram.to_dict() == before
+
+def test_junction_fan_out_draws_m_plus_n_edges():
+    group = lambda name: {'id': name, 'name': name, 'type': 'group',
+                          'of': [{'id': f'{name}{n}', 'name': f'{name} {n}', 'type': 'custom', 'icon': 'i.svg'} for n in range(3)]}
+    data = {'diagram': {'resources': [group('a'), group('b')], 'relates': [{'from': 'a', 'to': 'b'}]}}
+    _, nodes, edges = summary(DotBuilder(data).build())
+    assert len(edges) == 9
+    _, nodes, edges = summary(DotBuilder(data, fan_out='junction').build())
+    assert len(edges) == 6
+    assert sum(1 for _, attrs in nodes if ('shape', 'point') in attrs) == 1
+    with pytest.raises(ValueError):
+        DotBuilder(data, fan_out='star').build()
+
+def test_custom_node_without_icon_is_an_error():
+    with pytest.raises(ValueError):
+        DotBuilder({'diagram': {'resources': [{'id': 'a', 'name': 'A', 'type': 'custom'}]}}).build()
@@ -0,0 +1,82 @@
+import json
+import logging
+import os
+
+import pytest
+
+from icon_bundle import IconBundle, build_bundle
+from instrumentation import Instrumentation, RingBufferExporter
+
+ICON = '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {0} {0}"><!-- note --><rect width="{0}" height="{0}"/></svg>'
+
+@pytest.fixture
+def bundle_files(tmp_path, monkeypatch):
+    ''' A one-icon tree, its descriptor and a bundle built from them; the shared bundle is reset around the test.'''
+    monkeypatch.setattr(IconBundle, '_instance', None)
+    monkeypatch.setattr(IconBundle, '_instance_stamp', None)
+    icons_dir = tmp_path / 'icons'
+    icons_dir.mkdir()
+    icon_path = icons_dir / 'box.svg'
+    icon_path.write_text(ICON.format(10))
+    descriptor_path = tmp_path / 'icon_descriptor.json'
+    descriptor_path.write_text(json.dumps({'box': str(icon_path)}))
+    bundle_path = str(tmp_path / 'icons.bundle')
+    build_bundle(bundle_path, str(icons_dir), str(descriptor_path))
+    return bundle_path, str(descriptor_path), str(icon_path), str(icons_dir)
+
+def touch_later(path, seconds):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + int(seconds * 1e9)))
+
+def test_bundle_serves_the_minified_icon(bundle_files):
+    bundle_path, descriptor_path, icon_path, _ = bundle_files
+    bundle = IconBundle.default(bundle_path, descriptor_path)
+    width, height, view_box, markup = bundle.get(icon_path)
+    assert (width, height, view_box) == (10, 10, '0 0 10 10')
+    assert 'rect' in markup and 'note' not in markup
+    assert IconBundle.default(bundle_path, descriptor_path) is bundle
+
+def test_rebuilt_bundle_is_picked_up(bundle_files):
+    bundle_path, descriptor_path, icon_path, icons_dir = bundle_files
+    first = IconBundle.default(bundle_path, descriptor_path)
+    with open(icon_path, 'w') as file:
+        file.write(ICON.format(20))
+    build_bundle(bundle_path, icons_dir, descriptor_path)
+    touch_later(bundle_path, 1)
+    second = IconBundle.default(bundle_path, descriptor_path)
+    assert second is not first
+    assert second.get(icon_path)[0] == 20
+
+def test_stale_bundle_is_reported_not_printed(bundle_files, monkeypatch, capsys):
+    bundle_path, descriptor_path, _, _ = bundle_files
+    ring = RingBufferExporter()
+    monkeypatch.setattr(Instrumentation, 'enabled', True)
+    monkeypatch.setattr(Instrumentation, 'exporters', [ring])
+    touch_later(descriptor_path, 1)
+    assert IconBundle.default(bundle_path, descriptor_path) is None
+    assert IconBundle.default(bundle_path, descriptor_path) is None
+    events = [record for record in ring.records() if record['type'] == 'event']
+    assert len(events) == 1 and events[0]['level'] == logging.getLevelName(logging.WARNING)
+    assert capsys.readouterr().out == ''
+    os.remove(bundle_path)
+    assert IconBundle.default(bundle_path, descriptor_path) is None
+
+def test_rebuild_closes_the_replaced_bundle(bundle_files):
+    bundle_path, descriptor_path, icon_path, icons_dir = bundle_files
+    first = IconBundle.default(bundle_path, descriptor_path)
+    build_bundle(bundle_path, icons_dir, descriptor_path)
+    touch_later(bundle_path, 1)
+    assert IconBundle.default(bundle_path, descriptor_path) is not first
+    assert first.get(icon_path) is None
+
+def test_inlining_looks_the_bundle_up_once_per_render(bundle_files, monkeypatch):
+    from backend import SVGTransformer
+    _, _, icon_path, _ = bundle_files
+    lookups = []
+    default = IconBundle.default
+    monkeypatch.setattr(IconBundle, 'default', classmethod(lambda cls, *args: lookups.append(1) or default.__func__(cls, *args)))
+    images = ''.join(f'<image xlink:href="{icon_path}" width="20" height="20" x="{x}" y="0"/>' for x in range(5))
+    svg = SVGTransformer.get_svg_code(f'<svg xmlns="http://www.w3.org/2000/svg" '
+                                      f'xmlns:xlink="http://www.w3.org/1999/xlink">{images}</svg>')
+    assert svg.count('<rect') == 5
+    assert len(lookups) == 1
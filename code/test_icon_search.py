@@ -0,0 +1,41 @@
+import json
+import os
+
+import pytest
+
+from icon_search import IconSearchIndex
+
+DESCRIPTOR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'icon_descriptor.json')
+
+@pytest.fixture(scope='module')
+def index_dir(tmp_path_factory):
+    ''' The index built into a fresh directory, as load() does on first use.'''
+    index_dir = str(tmp_path_factory.mktemp('icon_search_index'))
+    IconSearchIndex.load(DESCRIPTOR_PATH, index_dir)
+    return index_dir
+
+def test_search_finds_services_by_description(index_dir):
+    index = IconSearchIndex.load(DESCRIPTOR_PATH, index_dir)
+    queue, dynamo = index.search(['message queue', 'dynamo'], k=3, providers=['AWS'])
+    assert 'simple.queue.service' in queue[0][0]
+    assert 'dynamodb' in dynamo[0][0]
+    assert all(key.startswith('aws.') for key, _ in queue + dynamo)
+    assert [score for _, score in queue] == sorted((score for _, score in queue), reverse=True)
+    (kubernetes,) = index.search(['kubernetes cluster'], k=1, providers=['Google Cloud'])
+    assert 'kubernetes' in kubernetes[0][0]
+    assert index.search(['the and of'], k=3) == [[]]
+
+def test_suggest_picks_the_services_a_description_names(index_dir):
+    index = IconSearchIndex.load(DESCRIPTOR_PATH, index_dir)
+    suggested = index.suggest('Orders go through a Lambda function, then into DynamoDB.', providers=['AWS'])
+    assert any('lambda' in key for key in suggested) and any('dynamodb' in key for key in suggested)
+    assert index.suggest('') == []
+
+def test_saved_index_opens_with_the_same_results(index_dir):
+    with open(DESCRIPTOR_PATH, 'r') as file:
+        built = IconSearchIndex.build(json.load(file).keys())
+    opened = IconSearchIndex.open(index_dir)
+    queries = ['load balancer', 'object storage', 'virtual machine']
+    assert opened.search(queries, k=5) == built.search(queries, k=5)
+    # Written under temporary names and renamed into place: nothing half-written is left behind
+    assert sorted(os.listdir(index_dir)) == ['data.npy', 'idf.npy', 'indices.npy', 'indptr.npy', 'terms.json']
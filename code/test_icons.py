@@ -0,0 +1,83 @@
+import json
+import os
+
+import pytest
+
+from backend import YAMLTransformer
+from diagram import Diagram, Resource
+from icons import ICON_MATCH_THRESHOLD, IconIndex, IconResolver
+
+DESCRIPTOR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'icon_descriptor.json')
+
+@pytest.fixture(scope='module')
+def icon_index():
+    return IconIndex.load(DESCRIPTOR_PATH)
+
+def test_index_matches_linear_scan_on_every_key(icon_index):
+    for key in icon_index.keys:
+        assert icon_index.match_position(key) == icon_index.scan_position(key), key
+
+def test_index_matches_linear_scan_on_references_the_llm_writes(icon_index):
+    references = ['/path/to/web-service-icon.svg', 'aws.compute.ec2', 'ec2', 'EC2', '', 'azure', 'gcp.compute',
+                  'azure.databases.10121.icon.service.azure.cosmos.db.extra', 'x' * 300]
+    for key in icon_index.keys[::97]:
+        references.extend([key + '_48', 'prefix.' + key, key.upper(), key.replace('.', '_'), key.rsplit('.', 1)[0]])
+    for reference in references:
+        assert icon_index.match_position(reference) == icon_index.scan_position(reference), reference
+
+def test_match_returns_the_descriptor_path(icon_index):
+    with open(DESCRIPTOR_PATH, 'r') as file:
+        descriptor = json.load(file)
+    key = icon_index.keys[0]
+    path = icon_index.match(key)
+    assert os.path.isabs(path)
+    assert path.endswith(descriptor[key].replace('\\', '/').lstrip('./'))
+    assert icon_index.match('no-such-icon') is None
+
+def test_load_is_shared(icon_index):
+    assert IconIndex.load(DESCRIPTOR_PATH) is icon_index
+
+@pytest.fixture(scope='module')
+def icon_resolver():
+    return IconResolver.load(DESCRIPTOR_PATH)
+
+def resource(resource_id, name, icon):
+    return Resource(resource_id, name, 'custom', icon)
+
+@pytest.mark.parametrize('name, icon, wrong', [
+    ('Events Queue', '/path/to/sqs.svg', 'iot.events'),
+    ('Events Storage', '/path/to/s3.svg', 'storage.lens'),
+])
+def test_placeholder_file_name_outweighs_words_of_the_label(icon_resolver, name, icon, wrong):
+    (key, confidence), = icon_resolver.resolve([resource(name.lower().replace(' ', '_'), name, icon)], providers=['AWS'])
+    assert not (wrong in key and confidence >= ICON_MATCH_THRESHOLD), (key, confidence)
+
+@pytest.mark.parametrize('name, icon, service', [
+    ('Events Queue', '/path/to/sqs.svg', 'simple.queue.service'),
+    ('Events Storage', '/path/to/s3.svg', 'simple.storage.service'),
+    ('Web Server', '/path/to/ec2.svg', 'amazon.ec2_'),
+    ('Lambda (Inventory Alerts)', '/path/to/lambda.svg', 'aws.lambda_'),
+    ('API', '/path/to/api-gateway-icon.svg', 'api.gateway'),
+])
+def test_placeholder_naming_the_service_resolves_to_it(icon_resolver, name, icon, service):
+    (key, confidence), = icon_resolver.resolve([resource('resource', name, icon)], providers=['AWS'])
+    assert service in key and confidence >= ICON_MATCH_THRESHOLD, (key, confidence)
+
+def test_allowed_icons_limit_the_candidates(icon_resolver):
+    allowed = [key for key in icon_resolver.keys if key.endswith('arch_amazon.simple.queue.service_48')]
+    (key, _), = icon_resolver.resolve([resource('queue', 'Events Queue', '/path/to/queue.svg')], allowed_icons=allowed)
+    assert key == allowed[0]
+    assert icon_resolver.resolve([resource('blank', '', '')], providers=['AWS']) == [(None, 0.0)]
+
+def test_every_descriptor_key_maps_to_its_own_path(icon_index):
+    with open(DESCRIPTOR_PATH, 'r') as file:
+        descriptor = json.load(file)
+    keys = list(descriptor)
+    diagram = Diagram(resources=[Resource(f'r{position}', key, 'custom', key) for position, key in enumerate(keys)])
+    YAMLTransformer.resolve_icon_paths(diagram, DESCRIPTOR_PATH, 'blank.svg')
+    for key, resource in zip(keys, diagram.resources):
+        assert resource.icon == icon_index.paths[icon_index.key_positions[key]], key
+        assert resource.icon.endswith(descriptor[key].replace('\\', '/').lstrip('./')), key
+    # As regex patterns, some keys pick another icon or none
+    assert icon_index.match('alibaba.add') != icon_index.path_for('alibaba.add')
+    assert icon_index.path_for('/path/to/ec2.svg') == icon_index.match('/path/to/ec2.svg')
@@ -0,0 +1,163 @@
+from xml.sax.saxutils import escape
+
+import pytest
+from lxml import etree
+
+import incremental
+from backend import SVG_NAMESPACE, XLINK_HREF
+from cache import RenderCache
+from diagram import Diagram
+from dot_builder import DotBuilder
+from incremental import patch_node, patch_svg, render_incremental, svg_elements
+
+ICON = '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {} {}"><rect width="10" height="10"/></svg>'
+
+# What dot writes for the diagram below: titles are the DOT node names, and 'tail->head' (escaped) for edges
+LAYOUT = '''<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<svg width="400pt" height="200pt" viewBox="0.00 0.00 400.00 200.00" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">
+<g id="graph0" class="graph" transform="scale(1 1) rotate(0) translate(4 196)">
+<title>Shop</title>
+<polygon fill="white" stroke="none" points="-4,4 -4,-196 396,-196 396,4 -4,4"/>
+<g id="node1" class="node">
+<title>web</title>
+<image xlink:href="{web_icon}" width="100px" height="100px" preserveAspectRatio="xMinYMin meet" x="0" y="-180"/>
+<text text-anchor="middle" x="50" y="-62.3" font-family="Sans-Serif" font-size="13.00" fill="#2d3436">{web_label}</text>
+</g>
+<g id="node2" class="node">
+<title>db</title>
+<image xlink:href="{db_icon}" width="100px" height="100px" preserveAspectRatio="xMinYMin meet" x="280" y="-180"/>
+<text text-anchor="middle" x="330" y="-76.3" font-family="Sans-Serif" font-size="13.00" fill="#2d3436">{db_line1}</text>
+<text text-anchor="middle" x="330" y="-62.3" font-family="Sans-Serif" font-size="13.00" fill="#2d3436">{db_line2}</text>
+</g>
+<g id="edge1" class="edge">
+<title>web&#45;&gt;db</title>
+<path fill="none" stroke="{edge1_color}" d="M100,-130C160,-130 200,-130 270,-130"/>
+<polygon fill="{edge1_color}" stroke="{edge1_color}" points="270,-133.5 280,-130 270,-126.5 270,-133.5"/>
+<text text-anchor="middle" x="190" y="-134.8" font-family="Sans-Serif" font-size="13.00" fill="#2d3436">reads</text>
+</g>
+<g id="edge2" class="edge">
+<title>web&#45;&gt;db</title>
+<path fill="none" stroke="{edge2_color}" d="M100,-110C160,-110 200,-110 270,-110"/>
+<polygon fill="{edge2_color}" stroke="{edge2_color}" points="270,-113.5 280,-110 270,-106.5 270,-113.5"/>
+</g>
+</g>
+</svg>
+'''
+
+def diagram_yaml(web='Web', db='Orders\\nDatabase', web_icon='square', db_icon='square', color='red'):
+    relation_color = f'\n      color: {color}' if color else ''
+    return f'''diagram:
+  name: Shop
+  resources:
+    - id: web
+      name: {web}
+      type: custom
+      icon: {{{web_icon}}}
+    - id: db
+      name: "{db}"
+      type: custom
+      icon: {{{db_icon}}}
+  relates:
+    - from: web
+      to: db
+      direction: outgoing
+      description: reads
+    - from: web
+      to: db
+      direction: outgoing{relation_color}
+'''
+
+@pytest.fixture
+def icons(tmp_path):
+    ''' Icon files by name: two square ones and a wide one.'''
+    paths = {}
+    for name, width, height in (('square', 10, 10), ('other_square', 20, 20), ('wide', 30, 10)):
+        path = tmp_path / f'{name}.svg'
+        path.write_text(ICON.format(width, height))
+        paths[name] = str(path)
+    return paths
+
+@pytest.fixture
+def dot(monkeypatch):
+    ''' Replaces dot with the canned layout above, filled in from the built diagram. Records every layout.'''
+    layouts = []
+    def fake_render_built(builder, dot_source):
+        nodes = {name: attrs for _, kind, name, attrs in builder.elements if kind == 'node'}
+        edges = [attrs for _, kind, _, attrs in builder.elements if kind == 'edge']
+        db_lines = nodes['db']['label'].split('\n')
+        layouts.append(dot_source)
+        return LAYOUT.format(web_icon=nodes['web']['image'], web_label=escape(nodes['web']['label']), db_icon=nodes['db']['image'],
+                             db_line1=escape(db_lines[0]), db_line2=escape(db_lines[-1]),
+                             edge1_color=edges[0].get('color', '#7b8894'), edge2_color=edges[1].get('color', '#7b8894'))
+    monkeypatch.setattr(incremental, 'render_built', fake_render_built)
+    return layouts
+
+def render(text, icons, previous=None):
+    return render_incremental(Diagram.from_yaml(text.format(**icons)), previous=previous, cache=RenderCache())
+
+def group_of(svg, kind, title, occurrence=0):
+    return svg_elements(etree.fromstring(svg.encode('utf-8')))[(kind, title, occurrence)]
+
+def test_svg_elements_tell_repeated_edges_apart(icons, dot):
+    _, state = render(diagram_yaml(), icons)
+    groups = svg_elements(etree.fromstring(state.local_svg.encode('utf-8')))
+    assert sorted(groups) == [('edge', 'web->db', 0), ('edge', 'web->db', 1), ('node', 'db', 0), ('node', 'web', 0)]
+    assert groups[('edge', 'web->db', 0)].get('id') == 'edge1' and groups[('edge', 'web->db', 1)].get('id') == 'edge2'
+
+def test_same_diagram_is_not_laid_out_again(icons, dot):
+    svg, state = render(diagram_yaml(), icons)
+    again, _ = render(diagram_yaml(), icons, previous=state)
+    assert again is svg and len(dot) == 1
+
+def test_labels_with_the_same_line_count_are_patched(icons, dot):
+    _, state = render(diagram_yaml(), icons)
+    svg, patched = render(diagram_yaml(web='Store & Front', db='Order\\nStore'), icons, previous=state)
+    assert len(dot) == 1
+    texts = [text.text for text in group_of(patched.local_svg, 'node', 'db').iter(SVG_NAMESPACE + 'text')]
+    assert texts == ['Order', 'Store']
+    assert group_of(patched.local_svg, 'node', 'web').findtext(SVG_NAMESPACE + 'text') == 'Store & Front'
+    assert 'Store &amp; Front' in svg and 'Orders' not in svg
+    # Another number of lines changes the node height: laid out again
+    render(diagram_yaml(db='Orders\\nand\\nDatabase'), icons, previous=patched)
+    assert len(dot) == 2
+
+def test_patch_node_refuses_a_label_with_another_number_of_text_lines(icons, dot):
+    _, state = render(diagram_yaml(), icons)
+    group = group_of(state.local_svg, 'node', 'web')
+    assert not patch_node(group, {'label': 'Web'}, {'label': 'Web\nFront'})
+    assert patch_node(group, {'label': 'Web'}, {'label': 'Front'}) and group.findtext(SVG_NAMESPACE + 'text') == 'Front'
+
+def test_icon_with_the_same_aspect_is_swapped(icons, dot):
+    _, state = render(diagram_yaml(), icons)
+    _, patched = render(diagram_yaml(db_icon='other_square'), icons, previous=state)
+    assert len(dot) == 1
+    assert group_of(patched.local_svg, 'node', 'db').find(SVG_NAMESPACE + 'image').get(XLINK_HREF) == icons['other_square']
+    assert group_of(patched.local_svg, 'node', 'web').find(SVG_NAMESPACE + 'image').get(XLINK_HREF) == icons['square']
+
+def test_icon_with_another_aspect_is_laid_out_again(icons, dot):
+    _, state = render(diagram_yaml(), icons)
+    builder = DotBuilder(Diagram.from_yaml(diagram_yaml(db_icon='wide').format(**icons)))
+    builder.build()
+    assert patch_svg(state, builder) is None
+    _, laid_out = render(diagram_yaml(db_icon='wide'), icons, previous=state)
+    assert len(dot) == 2
+    assert group_of(laid_out.local_svg, 'node', 'db').find(SVG_NAMESPACE + 'image').get(XLINK_HREF) == icons['wide']
+
+def test_edge_colour_is_patched_on_the_right_edge(icons, dot):
+    _, state = render(diagram_yaml(), icons)
+    _, patched = render(diagram_yaml(color='blue'), icons, previous=state)
+    assert len(dot) == 1
+    first, second = (group_of(patched.local_svg, 'edge', 'web->db', occurrence) for occurrence in (0, 1))
+    assert [(element.get('stroke'), element.get('fill')) for element in second if element.tag != SVG_NAMESPACE + 'title'] == \
+        [('blue', 'none'), ('blue', 'blue')]
+    assert first.find(SVG_NAMESPACE + 'path').get('stroke') == '#7b8894'
+    # Back to the default colour, which only dot knows
+    _, relaid = render(diagram_yaml(color=None), icons, previous=patched)
+    assert len(dot) == 2 and group_of(relaid.local_svg, 'edge', 'web->db', 1).find(SVG_NAMESPACE + 'path').get('stroke') == '#7b8894'
+
+def test_element_missing_from_the_previous_svg_is_laid_out_again(icons, dot):
+    _, state = render(diagram_yaml(), icons)
+    state.local_svg = state.local_svg.replace('<title>web</title>', '<title>website</title>')
+    svg, laid_out = render(diagram_yaml(web='Front'), icons, previous=state)
+    assert len(dot) == 2 and 'Front' in svg
+    assert group_of(laid_out.local_svg, 'node', 'web').findtext(SVG_NAMESPACE + 'text') == 'Front'
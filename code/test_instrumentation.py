@@ -0,0 +1,78 @@
+import asyncio
+import json
+import logging
+
+import pytest
+
+import instrumentation
+from instrumentation import Instrumentation, LogExporter, RingBufferExporter, count, event, span
+
+@pytest.fixture
+def ring(monkeypatch):
+    ''' Instrumentation enabled with a fresh ring buffer only, restored afterwards.'''
+    exporter = RingBufferExporter()
+    monkeypatch.setattr(Instrumentation, 'enabled', True)
+    monkeypatch.setattr(Instrumentation, 'exporters', [exporter])
+    monkeypatch.setattr(Instrumentation, 'counters', {})
+    return exporter
+
+@pytest.fixture
+def fresh_logger(monkeypatch):
+    ''' The 'orchestree' logger without handlers, as in a process nobody configured logging for.'''
+    target = instrumentation.logger
+    monkeypatch.setattr(target, 'handlers', [])
+    monkeypatch.setattr(target, 'level', logging.NOTSET)
+    monkeypatch.setattr(target, 'propagate', True)
+    return target
+
+def test_spans_reach_the_ring_buffer_with_their_parent(ring):
+    async def child():
+        with span('child'):
+            await asyncio.sleep(0)
+    async def main():
+        with span('parent', stage='test') as parent:
+            await child()
+            parent.set(items=2)
+    asyncio.run(main())
+    (child_record,), (parent_record,) = ring.records('child'), ring.records('parent')
+    assert child_record['parent_id'] == parent_record['span_id']
+    assert parent_record['attributes'] == {'stage': 'test', 'items': 2}
+    assert parent_record['status'] == 'ok' and parent_record['duration_ms'] >= 0
+
+def test_failed_span_and_counters(ring):
+    with pytest.raises(ValueError):
+        with span('broken'):
+            raise ValueError('bad')
+    assert ring.records('broken')[0]['status'] == 'error'
+    count('hits', format='svg')
+    count('hits', 2, format='svg')
+    assert Instrumentation.counter_values() == {('hits', (('format', 'svg'),)): 3}
+
+def test_disabled_instrumentation_records_nothing(monkeypatch):
+    monkeypatch.setattr(Instrumentation, 'enabled', False)
+    assert span('anything') is instrumentation.NO_SPAN
+    count('anything')
+
+def test_log_exporter_prints_json_lines(capsys):
+    exporter = LogExporter('orchestree.test_trace')
+    exporter.export({'type': 'span', 'name': 'graphviz.dot'})
+    assert json.loads(capsys.readouterr().err) == {'type': 'span', 'name': 'graphviz.dot'}
+
+def test_log_exporter_from_environment_also_prints_events(fresh_logger, monkeypatch, capsys):
+    monkeypatch.delenv('ORCHESTREE_LOG_LEVEL', raising=False)
+    monkeypatch.setattr(Instrumentation, 'exporters', [])
+    monkeypatch.setattr(Instrumentation, 'enabled', False)
+    Instrumentation.from_environment('log')
+    assert isinstance(Instrumentation.exporter(LogExporter), LogExporter)
+    event(logging.INFO, 'Gemini used 10 prompt tokens')
+    err = capsys.readouterr().err
+    assert 'INFO orchestree: Gemini used 10 prompt tokens' in err
+    assert '"type": "event"' in err
+
+def test_log_level_without_exporters(fresh_logger, monkeypatch, capsys):
+    monkeypatch.setenv('ORCHESTREE_LOG_LEVEL', 'warning')
+    Instrumentation.from_environment('')
+    event(logging.INFO, 'quiet')
+    event(logging.WARNING, 'loud')
+    err = capsys.readouterr().err
+    assert 'loud' in err and 'quiet' not in err
@@ -0,0 +1,85 @@
+import re
+
+from lxml import etree
+
+from dot_builder import DotBuilder
+from packing import SVG_NS, pack_svgs
+
+def system(name, size, linked=True):
+    ''' A cluster of size nodes, chained by relations when linked.'''
+    nodes = [{'id': f'{name}.n{n}', 'name': f'{name} {n}', 'type': 'custom', 'icon': 'i.svg'} for n in range(size)]
+    relates = [{'from': f'{name}.n{n}', 'to': f'{name}.n{n + 1}'} for n in range(size - 1)] if linked else []
+    return {'id': name, 'name': name, 'type': 'cluster', 'of': nodes}, relates
+
+def build(*systems, relates=()):
+    resources, all_relates = [], list(relates)
+    for resource, system_relates in systems:
+        resources.append(resource)
+        all_relates.extend(system_relates)
+    builder = DotBuilder({'diagram': {'name': 'Packed', 'resources': resources, 'relates': all_relates}})
+    builder.build()
+    return builder
+
+def node_ids(source):
+    return set(re.findall(r'^\t+"([^"]+)" \[', source, re.MULTILINE))
+
+def edges(source):
+    return set(re.findall(r'^\t"([^"]+)" -> "([^"]+)"', source, re.MULTILINE))
+
+def test_parts_split_unrelated_systems_and_keep_every_node_and_edge_once():
+    builder = build(system('a', 5), system('b', 3), system('c', 4), system('d', 2))
+    parts = builder.parts(4)
+    assert len(parts) == 4
+    part_nodes = [node_ids(part) for part in parts]
+    assert sum(len(nodes) for nodes in part_nodes) == len(builder.node_ids)
+    assert set().union(*part_nodes) == builder.node_ids
+    full_dot = '\n'.join(builder.lines)
+    assert set().union(*(edges(part) for part in parts)) == edges(full_dot)
+    for nodes, part in zip(part_nodes, parts):
+        # Every edge stays inside its part
+        assert all(tail in nodes and head in nodes for tail, head in edges(part))
+        assert 'label=""' in part and 'pad="0"' in part
+
+def test_parts_keep_related_systems_together():
+    builder = build(system('a', 3), system('b', 3), system('c', 3), relates=[{'from': 'a.n0', 'to': 'c.n2'}])
+    parts = builder.parts(4)
+    assert len(parts) == 2
+    assert {'a.n0', 'c.n2'} <= node_ids(parts[0])
+    assert node_ids(parts[1]) == {'b.n0', 'b.n1', 'b.n2'}
+
+def test_parts_bin_components_into_max_parts_in_resource_order():
+    builder = build(*(system(name, size) for name, size in zip('abcdef', (6, 1, 1, 5, 1, 1))))
+    parts = builder.parts(2)
+    assert len(parts) == 2
+    assert sorted(len(node_ids(part)) for part in parts) == [7, 8]
+    assert 'a.n0' in node_ids(parts[0])
+    # The same diagram always splits the same way
+    assert build(*(system(name, size) for name, size in zip('abcdef', (6, 1, 1, 5, 1, 1)))).parts(2) == parts
+
+def test_diagram_in_one_piece_is_not_split():
+    assert build(system('a', 4), system('b', 4), relates=[{'from': 'a.n3', 'to': 'b.n0'}]).parts(4) == []
+    assert build(system('a', 4), system('b', 4)).parts(1) == []
+
+def part_svg(number, width, height):
+    return (f'<svg xmlns="{SVG_NS}" xmlns:xlink="http://www.w3.org/1999/xlink" width="{width}pt" height="{height}pt" '
+            f'viewBox="0.00 0.00 {width}.00 {height}.00"><g id="graph0" class="graph" transform="translate(4 {height - 4})">'
+            f'<title>part</title><g id="node1" class="node"><title>n{number}</title></g></g></svg>')
+
+def test_pack_stacks_parts_across_the_rank_direction_with_unique_ids():
+    packed = pack_svgs([part_svg(1, 100, 50), part_svg(2, 60, 80)], {'rankdir': 'LR', 'pad': '1', 'label': 'Packed', 'fontsize': '10'})
+    root = etree.fromstring(packed.encode('UTF-8'))
+    ids = [element.get('id') for element in root.iter() if element.get('id') is not None]
+    assert len(ids) == len(set(ids))
+    assert {'part1_node1', 'part2_node1'} <= set(ids)
+    # pad 1 inch on each side, parts stacked top to bottom 36pt apart, label underneath
+    assert root.get('width') == f'{100 + 2 * 72}pt'
+    assert root.get('height') == f'{50 + 36 + 80 + 15 + 2 * 72:.0f}pt'
+    groups = [element for element in root.iter(f'{{{SVG_NS}}}g') if element.get('id', '').endswith('graph0') and element.get('id') != 'graph0']
+    assert [group.get('transform').split(')')[0] for group in groups] == ['translate(72.00 72.00', 'translate(92.00 158.00']
+    assert root.findtext(f'.//{{{SVG_NS}}}text') == 'Packed'
+
+def test_pack_places_parts_side_by_side_for_top_to_bottom_diagrams():
+    packed = pack_svgs([part_svg(1, 100, 50), part_svg(2, 60, 80)], {'rankdir': 'TB', 'pad': '0'})
+    root = etree.fromstring(packed.encode('UTF-8'))
+    assert root.get('width') == f'{100 + 36 + 60}pt'
+    assert root.get('height') == '80pt'
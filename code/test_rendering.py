@@ -0,0 +1,45 @@
+import os
+import stat
+import time
+
+import pytest
+
+from rendering import GraphvizRenderer, RenderError, RenderQueueFull, RenderTimeout
+
+# dot is stood in for by a shell script
+pytestmark = pytest.mark.skipif(os.name != 'posix', reason='needs /bin/sh')
+
+@pytest.fixture
+def slow_dot(tmp_path):
+    ''' Stand-in for dot: echoes its input after a short delay, or fails on input starting with "fail".'''
+    path = tmp_path / 'dot'
+    path.write_text('#!/bin/sh\nsleep 0.3\ninput=$(cat)\ncase "$input" in fail*) echo broken >&2; exit 3;; esac\nprintf %s "$input"\n')
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+def test_full_queue_waits_for_a_slot(slow_dot):
+    renderer = GraphvizRenderer(max_workers=1, max_pending=1, queue_timeout=5, dot_binary=slow_dot)
+    first = renderer.submit('first')
+    started = time.monotonic()
+    assert renderer.render('second') == 'second'
+    assert time.monotonic() - started >= 0.3
+    assert first.result() == 'first'
+
+def test_full_queue_without_waiting_raises(slow_dot):
+    renderer = GraphvizRenderer(max_workers=1, max_pending=1, queue_timeout=5, dot_binary=slow_dot)
+    first = renderer.submit('first')
+    with pytest.raises(RenderQueueFull):
+        renderer.submit('second', queue_timeout=0)
+    first.result()
+    assert GraphvizRenderer(dot_binary=slow_dot).queue_timeout > 0
+
+def test_failures_and_timeouts_are_render_errors(slow_dot):
+    renderer = GraphvizRenderer(max_workers=2, dot_binary=slow_dot)
+    with pytest.raises(RenderError, match='status 3'):
+        renderer.render('fail')
+    with pytest.raises(RenderTimeout):
+        renderer.render('slow', timeout=0.05)
+
+def test_render_many_keeps_order(slow_dot):
+    renderer = GraphvizRenderer(max_workers=3, dot_binary=slow_dot)
+    assert renderer.render_many(['a', 'b', 'c']) == ['a', 'b', 'c']
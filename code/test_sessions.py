@@ -0,0 +1,63 @@
+import time
+
+from sessions import Session, SessionRegistry
+
+def rendered_session(registry, svg):
+    session = registry.open()
+    session.input_data = {'title': 'Shop'}
+    session.output = session.preview = svg
+    session.inline_output = svg + svg
+    session.known_icons[((), ())] = {'Orders Queue': 'aws.queue'}
+    return session
+
+def test_reap_frees_only_the_idle_sessions():
+    registry = SessionRegistry(idle_timeout=60)
+    idle = rendered_session(registry, '<svg>idle</svg>')
+    active = rendered_session(registry, '<svg>active</svg>')
+    assert idle.size == 3 * len('<svg>idle</svg>')
+    idle.last_interaction = time.time() - 61
+
+    assert registry.reap() == 1
+    assert list(registry.sessions) == [active.session_id]
+    assert idle.reaped and (idle.output, idle.preview, idle.inline_output, idle.input_data) == (None, None, None, None)
+    assert idle.known_icons == {} and idle.size == 0
+    assert not active.reaped and active.output == '<svg>active</svg>'
+    # Later passes find nothing more until the active one goes idle too
+    assert registry.reap() == 0
+    assert registry.reap(now=time.time() + 61) == 1 and registry.sessions == {}
+
+def test_open_after_reap_registers_the_same_session_again():
+    registry = SessionRegistry(idle_timeout=60)
+    session = rendered_session(registry, '<svg/>')
+    session.last_interaction -= 120
+    registry.reap()
+
+    reopened = registry.open(session)
+    assert reopened is session and not session.reaped
+    assert registry.sessions == {session.session_id: session}
+    assert time.time() - session.last_interaction < 5 and session.output is None
+    # A touched session is not idle, and a new one gets its own id
+    assert registry.reap() == 0
+    assert registry.open().session_id != session.session_id and len(registry.sessions) == 2
+
+def test_close_and_configure(monkeypatch):
+    monkeypatch.setattr(SessionRegistry, '_instance', SessionRegistry())
+    old = SessionRegistry.default()
+    kept = rendered_session(old, '<svg/>')
+    closed = rendered_session(old, '<svg/>')
+    old.close(closed)
+    assert closed.output is None and closed.session_id not in old.sessions
+
+    registry = SessionRegistry.configure(idle_timeout=5, reap_interval=3600)
+    try:
+        assert SessionRegistry.default() is registry and old._stop.is_set()
+        assert registry.sessions == {kept.session_id: kept} and registry.idle_timeout == 5
+    finally:
+        registry.stop()
+
+def test_session_size_counts_a_shared_preview_once():
+    session = Session()
+    session.output = session.preview = 'x' * 100
+    assert session.size == 100
+    session.preview = 'y' * 10
+    assert session.size == 110
@@ -0,0 +1,46 @@
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+from singletons import GeminiModel, GoogleGeminiClientSingleton
+
+@pytest.fixture
+def genai(monkeypatch):
+    ''' Stand-in google.generativeai: configure() records the key, models take it as their client on the first call.'''
+    module = types.ModuleType('google.generativeai')
+    module.configured = []
+    module.configure = lambda api_key: module.configured.append(api_key)
+    class GenerativeModel:
+        def __init__(self, name):
+            self.client = None
+        def generate_content(self, contents, stream=False):
+            if self.client is None:
+                self.client = module.configured[-1]
+            time.sleep(0.05)
+            return (self.client, contents)
+    module.GenerativeModel = GenerativeModel
+    package = types.ModuleType('google')
+    package.generativeai = module
+    monkeypatch.setitem(sys.modules, 'google', package)
+    monkeypatch.setitem(sys.modules, 'google.generativeai', module)
+    monkeypatch.setattr(GoogleGeminiClientSingleton, '_configured_key', None)
+    return module
+
+def test_models_keep_their_own_key(genai):
+    models = [GoogleGeminiClientSingleton.create(api_key=key) for key in ('first', 'second', 'first', 'second')]
+    assert all(isinstance(model, GeminiModel) for model in models)
+    results = [None] * len(models)
+    def call(position):
+        results[position] = models[position].generate_content(str(position))
+    threads = [threading.Thread(target=call, args=(position,)) for position in range(len(models))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert results == [('first', '0'), ('second', '1'), ('first', '2'), ('second', '3')]
+    # Bound models no longer depend on the configured key
+    genai.configure(api_key='other')
+    assert models[0].generate_content('again') == ('first', 'again')
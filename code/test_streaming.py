@@ -0,0 +1,161 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+import backend
+from backend import LLMInference
+from cache import LLMResponseCache
+from streaming import IncrementalYAML, stream_llm_document, stream_resolved_diagram
+
+DESCRIPTOR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'icon_descriptor.json')
+
+ANSWER = '''```yaml
+diagram:
+  name: Shop
+  resources:
+    - id: queue
+      name: Orders Queue
+      type: custom
+      icon: /path/to/orders-icon.svg
+    - id: web
+      name: Web
+      type: custom
+      icon: /path/to/web-icon.svg
+```'''
+
+@pytest.fixture
+def llm(monkeypatch):
+    ''' Replaces the gemini stream: answers come from the answers dict (system prompt -> text), chunk by chunk.'''
+    monkeypatch.setattr(LLMResponseCache, '_instance', LLMResponseCache())
+    calls = []
+    answers = {}
+    async def fake_stream(self, input_data, system_prompt, byok):
+        calls.append(system_prompt)
+        await asyncio.sleep(0.01)
+        text = answers[system_prompt]
+        for start in range(0, len(text), 40):
+            await asyncio.sleep(0.01)
+            yield text[start:start + 40]
+    monkeypatch.setattr(LLMInference, '_stream_google', fake_stream)
+    return calls, answers
+
+async def collect(input_data, system_prompt, refresh=False):
+    return ''.join([chunk async for chunk in LLMInference('NULL').stream_inference_google(input_data, system_prompt, refresh=refresh)])
+
+def test_identical_streams_make_one_call(llm):
+    calls, answers = llm
+    answers['first'] = ANSWER
+    async def main():
+        return await asyncio.gather(*(collect('input', 'first') for _ in range(3)))
+    results = asyncio.run(main())
+    assert calls == ['first']
+    assert results[0] == ANSWER
+    assert results[1] == results[2] == backend.remove_code_block_markers(ANSWER)
+    cache = LLMResponseCache.default()
+    assert (cache.misses, cache.coalesced) == (1, 2)
+    assert asyncio.run(collect('input', 'first')) == backend.remove_code_block_markers(ANSWER)
+    assert calls == ['first'] and cache.hits == 1
+    asyncio.run(collect('input', 'first', refresh=True))
+    assert calls == ['first', 'first']
+
+def test_failed_stream_fails_its_waiters_and_is_not_cached(llm):
+    calls, answers = llm
+    async def main():
+        return await asyncio.gather(*(collect('input', 'missing') for _ in range(2)), return_exceptions=True)
+    results = asyncio.run(main())
+    assert all(isinstance(result, KeyError) for result in results)
+    assert calls == ['missing']
+    answers['missing'] = ANSWER
+    assert asyncio.run(collect('input', 'missing')) == ANSWER
+
+def test_regenerate_asks_the_icon_pass_again(llm):
+    calls, answers = llm
+    answers['first'] = ANSWER
+    answers['icons'] = 'diagram:\n  resources:\n    - id: queue\n      icon: aws.simple.queue\n    - id: web\n      icon: aws.ec2\n'
+    known_icons = {}
+    def run(refresh):
+        return asyncio.run(stream_resolved_diagram('input', 'first', 'icons', '', DESCRIPTOR_PATH, 'blank.svg', refresh=refresh,
+                                                   providers=['AWS'], known_icons=known_icons))
+    run(False)
+    assert calls == ['first', 'icons']
+    run(False)
+    assert calls == ['first', 'icons']
+    run(True)
+    assert calls == ['first', 'icons', 'first', 'icons']
+
+def test_incremental_yaml_reports_finished_entries_only():
+    document = IncrementalYAML()
+    text = backend.remove_code_block_markers(ANSWER) + '\n'
+    completed = []
+    for line in text.splitlines(keepends=True):
+        completed += [entry['id'] for entry in document.feed(line)]
+    assert completed == ['queue']
+    _, rest = document.close()
+    assert [entry['id'] for entry in rest] == ['web']
+    with pytest.raises(ValueError):
+        IncrementalYAML().close()
+
+def test_icons_are_resolved_off_the_event_loop_while_the_first_pass_streams(llm, monkeypatch):
+    calls, answers = llm
+    answers['first'] = ANSWER
+    answers['icons'] = 'diagram:\n  resources:\n    - id: web\n      icon: aws.ec2\n'
+    order = []
+    stream = LLMInference._stream_google
+    async def recorded_stream(self, input_data, system_prompt, byok):
+        async for chunk in stream(self, input_data, system_prompt, byok):
+            yield chunk
+        order.append(('stream done', system_prompt))
+    monkeypatch.setattr(LLMInference, '_stream_google', recorded_stream)
+    threads = []
+    for name in ('resolve_icons_locally', 'resolve_icon_paths'):
+        original = getattr(backend.YAMLTransformer, name)
+        def recording(*args, name=name, original=original, **kwargs):
+            threads.append(threading.current_thread())
+            order.append((name, [resource.name for _, resource in args[0].iter_resources()]))
+            return original(*args, **kwargs)
+        monkeypatch.setattr(backend.YAMLTransformer, name, staticmethod(recording))
+    asyncio.run(stream_resolved_diagram('input', 'first', 'icons', '', DESCRIPTOR_PATH, 'blank.svg', providers=['AWS']))
+    # The queue entry is complete (the web entry has started) before the first pass ends
+    assert order[0] == ('resolve_icons_locally', ['Orders Queue'])
+    assert order.index(('stream done', 'first')) > 0
+    assert threading.main_thread() not in threads
+
+def test_invalid_answer_is_raised_and_asked_for_again(llm):
+    calls, answers = llm
+    answers['first'] = 'diagram:\n  name: [unclosed\n'
+    async def document():
+        return await stream_llm_document(LLMInference('NULL'), 'input', 'first')
+    for _ in range(2):
+        with pytest.raises(ValueError, match='invalid YAML'):
+            asyncio.run(document())
+    assert calls == ['first', 'first']
+    answers['first'] = ANSWER
+    assert [entry['id'] for entry in asyncio.run(document()).completed] == ['queue', 'web']
+    asyncio.run(document())
+    assert calls == ['first', 'first', 'first']
+
+def test_abandoned_stream_stops_its_worker(monkeypatch):
+    monkeypatch.setattr(LLMResponseCache, '_instance', LLMResponseCache())
+    pulled = []
+    class Chunk:
+        def __init__(self, text):
+            self.text = text
+    class SlowModel:
+        def generate_content(self, contents, stream=False):
+            for position in range(20):
+                time.sleep(0.02)
+                pulled.append(position)
+                yield Chunk(f'{position}\n')
+    monkeypatch.setattr(LLMInference, 'gemini_request', lambda self, input_data, system_prompt, byok=False: (SlowModel(), system_prompt + input_data))
+    async def first_chunk():
+        stream = LLMInference('NULL').stream_inference_google('input', 'system')
+        chunk = await stream.__anext__()
+        await stream.aclose()
+        # The loop keeps running, as in a server
+        await asyncio.sleep(0.2)
+        return chunk
+    assert asyncio.run(first_chunk()) == '0\n'
+    assert len(pulled) < 5